@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: acq_process.py
+#
+# Description: Runs the CWS sensor acquisition in its own process, so nothing
+#           else the main loop does (display, storage, analytics, the status
+#           server, garbage collection) can run while an echo is being timed.
+#
+#           ACQUISITION_PROCESS forks the acquisition process, which owns the
+#           BME280, the HC-SR04 rangers (a RANGER_ARRAY, ranger_array.py) and
+#           the hall sensor. acquire() asks it for a
+#           measurement through a control word of a SHM_RING (shm_ring.py)
+#           and waits for the reading to show up in the ring. Each reading is
+#           one fixed-layout ACQ_RECORD: the BME280 values, the raw echo
+#           times and the range worked out from them for each of up to
+#           MAX_RANGERS rangers, and the hall sensor state, counts and latest
+#           transitions.
+#
+#           acquire(echos=1) is a level check instead: each ranger pings
+#           once, and the BME280 is not read. The hall sensor state and
+#           counts come back, but its transitions are left for the next
+#           measurement.
+#
+#           The process only reads the control words between measurements,
+#           and only writes to the ring, and its readers only read, so
+#           neither side ever waits on the other. The ring is named
+#           RING_NAME, so other programs can attach and watch the readings
+#           as they come in (./acq_process.py --watch).
+#
+#           In the acquisition process:
+#             * the garbage collector is frozen and off, and run by hand
+#               after each measurement has been published, never during one
+#             * SIGINT is ignored, the main process stops it with close()
+#             * with nice or fifo set, its priority is raised (os.nice() or
+#               SCHED_FIFO, both need root). If that is not allowed, it says
+#               so and runs at normal priority.
+#
+#           The process is forked before the caller creates any drivers or
+#           threads of its own. Driver metrics (metrics.py) hooked before the
+#           fork are counted in the acquisition process. With send_metrics=True it
+#           publishes its registry's values() to a second, small ring before
+#           each reading, and acquire() hands them to the main process's
+#           registry (set_remote()), so its /metrics shows them.
+#
+#           With sim=True (sim_hw.py installed before the fork) the process
+#           moves its own virtual clock up to the requester's before every
+#           measurement, and both sides poll in real time.
+#
+#           Usage:
+#             ./acq_process.py [--sim] [--count N]    take N readings
+#             ./acq_process.py --watch                show cws_main.py's
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Several rangers
+#          20261018 Driver metrics back to the main process
+#          20261018 Level checks
+#
+#-------------------------------------------------------------------------------
+
+import gc
+import math
+import multiprocessing
+import os
+import signal
+import struct
+import time
+
+import metrics
+from shm_ring import SHM_RING
+
+RING_NAME = 'cws_acq'
+RING_SLOTS = 64
+MAX_ECHOS = 10
+MAX_RANGERS = 4
+HALL_EVENTS = 8      # hall transitions carried per reading, older ones are lost
+
+# request Q, time d, cpu_seconds d, cycle_time f, temp f, pressure f,
+# humidity f, bme_ok B, hall B, ranger count B, event count B, on_count I,
+# off_count I, bounces I, lost I, pings I, bme_reads I, ranges, echo counts,
+# echo times (MAX_ECHOS per ranger), event times, event levels
+ACQ_RECORD = struct.Struct('<Qddffff4B6I{}f{}B{}I{}d{}B'.format(
+                           MAX_RANGERS, MAX_RANGERS, MAX_RANGERS * MAX_ECHOS,
+                           HALL_EVENTS, HALL_EVENTS))
+FIELDS = 17          # fields before the ranges
+
+# control words, written by the requesting process
+REQUEST = 0          # number of the latest measurement asked for
+REQUEST_TIME = 1     # its time.monotonic_ns(), for the simulated clock
+STOP = 2             # non-zero to end the acquisition process
+ECHOS = 3            # echoes per ranger for a level check, 0 to measure
+
+POLL_SECONDS = 0.005
+ECHO_TIMEOUT = -1    # HC_SR04.ECHO_TIMEOUT, the range with no valid echo
+
+#-------------------------------------------------------------------------------
+
+def set_priority(nice=None, fifo=None):
+  # raise the priority of this process, fifo is a SCHED_FIFO priority (1-99)
+  try:
+    if fifo is not None:
+      os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(fifo))
+    elif nice is not None:
+      os.nice(nice)
+  except (AttributeError, OSError) as e:
+    print('acquisition process: could not raise priority ({}), running at normal priority'.format(e))
+
+#-------------------------------------------------------------------------------
+
+def acquisition_main(ring, ranger_pins, hall_pin, nice, fifo, sim, bme_cal_file=None,
+                     metrics_ring=None):
+  # the acquisition process
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  set_priority(nice, fifo)
+
+  import RPi.GPIO as GPIO
+  from bme280_sensor import BME280_WRAPPER
+  from hc_sr04_sensor import HC_SR04
+  from ranger_array import RANGER_ARRAY
+  from hall_sensor import HALL_SENSOR
+
+  sleep = time.sleep
+  sync = None
+  if sim:
+    import sim_hw
+    sleep = sim_hw.real_sleep
+    sync = sim_hw.world.clock.advance_to
+
+  GPIO.setwarnings(False)
+  GPIO.setmode(GPIO.BCM)
+  bme = BME280_WRAPPER(cal_file=bme_cal_file)
+  rangers = RANGER_ARRAY([HC_SR04(trig_pin, echo_pin, edge_detect=True)
+                          for trig_pin, echo_pin in ranger_pins])
+  hall = HALL_SENSOR(hall_pin, edge_detect=True)
+  temp_C = 20
+
+  # everything that lives for the whole run is frozen out of the collector
+  gc.collect()
+  gc.freeze()
+  gc.disable()
+
+  served = 0   # requests are numbered from 1, one may already be waiting
+  while ring.get_control(STOP) == 0:
+    request = ring.get_control(REQUEST)
+    if request == served:
+      sleep(POLL_SECONDS)
+      continue
+    served = request
+    check = ring.get_control(ECHOS)
+    if sync is not None:
+      sync(ring.get_control(REQUEST_TIME))
+
+    start = time.monotonic()
+    timestamp = time.time()
+    data = None
+    if check == 0:
+      try:
+        data = bme.read()
+        temp_C = data['temp']
+      except Exception:
+        pass
+    try:
+      if check == 0:
+        echos = rangers.get_echos(temp_C, adaptive=True)
+      else:
+        echos = rangers.get_echos(temp_C, max_echos=min(check, MAX_ECHOS))
+      echos = [t_ns[:MAX_ECHOS] for t_ns in echos]
+    except Exception:
+      echos = [[] for ii in range(len(rangers))]
+    distances = rangers.echos_to_distances(echos, temp_C)
+    padding = MAX_RANGERS - len(rangers)
+    snapshot = hall.snapshot(events=check == 0)
+    cycle_time = time.monotonic() - start
+
+    if metrics_ring is not None:
+      # before the reading, so the counts are current when it shows up
+      metrics_ring.publish(*metrics.registry.values())
+
+    events = snapshot['events'][-HALL_EVENTS:]
+    lost = snapshot['lost'] + len(snapshot['events']) - len(events)
+    missing = (math.nan, math.nan, math.nan)
+    ring.publish(request, timestamp, time.process_time(), cycle_time,
+                 *(missing if data is None else (data['temp'], data['pressure'], data['humidity'])),
+                 data is not None, snapshot['state'], len(rangers), len(events),
+                 snapshot['on_count'], snapshot['off_count'], snapshot['bounces'], lost,
+                 rangers.pings, bme.cache.misses,
+                 *(distances + [ECHO_TIMEOUT] * padding),
+                 *([len(t_ns) for t_ns in echos] + [0] * padding),
+                 *[t for t_ns in echos + [[]] * padding for t in t_ns + [0] * (MAX_ECHOS - len(t_ns))],
+                 *([e[0] for e in events] + [0.0] * (HALL_EVENTS - len(events))),
+                 *([e[1] for e in events] + [0] * (HALL_EVENTS - len(events))))
+
+    # the garbage of this measurement, while nothing is being timed
+    gc.collect()
+
+#-------------------------------------------------------------------------------
+
+def decode(values):
+  # an ACQ_RECORD tuple as the readings dict the main loop uses
+  (request, timestamp, cpu_seconds, cycle_time, temp, pressure, humidity,
+   bme_ok, hall, n_rangers, n_events, on_count, off_count, bounces, lost, pings,
+   bme_reads) = values[:FIELDS]
+  ranges = values[FIELDS:FIELDS + n_rangers]
+  counts = values[FIELDS + MAX_RANGERS:FIELDS + MAX_RANGERS + n_rangers]
+  echos = FIELDS + 2 * MAX_RANGERS
+  events = echos + MAX_RANGERS * MAX_ECHOS
+  times = values[events:events + HALL_EVENTS]
+  levels = values[events + HALL_EVENTS:]
+  return {
+    'request'     : request,
+    'time'        : timestamp,
+    'cpu_seconds' : cpu_seconds,
+    'cycle_time'  : cycle_time,
+    'bme'         : {'temp': temp, 'pressure': pressure, 'humidity': humidity} if bme_ok else None,
+    'echos'       : [list(values[echos + k * MAX_ECHOS:echos + k * MAX_ECHOS + count])
+                     for k, count in enumerate(counts)],
+    'ranges'      : list(ranges),
+    'hall'        : hall,
+    'hall_events' : {
+      'state'     : hall,
+      'on_count'  : on_count,
+      'off_count' : off_count,
+      'bounces'   : bounces,
+      'events'    : list(zip(times[:n_events], levels[:n_events])),
+      'lost'      : lost,
+    },
+    'pings'       : pings,
+    'bme_reads'   : bme_reads,
+  }
+
+#-------------------------------------------------------------------------------
+
+class ACQUISITION_PROCESS:
+  def __init__(self, ranger_pins=((23, 24), (17, 27)), hall_pin=21, nice=None, fifo=None,
+               slots=RING_SLOTS, sim=False, timeout=10, bme_cal_file=None, send_metrics=False):
+    if len(ranger_pins) > MAX_RANGERS:
+      raise ValueError('at most {} rangers'.format(MAX_RANGERS))
+    self.ring = SHM_RING(ACQ_RECORD, slots, RING_NAME)
+    self.rangers = len(ranger_pins)
+    self.metrics_ring = None
+    if send_metrics:
+      values = struct.Struct('<{}d'.format(len(metrics.registry.values())))
+      self.metrics_ring = SHM_RING(values, 2)
+    self.timeout = timeout
+    self.sleep = time.sleep
+    if sim:
+      import sim_hw
+      self.sleep = sim_hw.real_sleep
+
+    self.request = 0
+    self.requests = 0
+    self.timeouts = 0
+    self.last = None    # the last reading
+
+    context = multiprocessing.get_context('fork')
+    self.process = context.Process(target=acquisition_main, name='cws-acq', daemon=True,
+                                   args=(self.ring, ranger_pins, hall_pin, nice, fifo, sim,
+                                         bme_cal_file, self.metrics_ring))
+    self.process.start()
+
+  #-------------------------------------
+
+  def acquire(self, echos=0):
+    # take one measurement, returns the readings dict (see decode()). A
+    # measurement that does not come back within timeout seconds (real
+    # time) reads as no readings. With echos > 0 it is a level check of
+    # that many pings per ranger.
+    self.request += 1
+    self.requests += 1
+    self.ring.set_control(ECHOS, echos)
+    self.ring.set_control(REQUEST_TIME, time.monotonic_ns())
+    self.ring.set_control(REQUEST, self.request)
+
+    deadline = time.perf_counter() + self.timeout
+    while time.perf_counter() < deadline and self.process.is_alive():
+      n, values = self.ring.latest()
+      if values is not None and values[0] == self.request:
+        readings = decode(values)
+        if echos == 0:
+          self.last = readings
+        if self.metrics_ring is not None:
+          n, counts = self.metrics_ring.latest()
+          if counts is not None:
+            metrics.registry.set_remote(counts)
+        return readings
+      self.sleep(POLL_SECONDS)
+
+    self.timeouts += 1
+    return {'bme': None, 'echos': None, 'ranges': [ECHO_TIMEOUT] * self.rangers, 'hall': None,
+            'hall_events': None}
+
+  #-------------------------------------
+
+  def close(self):
+    self.ring.set_control(STOP, 1)
+    self.process.join(2)
+    if self.process.is_alive():
+      self.process.terminate()
+      self.process.join()
+    self.ring.close()
+    if self.metrics_ring is not None:
+      self.metrics_ring.close()
+
+  #-------------------------------------
+
+  def stats(self):
+    last = self.last or {}
+    return {
+      'requests'   : self.requests,
+      'timeouts'   : self.timeouts,
+      'cycle_time' : last.get('cycle_time'),
+      'cpu_seconds': last.get('cpu_seconds', 0.0),
+      'pings'      : last.get('pings', 0),
+      'bme_reads'  : last.get('bme_reads', 0),
+    }
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser(description='CWS acquisition process')
+  parser.add_argument('--sim', action='store_true', help='use the simulated hardware')
+  parser.add_argument('--count', type=int, default=5, help='readings to take')
+  parser.add_argument('--watch', action='store_true',
+                      help="show the readings of a running cws_main.py --acq-process")
+  args = parser.parse_args()
+
+  if args.watch:
+    ring = SHM_RING(ACQ_RECORD, name=RING_NAME, create=False)
+    ring.read_seq = ring.write_seq()
+    try:
+      while True:
+        records, lost = ring.read_new()
+        for values in records:
+          r = decode(values)
+          print('{}  range {} cm  temp {}  hall {}  ({:.3f} s){}'.format(
+                time.strftime('%H:%M:%S', time.localtime(r['time'])),
+                ' '.join('{:.2f}'.format(d) for d in r['ranges']),
+                r['bme'] and round(r['bme']['temp'], 1), r['hall'], r['cycle_time'],
+                '  {} lost'.format(lost) if lost > 0 else ''))
+        time.sleep(1)
+    except KeyboardInterrupt:
+      ring.close()
+  else:
+    if args.sim:
+      import sim_hw
+      sim_hw.install()
+
+    print('ACQUISITION_PROCESS class test example')
+    acq = ACQUISITION_PROCESS(sim=args.sim)
+    for ii in range(args.count):
+      t0 = time.perf_counter()
+      r = acq.acquire()
+      print('range {} cm  {} echoes  bme {}  hall {}  ({:.3f} s, {:.3f} s to return)'.format(
+            ' '.join('{:.2f}'.format(d) for d in r['ranges']),
+            [len(echos) for echos in r['echos'] or []], r['bme'], r['hall_events'],
+            r.get('cycle_time', 0), time.perf_counter() - t0))
+      time.sleep(10)
+    print(acq.stats())
+    acq.close()
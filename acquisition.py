@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: acquisition.py
+#
+# Description: Runs the sensor reads for one measurement cycle concurrently on
+#           a small thread pool. All of the CWS sensor drivers spend nearly
+#           all of their time waiting on I/O (I2C transfers, echo pulses,
+#           sleeps), so running them side by side brings the cycle time down
+#           to roughly the time of the slowest sensor instead of the sum of
+#           all of them.
+#
+#           Each sensor is added with a name, a function that returns its
+#           reading, and a timeout in seconds. acquire() starts every read,
+#           waits for each one up to its own timeout, and returns a dict of
+#           name -> reading. A sensor that timed out or raised an exception
+#           reads as None, and is counted in stats().
+#
+#           A read that timed out cannot be cancelled, and keeps its worker
+#           thread until it returns. Until then that sensor is skipped (and
+#           reads as None) so a stuck sensor never piles up threads.
+#
+#           With max_workers=0 the reads are run one after another in the
+#           calling thread and timeouts are not enforced. That is what the
+#           simulated hardware (sim_hw.py) wants, where the virtual clock
+#           cannot overlap sleeps anyway.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Inline mode (max_workers=0)
+#
+#-------------------------------------------------------------------------------
+
+import concurrent.futures
+import time
+
+class ACQUISITION:
+  def __init__(self, max_workers=8):
+    self.pool = None
+    if max_workers > 0:
+      self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                        thread_name_prefix='acq')
+    self.sensors = {}   # name -> (read function, timeout)
+    self.pending = {}   # name -> future of a read that timed out
+    self.counts = {}    # name -> {'reads', 'timeouts', 'errors', 'skipped'}
+    self.last_error = {}
+    self.last_cycle_time = 0.0
+
+  #-------------------------------------
+
+  def __del__(self):
+    if self.pool is not None:
+      self.pool.shutdown(wait=False)
+
+  #-------------------------------------
+
+  def add_sensor(self, name, read_fn, timeout):
+    self.sensors[name] = (read_fn, timeout)
+    self.counts[name] = {'reads': 0, 'timeouts': 0, 'errors': 0, 'skipped': 0}
+
+  #-------------------------------------
+
+  def acquire(self):
+    if self.pool is None:
+      return self.acquire_inline()
+
+    start = time.monotonic()
+
+    # start every read that is not still stuck from a previous cycle
+    futures = {}
+    for name, (read_fn, timeout) in self.sensors.items():
+      stuck = self.pending.get(name)
+      if stuck is not None and not stuck.done():
+        self.counts[name]['skipped'] += 1
+        continue
+      self.pending.pop(name, None)
+      futures[name] = self.pool.submit(read_fn)
+
+    # then collect them, each against its own deadline
+    readings = {name: None for name in self.sensors}
+    for name, future in futures.items():
+      deadline = start + self.sensors[name][1]
+      try:
+        readings[name] = future.result(timeout=max(deadline - time.monotonic(), 0))
+        self.counts[name]['reads'] += 1
+      except concurrent.futures.TimeoutError:
+        self.counts[name]['timeouts'] += 1
+        self.pending[name] = future
+      except Exception as e:
+        self.counts[name]['errors'] += 1
+        self.last_error[name] = repr(e)
+
+    self.last_cycle_time = time.monotonic() - start
+    return readings
+
+  #-------------------------------------
+
+  def acquire_inline(self):
+    start = time.monotonic()
+    readings = {name: None for name in self.sensors}
+    for name, (read_fn, timeout) in self.sensors.items():
+      try:
+        readings[name] = read_fn()
+        self.counts[name]['reads'] += 1
+      except Exception as e:
+        self.counts[name]['errors'] += 1
+        self.last_error[name] = repr(e)
+
+    self.last_cycle_time = time.monotonic() - start
+    return readings
+
+  #-------------------------------------
+
+  def stats(self):
+    return {name: dict(counts) for name, counts in self.counts.items()}
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  print('ACQUISITION class test example')
+
+  acq = ACQUISITION()
+  acq.add_sensor('fast', lambda: time.sleep(0.1) or 1, timeout=1)
+  acq.add_sensor('slow', lambda: time.sleep(0.5) or 2, timeout=1)
+  acq.add_sensor('stuck', lambda: time.sleep(3) or 3, timeout=1)
+  acq.add_sensor('broken', lambda: 1 / 0, timeout=1)
+
+  for ii in range(3):
+    readings = acq.acquire()
+    print('{}  ({:.2f} s)'.format(readings, acq.last_cycle_time))
+  print(acq.stats())
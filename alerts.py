@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: alerts.py
+#
+# Description: Alert rules for the CWS, checked against every status
+#           snapshot, and a notification queue that hands the alerts to
+#           local sinks without ever holding up the measurement loop.
+#
+#           ALERT_ENGINE.evaluate(status) runs each rule on the cws_main.py
+#           status dict. The rules keep their own small state, so each check
+#           is cheap and nothing is read back from the history:
+#
+#             * THRESHOLD_RULE - a status value at or past a limit, e.g. the
+#               water volume low, or the temperature too hot or too cold.
+#             * RATE_RULE      - a status value rising or falling faster than
+#               a limit (per hour) over a time window, e.g. a leak. The
+#               values go through a median of 3 first, so one bad echo cannot
+#               make a rate.
+#             * EMPTY_RULE     - the predicted empty time (the consumption
+#               estimates) within so many hours. It waits for the estimator
+#               to have a rate at all, and only raises when the empty time
+#               band is narrow, no wider than max_band times the time left,
+#               so a noisy estimate just after a start cannot raise it.
+#
+#           Every rule has:
+#             * hysteresis - an alert is raised at the limit, and only
+#               cleared once the value is back past the limit by the
+#               hysteresis, so a value sitting at the limit does not flap.
+#             * confirm - the number of samples in a row the value must be
+#               past the limit (or back) before the state changes.
+#             * cooldown - the least time between two raised notifications
+#               of the rule. An alert raised again within it is held back,
+#               and only notified if it is still active when the cooldown is
+#               over. One that clears in the meantime is counted as
+#               suppressed, and nothing is sent for it at all.
+#             * repeat - if set, a reminder is sent this often while the
+#               alert stays active.
+#
+#           Times are the status timestamps, so the rules run the same on
+#           the simulated clock.
+#
+#           NOTIFIER gives each sink its own bounded queue and worker thread.
+#           post() never blocks: when a sink's queue is full (the sink is
+#           slow or stuck) the oldest notification in it is dropped and
+#           counted. A sink is any object with a send(event) method; the
+#           ones here are:
+#
+#             * LOG_SINK    - a line in the LOGGER log file
+#             * SOCKET_SINK - a JSON datagram to a Unix socket, for a local
+#               notifier (mail, push, buzzer) to pick up
+#             * LED_SINK    - the status LED blink pattern, by the most severe
+#               active alert
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 EMPTY_RULE waits for a converged estimate
+#
+#-------------------------------------------------------------------------------
+
+import collections
+import json
+import math
+import queue
+import socket
+import threading
+import time
+
+SEVERITIES = ('info', 'warning', 'critical')   # least to most severe
+
+#-------------------------------------------------------------------------------
+
+def get_value(status, key):
+  # a status value by a dotted key, e.g. 'bme.temp'. None if it is missing
+  # or not a number.
+  value = status
+  for part in key.split('.'):
+    if not isinstance(value, dict) or value.get(part) is None:
+      return None
+    value = value[part]
+  if not isinstance(value, (int, float)) or math.isnan(value):
+    return None
+  return value
+
+#-------------------------------------------------------------------------------
+
+class ALERT_RULE:
+  # state and notification logic shared by all rules. A subclass gives
+  # measure(), the value the rule looks at, and the tripped() / cleared()
+  # tests.
+
+  def __init__(self, name, message, severity='warning', confirm=1, cooldown=3600,
+               repeat=None):
+    if severity not in SEVERITIES:
+      raise ValueError('severity must be one of {}'.format(SEVERITIES))
+    self.name = name
+    self.message = message     # format string, {value} is the measured value,
+                               # a cleared alert says 'back to normal'
+    self.severity = severity
+    self.confirm = confirm
+    self.cooldown = cooldown
+    self.repeat = repeat
+
+    self.active = False
+    self.notified = False      # the current activation has been notified
+    self.since = None          # when the current activation started
+    self.value = None          # the last measured value
+    self.streak = 0            # samples in a row towards a state change
+    self.last_notify = None
+
+    self.raises = 0
+    self.notifications = 0
+    self.suppressed = 0
+
+  #-------------------------------------
+
+  def measure(self, now, status):
+    raise NotImplementedError
+
+  def tripped(self, value):
+    raise NotImplementedError
+
+  def cleared(self, value):
+    raise NotImplementedError
+
+  #-------------------------------------
+
+  def confirmed(self, condition):
+    # True once condition has held for confirm samples in a row
+    self.streak = self.streak + 1 if condition else 0
+    if self.streak >= self.confirm:
+      self.streak = 0
+      return True
+    return False
+
+  #-------------------------------------
+
+  def evaluate(self, now, status):
+    # returns a notification event, or None
+    value = self.measure(now, status)
+    if value is None:
+      return None
+    self.value = value
+
+    if not self.active:
+      if not self.confirmed(self.tripped(value)):
+        return None
+      self.active = True
+      self.notified = False
+      self.since = now
+      self.raises += 1
+    elif self.confirmed(self.cleared(value)):
+      self.active = False
+      if not self.notified:
+        self.suppressed += 1
+        return None
+      return self.event(now, 'cleared')
+
+    if not self.notified:
+      if self.last_notify is not None and now - self.last_notify < self.cooldown:
+        return None
+      self.notified = True
+      return self.event(now, 'raised')
+    if self.repeat is not None and now - self.last_notify >= self.repeat:
+      return self.event(now, 'reminder')
+    return None
+
+  #-------------------------------------
+
+  def event(self, now, state):
+    if state != 'cleared':
+      self.last_notify = now
+    self.notifications += 1
+    return {
+      'time'     : now,
+      'rule'     : self.name,
+      'severity' : self.severity,
+      'state'    : state,
+      'since'    : self.since,
+      'value'    : self.value,
+      'message'  : 'back to normal' if state == 'cleared' else self.message.format(value=self.value),
+    }
+
+  #-------------------------------------
+
+  def get_state(self):
+    return {'active': self.active, 'notified': self.notified, 'since': self.since,
+            'last_notify': self.last_notify}
+
+  def set_state(self, state):
+    self.active = state['active']
+    self.notified = state['notified']
+    self.since = state['since']
+    self.last_notify = state['last_notify']
+
+#-------------------------------------------------------------------------------
+
+class THRESHOLD_RULE(ALERT_RULE):
+  def __init__(self, name, key, limit, hysteresis, above=False, message=None, **kwargs):
+    # key is a status value (get_value()). Raised when it is at or below
+    # limit (at or above with above=True).
+    super().__init__(name, message or '{} {{value:.1f}}'.format(key), **kwargs)
+    self.key = key
+    self.limit = limit
+    self.hysteresis = hysteresis
+    self.sign = 1 if above else -1
+
+  #-------------------------------------
+
+  def measure(self, now, status):
+    return get_value(status, self.key)
+
+  def tripped(self, value):
+    return self.sign * (value - self.limit) >= 0
+
+  def cleared(self, value):
+    return self.sign * (value - self.limit) <= -self.hysteresis
+
+#-------------------------------------------------------------------------------
+
+class RATE_RULE(ALERT_RULE):
+  def __init__(self, name, key, limit_per_hour, hysteresis, window_seconds=1800,
+               rising=False, message=None, **kwargs):
+    # raised when key falls (rises with rising=True) by limit_per_hour or
+    # more per hour over window_seconds
+    super().__init__(name, message or '{} {{value:.2f}}/h'.format(key), **kwargs)
+    self.key = key
+    self.limit = limit_per_hour
+    self.hysteresis = hysteresis
+    self.window = window_seconds
+    self.sign = 1 if rising else -1
+
+    self.recent = collections.deque(maxlen=3)   # raw values, for the median
+    self.points = collections.deque()           # (time, filtered value)
+
+  #-------------------------------------
+
+  def measure(self, now, status):
+    # the rate (per hour, positive in the rule's direction) over the window,
+    # None until at least half the window has been seen
+    value = get_value(status, self.key)
+    if value is None:
+      return None
+    self.recent.append(value)
+    if len(self.recent) < self.recent.maxlen:
+      return None
+    self.points.append((now, sorted(self.recent)[1]))
+    while self.points[0][0] < now - self.window:
+      self.points.popleft()
+
+    t0, v0 = self.points[0]
+    if now - t0 < self.window / 2:
+      return None
+    return self.sign * (self.points[-1][1] - v0) / (now - t0) * 3600
+
+  def tripped(self, value):
+    return value >= self.limit
+
+  def cleared(self, value):
+    return value <= self.limit - self.hysteresis
+
+#-------------------------------------------------------------------------------
+
+class EMPTY_RULE(ALERT_RULE):
+  def __init__(self, name, hours, hysteresis_hours, max_band=1.0, message=None, **kwargs):
+    # raised when status['estimates'] predicts empty within hours, with an
+    # empty time band (earliest to latest) of at most max_band times the
+    # hours left
+    super().__init__(name, message or 'empty in {value:.1f} h', **kwargs)
+    self.hours = hours
+    self.hysteresis = hysteresis_hours
+    self.max_band = max_band
+    self.certain = False       # the last estimate's band was narrow enough
+
+  #-------------------------------------
+
+  def measure(self, now, status):
+    # hours until empty, inf if it is not being drunk (or was just
+    # refilled), None until the estimator has a rate
+    estimates = status.get('estimates')
+    if estimates is None or estimates.get('rate') is None:
+      return None
+    if estimates['empty_time'] is None:
+      return math.inf
+    hours = (estimates['empty_time'] - now) / 3600
+    if estimates['empty_late'] is None:
+      band = math.inf
+    else:
+      band = (estimates['empty_late'] - estimates['empty_early']) / 3600
+    self.certain = band <= self.max_band * max(hours, 1)
+    return hours
+
+  def tripped(self, value):
+    return value <= self.hours and self.certain
+
+  def cleared(self, value):
+    return value >= self.hours + self.hysteresis
+
+#-------------------------------------------------------------------------------
+
+class ALERT_ENGINE:
+  def __init__(self, rules, notifier=None):
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+      raise ValueError('alert rule names must be unique')
+    self.rules = list(rules)
+    self.notifier = notifier
+    self.evaluations = 0
+
+  #-------------------------------------
+
+  def evaluate(self, status):
+    # check every rule against one status snapshot, post and return the
+    # notifications
+    now = status['timestamp']
+    events = []
+    for rule in self.rules:
+      event = rule.evaluate(now, status)
+      if event is not None:
+        events.append(event)
+        if self.notifier is not None:
+          self.notifier.post(event)
+    self.evaluations += 1
+    return events
+
+  #-------------------------------------
+
+  def active(self):
+    # the active alerts, most severe first
+    alerts = [{'rule': r.name, 'severity': r.severity, 'since': r.since, 'value': r.value}
+              for r in self.rules if r.active]
+    alerts.sort(key=lambda a: -SEVERITIES.index(a['severity']))
+    return alerts
+
+  #-------------------------------------
+
+  def get_state(self):
+    # for a checkpoint, so a restart does not notify active alerts again
+    return {rule.name: rule.get_state() for rule in self.rules}
+
+  def set_state(self, state):
+    for rule in self.rules:
+      if rule.name in state:
+        rule.set_state(state[rule.name])
+
+  #-------------------------------------
+
+  def stats(self):
+    stats = {'evaluations': self.evaluations, 'active': len(self.active())}
+    for rule in self.rules:
+      stats[rule.name] = {'raises': rule.raises, 'notifications': rule.notifications,
+                          'suppressed': rule.suppressed}
+    if self.notifier is not None:
+      stats['sinks'] = self.notifier.stats()
+    return stats
+
+#-------------------------------------------------------------------------------
+
+class NOTIFIER:
+  def __init__(self, sinks, queue_size=32):
+    # sinks is a dict of name -> sink
+    self.workers = {}
+    for name, sink in sinks.items():
+      worker = {
+        'sink'    : sink,
+        'queue'   : queue.Queue(queue_size),
+        'sent'    : 0,
+        'dropped' : 0,
+        'errors'  : 0,
+        'last_error' : None,
+      }
+      worker['thread'] = threading.Thread(target=self.worker_loop, args=(worker,),
+                                          name='alerts-' + name, daemon=True)
+      worker['thread'].start()
+      self.workers[name] = worker
+
+  #-------------------------------------
+
+  def put(self, worker, item):
+    # never blocks, a full queue loses its oldest item
+    while True:
+      try:
+        worker['queue'].put_nowait(item)
+        return
+      except queue.Full:
+        try:
+          worker['queue'].get_nowait()
+          worker['dropped'] += 1
+        except queue.Empty:
+          pass
+
+  #-------------------------------------
+
+  def post(self, event):
+    for worker in self.workers.values():
+      self.put(worker, event)
+
+  #-------------------------------------
+
+  def worker_loop(self, worker):
+    while True:
+      event = worker['queue'].get()
+      if event is None:
+        break
+      try:
+        worker['sink'].send(event)
+        worker['sent'] += 1
+      except Exception as e:
+        # a failing sink only loses its own notifications
+        worker['errors'] += 1
+        worker['last_error'] = repr(e)
+
+  #-------------------------------------
+
+  def close(self, timeout=2):
+    # send what is queued, waiting at most timeout seconds per sink
+    for worker in self.workers.values():
+      self.put(worker, None)
+    for worker in self.workers.values():
+      worker['thread'].join(timeout)
+      # a sink still stuck in send() is left to its daemon thread
+      close = getattr(worker['sink'], 'close', None)
+      if close is not None and not worker['thread'].is_alive():
+        close()
+
+  #-------------------------------------
+
+  def stats(self):
+    return {name: {k: w[k] for k in ('sent', 'dropped', 'errors', 'last_error')}
+            for name, w in self.workers.items()}
+
+#-------------------------------------------------------------------------------
+
+def format_event(event):
+  return '{} {} {}: {}'.format(event['severity'].upper(), event['rule'], event['state'],
+                               event['message'])
+
+#-------------------------------------------------------------------------------
+
+class LOG_SINK:
+  def __init__(self, logger):
+    self.logger = logger   # a logger.LOGGER
+
+  def send(self, event):
+    # the log line time is when it was written, the alert's own time goes
+    # in the message
+    self.logger.write('ALERT,{},{}'.format(
+                      time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event['time'])),
+                      format_event(event)))
+
+#-------------------------------------------------------------------------------
+
+class SOCKET_SINK:
+  def __init__(self, path, timeout=1.0):
+    # path is a Unix datagram socket some other program listens on. If
+    # nothing is listening the notification is lost (a sink error).
+    self.path = path
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.sock.settimeout(timeout)
+
+  def send(self, event):
+    self.sock.sendto(json.dumps(event).encode(), self.path)
+
+  def close(self):
+    self.sock.close()
+
+#-------------------------------------------------------------------------------
+
+class LED_SINK:
+  # (on time, period) blink patterns by the most severe active alert
+  PATTERNS = {
+    None       : (0.05, 2.0),    # no alerts, the heartbeat
+    'info'     : (0.05, 2.0),
+    'warning'  : (0.25, 1.0),
+    'critical' : (0.5, 0.5),
+  }
+
+  def __init__(self, led, patterns=PATTERNS):
+    self.led = led
+    self.patterns = patterns
+    self.active = {}     # rule -> severity
+    self.pattern = None
+
+  def send(self, event):
+    active = dict(self.active)
+    if event['state'] == 'cleared':
+      active.pop(event['rule'], None)
+    else:
+      active[event['rule']] = event['severity']
+    self.show(active)
+
+  def show(self, active):
+    # start blinking for active, a dict of rule -> severity, e.g. the alerts
+    # restored at start up
+    self.active = active
+    worst = max(active.values(), key=SEVERITIES.index, default=None)
+    if self.patterns[worst] != self.pattern:
+      self.pattern = self.patterns[worst]
+      self.led.blink(*self.pattern)
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  print('ALERT_ENGINE class test example')
+
+  class PRINT_SINK:
+    def send(self, event):
+      print('  -> ' + format_event(event))
+
+  class SLOW_SINK:
+    def send(self, event):
+      time.sleep(1)
+
+  rules = [
+    THRESHOLD_RULE('water_low', 'volume', 4.0, 2.0, severity='critical', confirm=3,
+                   message='water low, {value:.1f} L left'),
+    THRESHOLD_RULE('temp_hot', 'bme.temp', 35.0, 3.0, above=True, cooldown=7200,
+                   message='hot, {value:.1f} C'),
+    RATE_RULE('leak', 'volume', 1.5, 0.5, message='level falling {value:.1f} L/h'),
+  ]
+  notifier = NOTIFIER({'print': PRINT_SINK(), 'slow': SLOW_SINK()}, queue_size=8)
+  engine = ALERT_ENGINE(rules, notifier)
+
+  # a leak from 12:00, a bad echo at 13:00, and a hot afternoon with the
+  # temperature going back and forth around 35 C
+  volume = 20.0
+  start = time.perf_counter()
+  for ii in range(0, 8 * 3600, 60):
+    hour = ii / 3600
+    volume -= (2.0 if 2 <= hour < 5 else 0.1) / 60
+    temp = 33 + 3 * math.sin(hour * 4)
+    reading = 0.01 if ii == 3 * 3600 else volume
+    engine.evaluate({'timestamp': ii, 'volume': reading, 'bme': {'temp': temp}})
+  print('evaluated {} snapshots in {:.1f} ms'.format(engine.evaluations,
+        (time.perf_counter() - start) * 1000))
+  print('active: {}'.format(engine.active()))
+  notifier.close(timeout=0.1)
+  print(engine.stats())
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: analytics.py
+#
+# Description: Streaming water analytics for the CWS. Everything here is
+#           updated in O(1) per reading with O(1) state, so nothing ever has
+#           to rescan the reading history.
+#
+#           CONSUMPTION_ESTIMATOR keeps exponentially weighted estimates of
+#           the water consumption rate over several horizons (by default 1 h,
+#           24 h and 7 d). The readings come at irregular intervals (missed
+#           echoes, restarts) so each update weights the new rate by
+#               alpha = 1 - exp(-dt / tau)
+#           which makes the estimate depend on elapsed time, not on the
+#           number of readings. The estimates start from zero and are bias
+#           corrected until a full horizon of data has been seen.
+#
+#           Just after a start the few readings seen are mostly level noise,
+#           and a rate made from them can swing by hundreds of liters a day.
+#           So a horizon's rate is None until min_fraction of the horizon
+#           has been covered (its weight 1 - exp(-covered / tau) has
+#           reached 1 - exp(-min_fraction)).
+#
+#           The empty time prediction uses the 24 h rate, which weights the
+#           last day more heavily than the days before it. Its confidence
+#           band allows for two things:
+#             * level noise - a rate over a span of data can be off by the
+#               noise at both of its ends, sqrt(2) * noise_liters / span,
+#               which is large while the span is short. rate_error() is
+#               BAND_SIGMAS of that, for the horizon's span (the data
+#               covered, up to tau).
+#             * drift - the spread between the 24 h and 7 d rates, once the
+#               7 d rate is known.
+#           The earliest empty time uses the highest rate plus the error,
+#           the latest the lowest minus it ('never' when that is not
+#           positive). The 1 h rate follows the chickens' day (nothing at
+#           night) too closely to bound a prediction days out, so it is only
+#           reported.
+#
+#           A change in volume of more than step_liters between readings, up
+#           (a refill) or down (a bad level reading, the chickens cannot
+#           drink that fast), is not counted as consumption. The estimate
+#           just carries on from the new level. Ignoring steps both ways
+#           keeps a bad reading and the recovery after it from biasing the
+#           rate.
+#
+#           Rates are reported in liters per day.
+#
+#           REFILL_DETECTOR finds refills in the volume stream as they
+#           happen. The readings go through a short median filter, which
+#           removes single bad echoes, and the filtered level is compared
+#           with its minimum over the last few minutes. A rise of more than
+#           start_liters starts a refill (dated from that minimum). The refill
+#           ends once the level has stopped rising for settle_seconds. Each
+#           refill of at least min_liters is written to a REFILL_TABLE, and
+#           update() returns it. The filter and sliding minimum are bounded
+#           by their windows, so memory use is constant.
+#
+#           REFILL_TABLE is an append-only file of fixed size (start, end,
+#           liters) records in time order. Record N is at a fixed offset, and
+#           time range queries bisect the file, so it never has to be loaded
+#           into memory.
+#
+#           get_state() / set_state() save and restore the whole state of the
+#           estimator and the detector as JSON-able dicts (for checkpoint.py),
+#           so a restart carries on from where it stopped. A refill found
+#           again while the readings after a checkpoint are replayed is not
+#           written to the table a second time.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Refill detection and refill table
+#          20261018 get_state() / set_state() for checkpoints
+#          20261018 No rate before min_fraction of a horizon, noise band
+#
+#-------------------------------------------------------------------------------
+
+import collections
+import math
+import os
+import struct
+
+SECONDS_PER_DAY = 86400
+
+DEFAULT_HORIZONS = {'1h': 3600, '24h': 86400, '7d': 7 * 86400}
+BAND_SIGMAS = 3      # width of the empty time band, in level noise errors
+
+#-------------------------------------------------------------------------------
+
+class CONSUMPTION_ESTIMATOR:
+  def __init__(self, horizons=DEFAULT_HORIZONS, predict_horizon='24h',
+               band_horizons=('24h', '7d'), step_liters=1.0, noise_liters=0.1,
+               min_fraction=0.25):
+    if predict_horizon not in horizons:
+      raise ValueError('predict_horizon {} is not one of the horizons'.format(predict_horizon))
+    for name in band_horizons:
+      if name not in horizons:
+        raise ValueError('band horizon {} is not one of the horizons'.format(name))
+
+    self.horizons = dict(horizons)   # name -> tau in seconds
+    self.predict_horizon = predict_horizon
+    self.band_horizons = tuple(band_horizons)
+    self.step_liters = step_liters
+    self.noise_liters = noise_liters     # standard deviation of a volume reading
+    self.min_weight = 1 - math.exp(-min_fraction)
+    self.reset()
+
+  #-------------------------------------
+
+  def reset(self):
+    # forget everything, e.g. after the buckets were replaced
+    self.last_time = None
+    self.last_volume = None
+    self.ewma = {name: 0.0 for name in self.horizons}     # liters per second
+    self.weight = {name: 0.0 for name in self.horizons}   # for bias correction
+    self.updates = 0
+
+  #-------------------------------------
+
+  def update(self, timestamp, volume):
+    # add one reading. Missing (None / NaN) volumes are skipped.
+    if volume is None or math.isnan(volume):
+      return
+    if self.last_time is None:
+      self.last_time = timestamp
+      self.last_volume = volume
+      return
+
+    dt = timestamp - self.last_time
+    if dt <= 0:
+      return
+
+    if abs(volume - self.last_volume) > self.step_liters:
+      self.last_time = timestamp
+      self.last_volume = volume
+      return
+
+    rate = (self.last_volume - volume) / dt
+    for name, tau in self.horizons.items():
+      alpha = 1 - math.exp(-dt / tau)
+      self.ewma[name] += alpha * (rate - self.ewma[name])
+      self.weight[name] += alpha * (1 - self.weight[name])
+
+    self.last_time = timestamp
+    self.last_volume = volume
+    self.updates += 1
+
+  #-------------------------------------
+
+  def rebase(self):
+    # forget the last reading but keep the rates, so the next reading
+    # starts a new level (used while the buckets are being refilled)
+    self.last_time = None
+    self.last_volume = None
+
+  #-------------------------------------
+
+  def rate(self, name):
+    # consumption rate in liters per day over one horizon, None until
+    # min_fraction of the horizon has been seen
+    if self.weight[name] < self.min_weight:
+      return None
+    return self.ewma[name] / self.weight[name] * SECONDS_PER_DAY
+
+  #-------------------------------------
+
+  def rate_error(self, name):
+    # liters per day the rate of one horizon can be off by from the level
+    # noise alone, None while there is no rate
+    if self.weight[name] < self.min_weight:
+      return None
+    tau = self.horizons[name]
+    if self.weight[name] < 1:
+      span = min(-tau * math.log(1 - self.weight[name]), tau)
+    else:
+      span = tau
+    return BAND_SIGMAS * math.sqrt(2) * self.noise_liters / span * SECONDS_PER_DAY
+
+  #-------------------------------------
+
+  def empty_time(self, rate):
+    # timestamp when the last volume runs out at rate (liters per day), or
+    # None if it never does
+    if rate is None or rate <= 0 or self.last_volume is None:
+      return None
+    return self.last_time + max(self.last_volume, 0) / rate * SECONDS_PER_DAY
+
+  #-------------------------------------
+
+  def estimate(self):
+    rates = {name: self.rate(name) for name in self.horizons}
+    rate = rates[self.predict_horizon]
+    error = self.rate_error(self.predict_horizon)
+
+    high = low = None
+    if rate is not None:
+      band = [rate] + [rates[name] for name in self.band_horizons if rates[name] is not None]
+      high = max(band) + error
+      low = min(band) - error
+
+    return {
+      'time'        : self.last_time,
+      'volume'      : self.last_volume,
+      'rates'       : rates,
+      'rate'        : rate,             # None until it has enough data
+      'rate_error'  : error,
+      'empty_time'  : self.empty_time(rate),
+      'empty_early' : self.empty_time(high),
+      'empty_late'  : self.empty_time(low),   # None if the low rate is <= 0
+    }
+
+  #-------------------------------------
+
+  def get_state(self):
+    return {
+      'last_time'   : self.last_time,
+      'last_volume' : self.last_volume,
+      'ewma'        : dict(self.ewma),
+      'weight'      : dict(self.weight),
+      'updates'     : self.updates,
+    }
+
+  #-------------------------------------
+
+  def set_state(self, state):
+    # horizons that are not in state (added since it was saved) start from
+    # zero, ones that are no longer used are dropped
+    self.reset()
+    self.last_time = state['last_time']
+    self.last_volume = state['last_volume']
+    for name in self.horizons:
+      if name in state['ewma'] and name in state['weight']:
+        self.ewma[name] = state['ewma'][name]
+        self.weight[name] = state['weight'][name]
+    self.updates = state['updates']
+
+  #-------------------------------------
+
+  def prime(self, store, now, span=7 * SECONDS_PER_DAY):
+    # warm up from a TS_STORE after a restart. This reads the history once,
+    # at startup only. Each stored run gives its start and end time with the
+    # run's volume.
+    for rec in store.query(now - span, now, expand=False):
+      self.update(rec['time'], rec['volume'])
+      self.update(rec['time_end'], rec['volume'])
+
+#-------------------------------------------------------------------------------
+
+class REFILL_DETECTOR:
+  def __init__(self, table=None, window=5, start_liters=0.5, min_liters=1.0,
+               baseline_seconds=300, settle_liters=0.2, settle_seconds=60,
+               max_refill_seconds=1800):
+    self.table = table
+    self.start_liters = start_liters
+    self.min_liters = min_liters
+    self.baseline_seconds = baseline_seconds
+    self.settle_liters = settle_liters
+    self.settle_seconds = settle_seconds
+    self.max_refill_seconds = max_refill_seconds
+
+    self.recent = collections.deque(maxlen=window)  # raw volumes, for the median
+    self.lows = collections.deque()  # (time, level) increasing, for the sliding minimum
+    self.refilling = False
+    self.start_time = None
+    self.base = None        # level before the refill
+    self.rise_time = None   # last time the level rose by settle_liters
+    self.rise_level = None
+
+    self.refill_count = 0
+    self.last_refill = None
+    if table is not None and len(table) > 0:
+      self.last_refill = table.read(len(table) - 1)
+
+  #-------------------------------------
+
+  def update(self, timestamp, volume):
+    # add one reading. Returns the refill (a dict of start, end, liters)
+    # when one has just ended, otherwise None.
+    if volume is None or math.isnan(volume):
+      return None
+    self.recent.append(volume)
+    level = sorted(self.recent)[len(self.recent) // 2]
+
+    if not self.refilling:
+      # sliding minimum of the filtered level
+      while len(self.lows) > 0 and self.lows[-1][1] >= level:
+        self.lows.pop()
+      self.lows.append((timestamp, level))
+      while self.lows[0][0] < timestamp - self.baseline_seconds:
+        self.lows.popleft()
+
+      base_time, base = self.lows[0]
+      if level - base > self.start_liters:
+        self.refilling = True
+        self.start_time = base_time
+        self.base = base
+        self.rise_time = timestamp
+        self.rise_level = level
+      return None
+
+    if level > self.rise_level + self.settle_liters:
+      self.rise_time = timestamp
+      self.rise_level = level
+    elif timestamp - self.rise_time >= self.settle_seconds or \
+         timestamp - self.start_time >= self.max_refill_seconds:
+      return self.end_refill(timestamp, level)
+    return None
+
+  #-------------------------------------
+
+  def end_refill(self, timestamp, level):
+    self.refilling = False
+    self.lows.clear()
+    self.lows.append((timestamp, level))
+
+    liters = level - self.base
+    if liters < self.min_liters:
+      return None
+
+    refill = {'start': self.start_time, 'end': self.rise_time, 'liters': liters}
+    if self.last_refill is not None and refill['start'] <= self.last_refill['end']:
+      # already recorded, the readings it was found in are being replayed
+      return None
+    if self.table is not None:
+      self.table.append(refill['start'], refill['end'], liters)
+    self.refill_count += 1
+    self.last_refill = refill
+    return refill
+
+  #-------------------------------------
+
+  def get_state(self):
+    return {
+      'recent'       : list(self.recent),
+      'lows'         : [list(low) for low in self.lows],
+      'refilling'    : self.refilling,
+      'start_time'   : self.start_time,
+      'base'         : self.base,
+      'rise_time'    : self.rise_time,
+      'rise_level'   : self.rise_level,
+      'refill_count' : self.refill_count,
+    }
+
+  #-------------------------------------
+
+  def set_state(self, state):
+    # last_refill always comes from the table
+    self.recent.clear()
+    self.recent.extend(state['recent'])
+    self.lows = collections.deque(tuple(low) for low in state['lows'])
+    self.refilling = state['refilling']
+    self.start_time = state['start_time']
+    self.base = state['base']
+    self.rise_time = state['rise_time']
+    self.rise_level = state['rise_level']
+    self.refill_count = state['refill_count']
+
+#-------------------------------------------------------------------------------
+
+class REFILL_TABLE:
+  RECORD = struct.Struct('<ddf')       # start, end, liters
+  HEADER = struct.Struct('<4sBxH')     # magic, version, record size
+  MAGIC = b'CWSR'
+  VERSION = 1
+
+  def __init__(self, filename):
+    self.filename = filename
+    if not os.path.isfile(filename) or os.path.getsize(filename) < self.HEADER.size:
+      with open(filename, 'wb') as f:
+        f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size))
+    with open(filename, 'rb+') as f:
+      magic, version, size = self.HEADER.unpack(f.read(self.HEADER.size))
+      if magic != self.MAGIC or version != self.VERSION or size != self.RECORD.size:
+        raise ValueError('{} is not a version {} refill table'.format(filename, self.VERSION))
+      # drop a record torn by a crash in the middle of a write
+      self.count = (os.path.getsize(filename) - self.HEADER.size) // self.RECORD.size
+      f.truncate(self.HEADER.size + self.count * self.RECORD.size)
+
+  #-------------------------------------
+
+  def __len__(self):
+    return self.count
+
+  #-------------------------------------
+
+  def append(self, start, end, liters):
+    with open(self.filename, 'ab') as f:
+      f.write(self.RECORD.pack(start, end, liters))
+      f.flush()
+      os.fsync(f.fileno())
+    self.count += 1
+
+  #-------------------------------------
+
+  def read(self, index, f=None):
+    if index < 0 or index >= self.count:
+      raise IndexError('refill {} out of range'.format(index))
+    if f is None:
+      with open(self.filename, 'rb') as f:
+        return self.read(index, f)
+    f.seek(self.HEADER.size + index * self.RECORD.size)
+    start, end, liters = self.RECORD.unpack(f.read(self.RECORD.size))
+    return {'start': start, 'end': end, 'liters': liters}
+
+  #-------------------------------------
+
+  def query(self, t_start, t_end):
+    # refills that started in t_start <= start <= t_end, oldest first
+    with open(self.filename, 'rb') as f:
+      lo, hi = 0, self.count
+      while lo < hi:
+        mid = (lo + hi) // 2
+        if self.read(mid, f)['start'] < t_start:
+          lo = mid + 1
+        else:
+          hi = mid
+
+      refills = []
+      for ii in range(lo, self.count):
+        refill = self.read(ii, f)
+        if refill['start'] > t_end:
+          break
+        refills.append(refill)
+    return refills
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  import random
+
+  print('CONSUMPTION_ESTIMATOR class test example')
+
+  # 3 L/day, drunk only between 6:00 and 20:00, noisy level readings
+  est = CONSUMPTION_ESTIMATOR()
+  volume = 30.0
+  for ii in range(0, 10 * SECONDS_PER_DAY, 10):
+    hour = (ii % SECONDS_PER_DAY) / 3600
+    if 6 <= hour < 20:
+      volume -= 3.0 / (14 * 3600) * 10
+    if volume < 2:
+      volume = 30.0
+    est.update(ii, volume + random.gauss(0, 0.05))
+    if ii in (120, 3600, 6 * 3600, SECONDS_PER_DAY, 3 * SECONDS_PER_DAY):
+      # no rate until there is enough data, then a band that narrows
+      e = est.estimate()
+      print('{:>7} s: 24 h rate {}'.format(ii, 'none yet' if e['rate'] is None else
+            '{:.2f} +/- {:.2f} L/day'.format(e['rate'], e['rate_error'])))
+
+  e = est.estimate()
+  print('rates (L/day):', {k: round(v, 2) for k, v in e['rates'].items()})
+  print('volume {:.1f} L, empty in {:.1f} days ({:.1f} - {})'.format(
+        e['volume'], (e['empty_time'] - e['time']) / SECONDS_PER_DAY,
+        (e['empty_early'] - e['time']) / SECONDS_PER_DAY,
+        'never' if e['empty_late'] is None else
+        '{:.1f}'.format((e['empty_late'] - e['time']) / SECONDS_PER_DAY)))
+
+  print('\nREFILL_DETECTOR class test example')
+
+  # a slow refill by hand, with an occasional bad echo
+  filename = 'test_refills.dat'
+  if os.path.isfile(filename):
+    os.remove(filename)
+  detector = REFILL_DETECTOR(REFILL_TABLE(filename))
+  volume = 3.0
+  for ii in range(0, 3600, 10):
+    if 1800 <= ii < 1920:
+      volume += 15.0 / 12       # 15 L in two minutes
+    else:
+      volume -= 0.002
+    reading = volume + random.gauss(0, 0.05)
+    if random.random() < 0.02:
+      reading = 0.01            # bad echo
+    refill = detector.update(ii, reading)
+    if refill is not None:
+      print('refill {:.0f} - {:.0f} s, {:.1f} L'.format(refill['start'], refill['end'], refill['liters']))
+  print(REFILL_TABLE(filename).query(0, 3600))
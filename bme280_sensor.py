@@ -15,24 +15,52 @@
 #           almost always 1 (especially if it is a Raspberry Pi talking to the 
 #           device.
 #
+#           The I2C bus is the shared, locked handle from i2c_bus, so the
+#           BME280 can be read from any thread alongside the other I2C
+#           devices. The calibration table is prefetched in two block reads.
+#
+#           The calibration is only read when the first sample is taken, so
+#           creating the wrapper costs no I/O. With cal_file set, the raw
+#           calibration registers are kept in that file (JSON) and read from
+#           it on later starts instead of from the chip. They are fixed at
+#           the factory, but each chip has its own, so delete the file when
+#           the sensor is replaced.
+#
+#           read() goes through a READ_CACHE with a ttl (default 0, always
+#           sample). str() formats the last reading from the cache and never
+#           samples the sensor.
+#
 # Author: Greg Kraus
 # History: 20230512 Initial creation
+#          20261018 Use the shared I2C bus, honor addr and port
+#          20261018 Read cache, str() no longer samples
+#          20261018 format_reading() for readings from elsewhere
+#          20261018 Lazy calibration, calibration cache file
 #
 #-------------------------------------------------------------------------------
 
-import smbus2
+import json
+import os
+
 import bme280
+import i2c_bus
+from read_cache import READ_CACHE
+
+# calibration registers - (first register, number of registers)
+BME280_CALIBRATION = [(0x88, 26), (0xE1, 7)]
 
 class BME280_WRAPPER:
-  def __init__(self, addr=0x76, port=1):
-    self.port = 1
-    self.address = 0x76
+  def __init__(self, addr=0x76, port=1, ttl=0, cal_file=None):
+    self.port = port
+    self.address = addr
+    self.cal_file = cal_file
+    self.cache = READ_CACHE(ttl)
   
-    #open up a connection the I2C bus
-    self.bus = smbus2.SMBus(port)
+    # get the shared connection to the I2C bus
+    self.bus = i2c_bus.get_bus(port)
 
-    # get calibration params from the device (makes for more accurate measurements)
-    self.calibration_params = bme280.load_calibration_params(self.bus, self.address)
+    self.calibration_params = None   # loaded by the first sample()
+    self.calibration_source = None   # 'file' or 'chip'
 
   #-------------------------------------
   
@@ -42,23 +70,91 @@ class BME280_WRAPPER:
   #-------------------------------------
     
   def __str__(self):
-    data = self.read()
-    ss  = "Temp: {:.1f} ".format(data['temp']) + u'\xb0C' + '   '
-    ss += "Baro: {:.0f} ".format(data['pressure']) + 'hPa   '
-    ss += "Humidity: {:.1f} ".format(data['humidity']) + '%rH'
-    return ss
+    return format_reading(self.cache.last())
 
   #-------------------------------------
 
   def read(self):
+    data = self.cache.get()
+    if data is None:
+      data = self.sample()
+      self.cache.put(data)
+    return data
+
+  #-------------------------------------
+
+  def load_calibration(self):
+    # get calibration params from the cache file, or else from the device
+    # (makes for more accurate measurements)
+    registers = self.read_cal_file()
+    if registers is not None:
+      self.calibration_source = 'file'
+      calibration_regs = i2c_bus.PREFETCHED_BUS(self.bus, self.address, registers)
+      self.calibration_params = bme280.load_calibration_params(calibration_regs, self.address)
+      return
+
+    with self.bus.transaction():
+      calibration_regs = self.bus.prefetch(self.address, BME280_CALIBRATION)
+      self.calibration_params = bme280.load_calibration_params(calibration_regs, self.address)
+    self.calibration_source = 'chip'
+    self.write_cal_file(calibration_regs.registers)
+
+  #-------------------------------------
+
+  def read_cal_file(self):
+    # the cached calibration registers of this device, or None
+    if self.cal_file is None:
+      return None
+    try:
+      with open(self.cal_file) as f:
+        data = json.load(f)
+      if data['address'] != self.address or data['port'] != self.port:
+        return None
+      registers = {int(reg): value for reg, value in data['registers'].items()}
+    except (OSError, ValueError, KeyError, AttributeError):
+      return None
+    for first, count in BME280_CALIBRATION:
+      if any(reg not in registers for reg in range(first, first + count)):
+        return None
+    return registers
+
+  #-------------------------------------
+
+  def write_cal_file(self, registers):
+    if self.cal_file is None:
+      return
+    tmp = self.cal_file + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'address': self.address, 'port': self.port,
+                 'registers': {str(reg): value for reg, value in sorted(registers.items())}}, f)
+    os.replace(tmp, self.cal_file)
+
+  #-------------------------------------
+
+  def sample(self):
     # the sample method will take a single reading and return a
-    # compensated_reading object
-    data = bme280.sample(self.bus, self.address, self.calibration_params)
+    # compensated_reading object. Hold the bus for the whole
+    # trigger / wait / read sequence.
+    if self.calibration_params is None:
+      self.load_calibration()
+    with self.bus.transaction():
+      data = bme280.sample(self.bus, self.address, self.calibration_params)
 
     return {'temp':data.temperature, 'pressure':data.pressure, 'humidity': data.humidity}
 
 #-------------------------------------------------------------------------------
 
+def format_reading(data):
+  # a read() result as text, e.g. one passed on by the acquisition process
+  if data is None or data['temp'] is None:
+    return "Temp: ----   Baro: ----   Humidity: ----"
+  ss  = "Temp: {:.1f} ".format(data['temp']) + u'\xb0C' + '   '
+  ss += "Baro: {:.0f} ".format(data['pressure']) + 'hPa   '
+  ss += "Humidity: {:.1f} ".format(data['humidity']) + '%rH'
+  return ss
+
+#-------------------------------------------------------------------------------
+
 if __name__ == '__main__':
 
   import time
@@ -66,6 +162,7 @@ if __name__ == '__main__':
   try:
     while 1:
       sensor = BME280_WRAPPER()
+      sensor.read()
       print(sensor)
       time.sleep(1)
   except KeyboardInterrupt:
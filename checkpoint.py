@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: checkpoint.py
+#
+# Description: Small state file for a fast restart of the CWS.
+#
+#           cws_main.py saves the analytics state (CONSUMPTION_ESTIMATOR and
+#           REFILL_DETECTOR get_state()) every few minutes and on exit, with
+#           the time of the reading it was taken at. After a restart, or a
+#           crash, it loads the state back and only replays the history
+#           stored after that time, which is a bisect to the end of the
+#           history and a few records, however long the history is.
+#
+#           The file is JSON, written to a temp file and renamed over the old
+#           one, so a crash in the middle of a save leaves the previous
+#           checkpoint. load() returns None for a missing, unreadable or
+#           older version file, and the caller starts from the history
+#           instead.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#
+#-------------------------------------------------------------------------------
+
+import json
+import os
+import time
+
+CHECKPOINT_VERSION = 1
+
+class CHECKPOINT:
+  def __init__(self, filename, fsync=True):
+    self.filename = filename
+    self.fsync = fsync   # False for the simulation, the data is throwaway
+    self.saves = 0
+    self.save_time = None   # seconds the last save took
+
+  #-------------------------------------
+
+  def save(self, state):
+    # state is a JSON-able dict
+    start = time.perf_counter()
+    tmp = self.filename + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'version': CHECKPOINT_VERSION, 'state': state}, f, separators=(',', ':'))
+      if self.fsync:
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, self.filename)
+    self.saves += 1
+    self.save_time = time.perf_counter() - start
+
+  #-------------------------------------
+
+  def load(self):
+    # the saved state, or None if there is no usable checkpoint
+    try:
+      with open(self.filename) as f:
+        data = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if not isinstance(data, dict) or data.get('version') != CHECKPOINT_VERSION:
+      return None
+    return data.get('state')
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  print('CHECKPOINT class test example')
+
+  filename = 'test_checkpoint.json'
+  checkpoint = CHECKPOINT(filename)
+  print('no file: {}'.format(checkpoint.load()))
+
+  checkpoint.save({'time': time.time(), 'counts': [1, 2, 3], 'rate': float('nan')})
+  print('saved in {:.1f} ms: {}'.format(checkpoint.save_time * 1000, checkpoint.load()))
+
+  with open(filename, 'w') as f:
+    f.write('{"version": 1, "sta')   # a torn file
+  print('torn file: {}'.format(checkpoint.load()))
+  os.remove(filename)
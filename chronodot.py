@@ -11,16 +11,24 @@
 #
 #           If you call str() on the instantiated class object, you will
 #           get a nice YYYY-MM-DD HH:mm:SS formatted string of the current
-#           date and time.
+#           date and time. That is the last time read (see get_date_time),
+#           str() does not read the RTC.
+#
+#           get_date_time() goes through a READ_CACHE with a ttl (default 0,
+#           always read the RTC).
 #
 # Author: Greg Kraus
 #
 # History: 20230510 Initial version
+#          20261018 get_timestamp() does a single I2C read
+#          20261018 Use the shared I2C bus
+#          20261018 Read cache, str() no longer reads the RTC
 #
 #-------------------------------------------------------------------------------
 
 import time
-from smbus2 import SMBus
+import i2c_bus
+from read_cache import READ_CACHE
 
 # register order - from DS3231 Data Sheet
 ds3231_reg = {
@@ -36,9 +44,10 @@ ds3231_reg = {
 }
 
 class DS3231:
-  def __init__(self, i2c_addr = 0x68, bus_id = 1):
+  def __init__(self, i2c_addr = 0x68, bus_id = 1, ttl = 0):
     self.i2c_addr = i2c_addr
-    self.bus = SMBus(bus_id)
+    self.cache = READ_CACHE(ttl)
+    self.bus = i2c_bus.get_bus(bus_id)  # shared, locked bus handle
     # write control register to disable alarms and Squarewave output
     self.bus.write_byte_data(self.i2c_addr, ds3231_reg['ctrl'], 0)
 
@@ -50,7 +59,9 @@ class DS3231:
   #-----------------------------------------
 
   def __str__(self):
-    data = self.get_date_time()
+    data = self.cache.last()
+    if data is None:
+      return "----------- --:--:--"
     s =  "{:4n}-".format(2000 + data[ds3231_reg['year']])
     s += "{:02n}-".format(data[ds3231_reg['month']])
     s += "{:02n} ".format(data[ds3231_reg['day']])
@@ -69,10 +80,20 @@ class DS3231:
       # print( reg_data )
       # write bcd data to DS3231
       self.bus.write_i2c_block_data(self.i2c_addr, 0, reg_data)
+      self.cache.clear()
     
   #-----------------------------------------
 
   def get_date_time(self):
+      data = self.cache.get()
+      if data is None:
+        data = self.read_date_time()
+        self.cache.put(data)
+      return data
+
+  #-----------------------------------------
+
+  def read_date_time(self):
       # read bcd data from DS3231
       reg_data = self.bus.read_i2c_block_data(self.i2c_addr, 0, 7)
       # print( reg_data )
@@ -88,8 +109,12 @@ class DS3231:
   #-----------------------------------------
 
   def get_timestamp(self):
+      # build the local time tuple straight from the register data - one
+      # I2C read, no string formatting and parsing
       data = self.get_date_time()
-      ts = time.strptime(str(self), '%Y-%m-%d %H:%M:%S')
+      ts = (2000 + data[ds3231_reg['year']], data[ds3231_reg['month']],
+            data[ds3231_reg['day']], data[ds3231_reg['hour']],
+            data[ds3231_reg['min']], data[ds3231_reg['sec']], 0, 0, -1)
       timestamp = int(time.mktime(ts))
 
       return timestamp                          
@@ -123,8 +148,8 @@ if __name__ == '__main__':
     # run a loop printing out the time values from RTC and computer
     while( 1 ):
       print("time: " + time.ctime() )
-      print("rtc: " + str(rtc))
       rtc_timestamp = rtc.get_timestamp()
+      print("rtc: " + str(rtc))
       print('rtc timestamp: ' + str(rtc_timestamp))
       time.sleep( 2 )
   except KeyboardInterrupt:
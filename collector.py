@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: collector.py
+#
+# Description: Collector service for a fleet of CWS nodes (one Pi per coop).
+#           Every node running cws_main.py --collector HOST:PORT sends its
+#           status snapshots here through an UPLINK (uplink.py). The
+#           collector stores them in one TS_STORE per station and serves
+#           fleet wide queries as JSON over HTTP.
+#
+#           Protocol, TCP, each message is one frame:
+#
+#               length   uint32 big endian, of the payload
+#               payload  zlib compressed JSON
+#
+#           node -> collector: {'type': 'batch', 'station': name,
+#                               'boot': id, 'seq': n, 'snapshots': [...]}
+#           collector -> node: {'type': 'ack', 'boot': id, 'seq': n}
+#
+#           Snapshots are numbered by the node from 0 at every start (boot,
+#           a new id each time, see uplink.boot_id()). Boot ids are only
+#           compared for equality, never ordered: a batch from any other boot
+#           than the station's current one starts (or, for the last few
+#           boots, goes back to) that run. A batch carries the number of its first
+#           snapshot, and the collector acks the last one it has stored (and
+#           fsynced). The node keeps everything unacked and sends it again
+#           after an outage. A batch that starts beyond the next expected
+#           number is a gap (the node's buffer overflowed), counted per
+#           station. Snapshots seen before (a resend after a lost ack) or not
+#           newer than the station's newest stored one (a resend to a
+#           restarted collector) are skipped. Snapshots of a new run that
+#           are not newer either (the node's clock went back) cannot be
+#           stored in time order; they are counted as stale, and acked so
+#           they do not hold up the rest.
+#
+#           One thread runs all the connections from a selectors loop, so
+#           hundreds of stations cost one socket and one open segment file
+#           each, not a thread. The station stores keep every snapshot as a
+#           record (no deadbands), so nothing acked is held back in an open
+#           run.
+#
+#           HTTP queries (http_port):
+#             /stations                 every station's newest snapshot and
+#                                       link stats
+#             /fleet                    totals, stations with alerts, the
+#                                       stations running out first
+#             /history?station=S&start=T0&end=T1&width=W
+#                                       one station's volume and temperature,
+#                                       as TS_STORE.query_rollup()
+#             /fleet/history?start=T0&end=T1&resolution=R
+#                                       total volume of all stations per
+#                                       rollup bucket
+#           start and end default to the last week.
+#
+#           Usage:
+#             ./collector.py [--port 7070] [--http-port 7080] [--dir cws_fleet]
+#             ./collector.py --sim-nodes N [--snapshots M] [--outage]
+#                 runs a collector and N simulated nodes in this process,
+#                 with a collector restart half way through if --outage
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Boot ids are not ordered, stale snapshots counted
+#
+#-------------------------------------------------------------------------------
+
+import http.server
+import json
+import math
+import os
+import re
+import selectors
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+
+from status_server import clean
+from ts_store import TS_STORE
+
+FRAME = struct.Struct('>I')
+MAX_FRAME = 4 << 20          # bytes, a bigger frame closes the connection
+STATION_NAME = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}$')
+
+DEFAULT_PORT = 7070
+DEFAULT_HTTP_PORT = 7080
+ONLINE_SECONDS = 900         # a station not heard from this long is offline
+HISTORY_DAYS = 7
+EMPTIEST = 10                # stations listed in /fleet as running out first
+RECENT_RUNS = 4              # boots per station whose next sequence number is kept
+
+#-------------------------------------------------------------------------------
+
+def encode(message):
+  payload = zlib.compress(json.dumps(clean(message), separators=(',', ':')).encode())
+  return FRAME.pack(len(payload)) + payload
+
+#-------------------------------------------------------------------------------
+
+def decode(payload):
+  return json.loads(zlib.decompress(payload))
+
+#-------------------------------------------------------------------------------
+
+def recv_frame(sock):
+  # one message from a blocking socket, None if the connection was closed
+  header = recv_exactly(sock, FRAME.size)
+  if header is None:
+    return None
+  length, = FRAME.unpack(header)
+  if length > MAX_FRAME:
+    raise ValueError('frame of {} bytes is too big'.format(length))
+  payload = recv_exactly(sock, length)
+  return None if payload is None else decode(payload)
+
+def recv_exactly(sock, size):
+  data = b''
+  while len(data) < size:
+    chunk = sock.recv(size - len(data))
+    if len(chunk) == 0:
+      return None
+    data += chunk
+  return data
+
+#-------------------------------------------------------------------------------
+
+def number(value):
+  # a snapshot value for the store, None if it is missing
+  return value if isinstance(value, (int, float)) else None
+
+#-------------------------------------------------------------------------------
+
+class STATION:
+  def __init__(self, path, name, fsync='flush'):
+    self.name = name
+    self.store = TS_STORE(os.path.join(path, name), deadbands=None, fsync=fsync,
+                          batch_size=100)
+    self.lock = threading.Lock()   # the store, between the loop and queries
+
+    self.boot = None          # the node run the sequence numbers belong to
+    self.next_seq = None
+    self.runs = {}            # boot -> next sequence number, the last RECENT_RUNS
+    self.latest = None        # newest snapshot
+    self.last_seen = None     # collector time of the last batch
+    self.batches = 0
+    self.received = 0
+    self.duplicates = 0
+    self.stale = 0            # new snapshots not newer than the stored ones
+    self.gaps = 0
+    self.missing = 0          # snapshots lost in the gaps
+
+    last = self.store.last()
+    if last is not None:
+      self.latest = dict(last)
+
+  #-------------------------------------
+
+  def add_batch(self, boot, seq, snapshots):
+    # store a batch, returns the sequence number to ack. A resend to a
+    # restarted collector is the only thing that can be older than what is
+    # stored, before that nothing has been heard from the station.
+    resend = self.last_seen is None
+    if boot != self.boot:
+      # a new run, or a batch from an earlier one still in flight
+      if self.boot is not None:
+        self.runs[self.boot] = self.next_seq
+      self.boot = boot
+      self.next_seq = self.runs.pop(boot, seq if resend else 0)
+      while len(self.runs) >= RECENT_RUNS:
+        del self.runs[next(iter(self.runs))]
+    if seq > self.next_seq:
+      self.gaps += 1
+      self.missing += seq - self.next_seq
+      self.next_seq = seq
+
+    with self.lock:
+      for n, snapshot in enumerate(snapshots, seq):
+        if n < self.next_seq:
+          self.duplicates += 1
+          continue
+        self.next_seq = n + 1
+        t = number(snapshot.get('time'))
+        if t is None or (self.store.last_ts is not None and t <= self.store.last_ts):
+          if resend:
+            self.duplicates += 1
+          else:
+            self.stale += 1
+          continue
+        self.store.append(t, number(snapshot.get('temp')), number(snapshot.get('pressure')),
+                          number(snapshot.get('humidity')), number(snapshot.get('range')),
+                          number(snapshot.get('volume')), number(snapshot.get('hall')))
+        self.latest = snapshot
+        self.received += 1
+      self.store.flush()   # stored for good before the ack
+
+    self.batches += 1
+    self.last_seen = time.time()
+    return self.next_seq - 1
+
+  #-------------------------------------
+
+  def stats(self, now):
+    return {
+      'latest'     : self.latest,
+      'last_seen'  : self.last_seen,
+      'online'     : self.last_seen is not None and now - self.last_seen < ONLINE_SECONDS,
+      'boot'       : self.boot,
+      'batches'    : self.batches,
+      'received'   : self.received,
+      'duplicates' : self.duplicates,
+      'stale'      : self.stale,
+      'gaps'       : self.gaps,
+      'missing'    : self.missing,
+    }
+
+  #-------------------------------------
+
+  def close(self):
+    with self.lock:
+      self.store.close()
+
+#-------------------------------------------------------------------------------
+
+class COLLECTOR:
+  def __init__(self, path='cws_fleet', port=DEFAULT_PORT, addr='0.0.0.0',
+               http_port=DEFAULT_HTTP_PORT, http_addr='127.0.0.1', fsync='flush'):
+    self.path = path
+    self.fsync = fsync
+    os.makedirs(path, exist_ok=True)
+
+    # the stations already on disk
+    self.stations = {}
+    for name in sorted(os.listdir(path)):
+      if STATION_NAME.match(name) and os.path.isdir(os.path.join(path, name)):
+        self.stations[name] = STATION(path, name, fsync)
+
+    self.selector = selectors.DefaultSelector()
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.listener.bind((addr, port))
+    self.listener.listen(128)
+    self.listener.setblocking(False)
+    self.port = self.listener.getsockname()[1]
+    self.selector.register(self.listener, selectors.EVENT_READ, None)
+
+    self.connections = 0
+    self.frames = 0
+    self.bytes_in = 0
+    self.errors = 0
+    self.busy_seconds = 0.0   # time spent handling connections
+
+    self.running = False
+    self.thread = None
+    self.httpd = None
+    if http_port is not None:
+      self.start_http(http_port, http_addr)
+
+  #-------------------------------------
+
+  def start(self):
+    # run the connection loop in a thread
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name='collector', daemon=True)
+    self.thread.start()
+
+  #-------------------------------------
+
+  def run(self):
+    while self.running:
+      for key, mask in self.selector.select(0.5):
+        start = time.perf_counter()
+        if key.data is None:
+          self.accept()
+        else:
+          self.read(key.fileobj, key.data)
+        self.busy_seconds += time.perf_counter() - start
+
+  #-------------------------------------
+
+  def accept(self):
+    try:
+      sock, addr = self.listener.accept()
+    except BlockingIOError:
+      return
+    sock.setblocking(False)
+    self.selector.register(sock, selectors.EVENT_READ, {'buffer': bytearray(), 'addr': addr})
+    self.connections += 1
+
+  #-------------------------------------
+
+  def drop(self, sock):
+    self.selector.unregister(sock)
+    sock.close()
+
+  #-------------------------------------
+
+  def read(self, sock, conn):
+    try:
+      data = sock.recv(65536)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      data = b''
+    if len(data) == 0:
+      self.drop(sock)
+      return
+    self.bytes_in += len(data)
+
+    buffer = conn['buffer']
+    buffer.extend(data)
+    while len(buffer) >= FRAME.size:
+      length, = FRAME.unpack_from(buffer)
+      if length > MAX_FRAME:
+        self.errors += 1
+        self.drop(sock)
+        return
+      if len(buffer) < FRAME.size + length:
+        break
+      payload = bytes(buffer[FRAME.size:FRAME.size + length])
+      del buffer[:FRAME.size + length]
+      self.frames += 1
+
+      try:
+        reply = self.handle(decode(payload))
+        # acks are tiny, a socket that cannot take one is dropped and
+        # the node sends the batch again
+        sock.send(encode(reply))
+      except (ValueError, KeyError, TypeError, zlib.error, OSError):
+        self.errors += 1
+        self.drop(sock)
+        return
+
+  #-------------------------------------
+
+  def handle(self, message):
+    if message.get('type') != 'batch':
+      raise ValueError('not a batch')
+    name = message['station']
+    if not isinstance(name, str) or not STATION_NAME.match(name):
+      raise ValueError('bad station name')
+    station = self.stations.get(name)
+    if station is None:
+      station = STATION(self.path, name, self.fsync)
+      self.stations[name] = station
+    seq = station.add_batch(message['boot'], message['seq'], message['snapshots'])
+    return {'type': 'ack', 'boot': message['boot'], 'seq': seq}
+
+  #-------------------------------------
+
+  def close(self):
+    self.running = False
+    if self.thread is not None:
+      self.thread.join()
+    for key in list(self.selector.get_map().values()):
+      key.fileobj.close()
+    self.selector.close()
+    if self.httpd is not None:
+      self.httpd.shutdown()
+      self.httpd.server_close()
+    for station in self.stations.values():
+      station.close()
+
+  #-------------------------------------
+
+  def stats(self):
+    stations = list(self.stations.values())
+    return {
+      'stations'     : len(stations),
+      'connections'  : self.connections,
+      'frames'       : self.frames,
+      'bytes_in'     : self.bytes_in,
+      'errors'       : self.errors,
+      'busy_seconds' : self.busy_seconds,
+      'received'     : sum(s.received for s in stations),
+      'duplicates'   : sum(s.duplicates for s in stations),
+      'stale'        : sum(s.stale for s in stations),
+      'gaps'         : sum(s.gaps for s in stations),
+      'missing'      : sum(s.missing for s in stations),
+    }
+
+  #-------------------------------------
+  # fleet queries
+
+  def query_stations(self):
+    now = time.time()
+    return {name: s.stats(now) for name, s in list(self.stations.items())}
+
+  def query_fleet(self):
+    now = time.time()
+    stations = list(self.stations.values())
+    latest = [(s.name, s.latest) for s in stations if s.latest is not None]
+    volumes = [l['volume'] for n, l in latest if number(l.get('volume')) is not None
+               and not math.isnan(l['volume'])]
+    running_out = sorted((l['empty_time'], n) for n, l in latest
+                         if number(l.get('empty_time')) is not None)
+    return {
+      'stations'     : len(stations),
+      'online'       : sum(s.stats(now)['online'] for s in stations),
+      'total_volume' : sum(volumes),
+      'alerts'       : {n: l['alerts'] for n, l in latest if l.get('alerts')},
+      'refilling'    : [n for n, l in latest if l.get('refilling')],
+      'emptiest'     : [{'station': n, 'empty_time': t} for t, n in running_out[:EMPTIEST]],
+      'link'         : self.stats(),
+    }
+
+  def query_history(self, name, start, end, width):
+    station = self.stations.get(name)
+    if station is None:
+      return None
+    with station.lock:
+      return station.store.query_rollup(start, end, width=width)
+
+  def query_fleet_history(self, start, end, resolution):
+    # the sum of every station's mean volume per bucket
+    totals = {}
+    for station in list(self.stations.values()):
+      with station.lock:
+        buckets = station.store.query_rollup(start, end, resolution=resolution)
+      for b in buckets:
+        if b['volume'] is not None and not math.isnan(b['volume']):
+          total = totals.setdefault(b['time'], [0.0, 0])
+          total[0] += b['volume']
+          total[1] += 1
+    return {'fields': ('time', 'volume', 'stations'),
+            'rows'  : [[t, v, n] for t, (v, n) in sorted(totals.items())]}
+
+  #-------------------------------------
+
+  def start_http(self, port, addr):
+    collector = self
+
+    class HANDLER(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        collector.handle_http(self)
+      def log_message(self, format, *args):
+        pass
+
+    self.httpd = http.server.ThreadingHTTPServer((addr, port), HANDLER)
+    self.httpd.daemon_threads = True
+    threading.Thread(target=self.httpd.serve_forever, name='collector-http', daemon=True).start()
+
+  #-------------------------------------
+
+  def handle_http(self, request):
+    url = urllib.parse.urlparse(request.path)
+    params = dict(urllib.parse.parse_qsl(url.query))
+    now = time.time()
+    try:
+      start = float(params.get('start', now - HISTORY_DAYS * 86400))
+      end = float(params.get('end', now))
+      if url.path == '/stations':
+        data = self.query_stations()
+      elif url.path == '/fleet':
+        data = self.query_fleet()
+      elif url.path == '/history':
+        data = self.query_history(params.get('station'), start, end, int(params.get('width', 800)))
+      elif url.path == '/fleet/history':
+        data = self.query_fleet_history(start, end, int(params.get('resolution', 3600)))
+      else:
+        data = None
+    except ValueError as e:
+      request.send_error(400, str(e))
+      return
+    if data is None:
+      request.send_error(404)
+      return
+
+    body = json.dumps(clean(data), separators=(',', ':')).encode()
+    request.send_response(200)
+    request.send_header('Content-Type', 'application/json')
+    request.send_header('Content-Length', str(len(body)))
+    request.send_header('Access-Control-Allow-Origin', '*')
+    request.end_headers()
+    request.wfile.write(body)
+
+#-------------------------------------------------------------------------------
+
+def simulate(args):
+  # a collector and simulated nodes in one process. Each node's snapshots
+  # are a bucket drinking 3 L a day, refilled when low, 10 s apart, and
+  # come out as fast as the uplinks take them.
+  import resource
+  from uplink import UPLINK
+
+  collector = COLLECTOR(args.dir, args.port, '127.0.0.1', args.http_port, fsync='never')
+  collector.start()
+  port = collector.port
+
+  start_time = time.time() - args.snapshots * 10
+  nodes = []
+  for ii in range(args.sim_nodes):
+    nodes.append({
+      'uplink' : UPLINK('127.0.0.1', port, 'sim{:04d}'.format(ii), batch_size=args.batch,
+                        interval=0.05, max_backoff=1.0),
+      'volume' : 10.0 + ii % 20,
+    })
+
+  t0 = time.perf_counter()
+  cpu0 = time.process_time()
+  for n in range(args.snapshots):
+    if args.outage and n == args.snapshots // 2:
+      # the collector goes away and comes back
+      collector.close()
+      stats = collector.stats()
+      time.sleep(2)
+      collector = COLLECTOR(args.dir, port, '127.0.0.1', args.http_port, fsync='never')
+      collector.stats_before = stats
+      collector.start()
+    t = start_time + n * 10
+    for ii, node in enumerate(nodes):
+      node['volume'] -= 3.0 / 8640
+      if node['volume'] < 1:
+        node['volume'] = 30.0
+      node['uplink'].add({'time': t, 'temp': 15 + 5 * math.sin(t / 13751), 'pressure': 1010.0,
+                          'humidity': 60.0, 'range': 37.4 - node['volume'] / 1.09,
+                          'volume': node['volume'], 'hall': 0, 'rate': 3.0,
+                          'empty_time': t + node['volume'] / 3.0 * 86400,
+                          'refilling': False, 'alerts': []})
+    time.sleep(0.001)
+
+  for node in nodes:
+    node['uplink'].close(timeout=10)
+  elapsed = time.perf_counter() - t0
+  cpu = time.process_time() - cpu0
+  time.sleep(0.5)
+
+  stats = collector.stats()
+  before = getattr(collector, 'stats_before', None)
+  total = stats['received'] + (before['received'] if before else 0)
+  print('{} nodes, {} snapshots each: {} stored in {:.1f} s ({:.0f}/s), {:.1f} s CPU'.format(
+        args.sim_nodes, args.snapshots, total, elapsed, total / elapsed, cpu))
+  print('collector: {}'.format(stats))
+  if before:
+    print('before the outage: {}'.format(before))
+  print('uplinks: {}'.format({k: sum(n['uplink'].stats()[k] for n in nodes)
+                              for k in ('sent', 'batches', 'resent', 'dropped', 'failures')}))
+  print('fleet: {}'.format({k: v for k, v in collector.query_fleet().items() if k != 'link'}))
+  print('max RSS {:.0f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+  collector.close()
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser(description='CWS fleet collector')
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port the nodes send to')
+  parser.add_argument('--addr', default='0.0.0.0', help='address the nodes send to')
+  parser.add_argument('--http-port', type=int, default=DEFAULT_HTTP_PORT,
+                      help='port for the JSON queries, 0 for none')
+  parser.add_argument('--dir', default='cws_fleet', help='directory for the station stores')
+  parser.add_argument('--sim-nodes', type=int, default=0, help='run this many simulated nodes')
+  parser.add_argument('--snapshots', type=int, default=1000, help='snapshots per simulated node')
+  parser.add_argument('--batch', type=int, default=30, help='simulated node batch size')
+  parser.add_argument('--outage', action='store_true', help='restart the simulated collector')
+  args = parser.parse_args()
+  if args.http_port == 0:
+    args.http_port = None
+
+  if args.sim_nodes > 0:
+    simulate(args)
+  else:
+    collector = COLLECTOR(args.dir, args.port, args.addr, args.http_port)
+    print('collecting on port {}, {} stations'.format(collector.port, len(collector.stations)))
+    collector.running = True
+    try:
+      collector.run()
+    except KeyboardInterrupt:
+      pass
+    collector.close()
+    print(collector.stats())
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: cws_benchmark.py
+#
+# Description: Benchmarks for the CWS measurement cycle and its hot paths, run
+#           on the simulated hardware in sim_hw.py so they give repeatable
+#           numbers on any Linux box.
+#
+#           Each hot path is called a number of times and reports:
+#             * real_*      - wall time per call (perf_counter), which is the
+#                             Python cost of the code path
+#             * cpu_mean    - CPU seconds per call (process_time)
+#             * virtual_mean- simulated device time per call, i.e. how long
+#                             the call would take on the Pi (sleeps, echo
+#                             pulses, polling)
+#             * ops_per_sec - calls per second of real time
+#
+#           The full main loop is benchmarked by running cws_main.py --sim
+#           for a simulated hour and reading back its scheduler stats: cycle
+#           time, jitter and overruns. It runs with fixed rate sampling, so
+#           every run measures the same number of cycles. main_loop reads
+#           the sensors in turn, as --sim does by default; main_loop.threads
+#           reads them on the acquisition thread pool (--acq-workers).
+#
+#           Every benchmark is run --repeats times (default 5). The
+#           compared metrics (COMPARED_METRICS) are the best, i.e. smallest,
+#           over the repeats, which other load on the machine can only make
+#           worse; the rest are the median. The noise of each metric, its
+#           spread (max - min) over the repeats relative to the reported
+#           value, is kept alongside.
+#
+#           Results are written as JSON. With --baseline the results are
+#           compared against an earlier run, and any metric that got worse by
+#           more than --threshold (default 20%) and by more than the noise
+#           of either run is reported as a regression. The exit code is 1
+#           only when both runs had at least MIN_REPEATS repeats; with fewer
+#           the regressions are reported but never fail. Use the same
+#           --quick setting for both runs; quick runs are noisier.
+#
+#           Usage:
+#             ./cws_benchmark.py [--output results.json]
+#                                [--baseline baseline.json] [--threshold 0.2]
+#                                [--repeats 5] [--quick]
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Main loop at fixed rate sampling
+#          20261018 Median of repeats, noise floor, threaded main loop
+#
+#-------------------------------------------------------------------------------
+
+import sim_hw
+sim_hw.install()  # must happen before the driver modules are imported
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import RPi.GPIO as GPIO
+from chronodot import DS3231
+from rtc_clock import RTC_CLOCK
+from hc_sr04_sensor import HC_SR04
+from bme280_sensor import BME280_WRAPPER
+from logger import LOGGER
+from ts_store import TS_STORE
+
+TRIG_PIN = 23
+ECHO_PIN = 24
+
+# metrics where a bigger number is worse, checked in --baseline mode. The
+# median is compared rather than the mean, which a single GC pause can move.
+COMPARED_METRICS = ('real_p50', 'real_p95', 'cpu_mean', 'virtual_mean',
+                    'cycle_virtual_mean', 'cycle_real_mean', 'jitter_max', 'overruns')
+# changes smaller than this (seconds) are timer noise, never a regression
+MIN_DELTA = 1e-6
+# fewer repeats than this in either run never fail --baseline
+MIN_REPEATS = 3
+
+#-------------------------------------------------------------------------------
+
+def run_bench(fn, iterations, warmup=3):
+  for ii in range(warmup):
+    fn()
+
+  real = []
+  cpu_start = time.process_time()
+  virtual_start = time.monotonic()
+  for ii in range(iterations):
+    t0 = time.perf_counter()
+    fn()
+    real.append(time.perf_counter() - t0)
+  cpu = time.process_time() - cpu_start
+  virtual = time.monotonic() - virtual_start
+
+  real.sort()
+  real_mean = sum(real) / iterations
+  return {
+    'iterations'   : iterations,
+    'real_mean'    : real_mean,
+    'real_p50'     : real[iterations // 2],
+    'real_p95'     : real[min(int(iterations * 0.95), iterations - 1)],
+    'real_max'     : real[-1],
+    'cpu_mean'     : cpu / iterations,
+    'virtual_mean' : virtual / iterations,
+    'ops_per_sec'  : 1 / real_mean if real_mean > 0 else None,
+  }
+
+#-------------------------------------------------------------------------------
+
+def bench_ranger(results, scale):
+  # polling and edge detect instances cannot share the echo pin at the same
+  # time, so each one is removed before the next is made. GPIO holds on to
+  # the edge detect callback, and with it the instance, so its event detect
+  # is removed here rather than left to __del__.
+  sensor = HC_SR04(TRIG_PIN, ECHO_PIN)
+  results['hc_sr04.get_echo.poll'] = run_bench(sensor.get_echo, 100 * scale)
+  results['hc_sr04.calc_distance.poll'] = run_bench(sensor.calc_distance, 5 * scale)
+  del sensor
+
+  sensor = HC_SR04(TRIG_PIN, ECHO_PIN, edge_detect=True)
+  results['hc_sr04.get_echo.edge'] = run_bench(sensor.get_echo, 100 * scale)
+  results['hc_sr04.calc_distance.edge'] = run_bench(sensor.calc_distance, 5 * scale)
+  results['hc_sr04.calc_distance.adaptive'] = run_bench(
+    lambda: sensor.calc_distance(adaptive=True), 5 * scale)
+  GPIO.remove_event_detect(ECHO_PIN)
+  del sensor
+
+#-------------------------------------------------------------------------------
+
+def bench_i2c(results, scale):
+  rtc = DS3231()
+  results['ds3231.get_timestamp'] = run_bench(rtc.get_timestamp, 200 * scale)
+
+  clock = RTC_CLOCK(rtc)
+  results['rtc_clock.get_timestamp'] = run_bench(clock.get_timestamp, 1000 * scale)
+
+  bme = BME280_WRAPPER()
+  results['bme280.read'] = run_bench(bme.read, 200 * scale)
+
+#-------------------------------------------------------------------------------
+
+def bench_storage(results, scale, work_dir):
+  log = LOGGER(os.path.join(work_dir, 'bench_log.txt'))
+  results['logger.write'] = run_bench(
+    lambda: log.write('12.3,1013.2,55.1,20.41,18.52,1'), 500 * scale)
+
+  store = TS_STORE(os.path.join(work_dir, 'bench_history'), fsync='never',
+                   deadbands={'range': 0.2, 'temp': 0.1})
+  readings = iter(range(10 ** 9))
+  def append():
+    ii = next(readings)
+    store.append(ii * 10, 20.0, 1013.0, 50.0, 20.0 + (ii % 5) * 0.1, 15.0, 1)
+  results['ts_store.append'] = run_bench(append, 2000 * scale)
+  store.close()
+
+#-------------------------------------------------------------------------------
+
+def bench_main_loop(results, duration, work_dir, name='main_loop', acq_workers=0):
+  # run the real main loop on simulated hardware and read back its stats.
+  # Each run starts from an empty history.
+  run_dir = tempfile.mkdtemp(prefix='main_', dir=work_dir)
+  stats_file = os.path.join(run_dir, 'main_stats.json')
+  main = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cws_main.py')
+
+  t0 = time.perf_counter()
+  subprocess.run([sys.executable, main, '--sim', '--quiet', '--duration', str(duration),
+                  '--stats-json', stats_file, '--status-port', '0', '--sampling', 'fixed',
+                  '--acq-workers', str(acq_workers)],
+                 cwd=run_dir, check=True,
+                 stdout=subprocess.DEVNULL)
+  real = time.perf_counter() - t0
+
+  with open(stats_file) as f:
+    stats = json.load(f)
+  measure = stats['scheduler']['measure']
+  results[name] = {
+    'cycles'             : measure['runs'],
+    'cycle_virtual_mean' : measure['mean_run_time'],
+    'cycle_virtual_max'  : measure['max_run_time'],
+    'cycle_real_mean'    : real / measure['runs'],
+    'jitter_mean'        : measure['mean_jitter'],
+    'jitter_max'         : measure['max_jitter'],
+    'overruns'           : measure['overruns'],
+  }
+
+#-------------------------------------------------------------------------------
+
+def median(values):
+  ordered = sorted(values)
+  mid = len(ordered) // 2
+  return ordered[mid] if len(ordered) % 2 == 1 else (ordered[mid - 1] + ordered[mid]) / 2
+
+#-------------------------------------------------------------------------------
+
+def merge_repeats(runs):
+  # runs is a list of results dicts, one per repeat. Returns the best of
+  # the compared metrics and the median of the rest, and the noise: the
+  # spread of each metric over the repeats, relative to that value
+  results = {}
+  noise = {}
+  for name in runs[0]:
+    results[name] = {}
+    noise[name] = {}
+    for metric in runs[0][name]:
+      values = [run[name][metric] for run in runs if run[name][metric] is not None]
+      if len(values) == 0:
+        results[name][metric] = None
+        continue
+      value = min(values) if metric in COMPARED_METRICS else median(values)
+      results[name][metric] = value
+      noise[name][metric] = (max(values) - min(values)) / value if value > 0 else 0.0
+  return results, noise
+
+#-------------------------------------------------------------------------------
+
+def compare(results, baseline, threshold, noise=None, baseline_noise=None):
+  # returns a list of (bench, metric, baseline value, new value, change). A
+  # change must be over the threshold and over the noise of both runs.
+  regressions = []
+  noise = noise or {}
+  baseline_noise = baseline_noise or {}
+  for name, metrics in results.items():
+    base = baseline.get(name)
+    if base is None:
+      continue
+    for metric in COMPARED_METRICS:
+      new = metrics.get(metric)
+      old = base.get(metric)
+      if new is None or old is None or new - old < MIN_DELTA:
+        continue
+      if old <= 0:
+        change = 0.0 if new <= 0 else float('inf')
+      else:
+        change = (new - old) / old
+      floor = max(threshold, noise.get(name, {}).get(metric, 0.0),
+                  baseline_noise.get(name, {}).get(metric, 0.0))
+      if change > floor:
+        regressions.append((name, metric, old, new, change))
+  return regressions
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='CWS benchmark suite (simulated hardware)')
+  parser.add_argument('--output', default=None, help='write JSON results here')
+  parser.add_argument('--baseline', default=None, help='compare against these JSON results')
+  parser.add_argument('--threshold', type=float, default=0.2,
+                      help='relative slowdown that counts as a regression')
+  parser.add_argument('--repeats', type=int, default=5,
+                      help='runs of every benchmark, the best or median is reported')
+  parser.add_argument('--quick', action='store_true', help='fewer iterations')
+  args = parser.parse_args()
+  if args.repeats < 1:
+    raise ValueError('--repeats must be at least 1')
+
+  GPIO.setwarnings(False)
+  GPIO.setmode(GPIO.BCM)
+
+  scale = 1 if args.quick else 5
+  work_dir = tempfile.mkdtemp(prefix='cws_bench_')
+  duration = 3600 if args.quick else 6 * 3600
+  runs = []
+  try:
+    for ii in range(args.repeats):
+      run = {}
+      bench_ranger(run, scale)
+      bench_i2c(run, scale)
+      bench_storage(run, scale, tempfile.mkdtemp(prefix='storage_', dir=work_dir))
+      bench_main_loop(run, duration, work_dir)
+      bench_main_loop(run, duration, work_dir, 'main_loop.threads', acq_workers=8)
+      runs.append(run)
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+  results, noise = merge_repeats(runs)
+
+  report = {
+    'meta' : {
+      'time'     : sim_hw.real_time(),
+      'python'   : platform.python_version(),
+      'platform' : platform.platform(),
+      'quick'    : args.quick,
+      'repeats'  : args.repeats,
+    },
+    'results' : results,
+    'noise'   : noise,
+  }
+
+  for name, metrics in results.items():
+    print('{:<32} {}'.format(name, ', '.join('{}={:.6g}'.format(k, v)
+          for k, v in metrics.items() if v is not None)))
+
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+
+  if args.baseline is not None:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare(results, baseline['results'], args.threshold,
+                          noise, baseline.get('noise'))
+    print('\n{} regression(s) against {}'.format(len(regressions), args.baseline))
+    for name, metric, old, new, change in regressions:
+      print('  {:<32} {:<20} {:.6g} -> {:.6g} ({:+.0%})'.format(name, metric, old, new, change))
+    repeats = min(args.repeats, baseline['meta'].get('repeats', 1))
+    if len(regressions) > 0 and repeats < MIN_REPEATS:
+      print('not failing: {} repeat(s), {} needed'.format(repeats, MIN_REPEATS))
+      sys.exit(0)
+    sys.exit(1 if len(regressions) > 0 else 0)
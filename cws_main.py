@@ -21,19 +21,138 @@
 #
 # History:  20230512 Initial work started
 #
+# Usage: ./cws_main.py [--sim] [--duration SECONDS] [--quiet] [--stats-json FILE]
+#                      [--metrics-port PORT] [--metrics-file FILE]
+#                      [--status-port PORT] [--status-addr ADDR] [--raw-echoes]
+#                      [--sampling adaptive|fixed]
+#                      [--acq-process [--acq-nice N | --acq-fifo PRIO]]
+#                      [--acq-workers N]
+#                      [--alert-socket PATH] [--collector HOST:PORT [--station NAME]]
+#           --sim runs on the simulated hardware in sim_hw.py, with a virtual
+#           clock, so the whole system can be run and tested off the Pi.
+#           --stats-json writes the scheduler and acquisition stats to FILE
+#           on exit (used by cws_benchmark.py).
+#           --metrics-port serves Prometheus metrics (metrics.py) on
+#           http://127.0.0.1:PORT/metrics, --metrics-file writes them to FILE
+#           (a node_exporter textfile, name it *.prom) every minute. Without
+#           either the driver hooks are not installed at all.
+#           --status-port serves the status, estimates and history as JSON
+#           (status_server.py) on ADDR:PORT, default 127.0.0.1:8080. Port 0
+#           turns it off.
+#           --raw-echoes also stores the raw echo times and temperature of
+#           every measurement (echo_store.py), so the history can be
+#           recomputed under a new calibration with reprocess_echoes.py.
+#           --sampling picks the measurement rate policy (sample_policy.py):
+#           adaptive (default) measures every 10 s while the level or the
+#           water out sensor is changing and backs off to minutes when it is
+#           stable, longer at night. fixed measures every 10 s. In
+#           between slow samples a water out sensor edge, or a level check
+#           (one ping per ranger every LEVEL_CHECK_SECONDS) that finds the
+#           level has moved, e.g. a refill starting, measures at once.
+#           --acq-process reads the sensors in a separate process
+#           (acq_process.py) that hands the readings over through shared
+#           memory, so nothing else running here can disturb the echo
+#           timing. --acq-nice (a negative nice value) or --acq-fifo (a
+#           SCHED_FIFO priority, 1-99) raise its priority; both need root.
+#           --acq-workers sets the threads that read the sensors side by
+#           side (acquisition.py), default 8, or 0 (one after another) with
+#           --sim.
+#
+#           --alert-socket also sends every alert notification (alerts.py)
+#           as a JSON datagram to the Unix socket PATH. Alerts always go to
+#           the log file and the status LED blink pattern.
+#
+#           --collector also sends every status snapshot to a fleet
+#           collector (collector.py) through an uplink (uplink.py), which
+#           buffers them while the collector cannot be reached. --station
+#           names this node there, default the host name.
+#
+#           The water level is measured by one HC-SR04 ranger per bucket
+#           (RANGER_PINS), which take turns so they never hear each other's
+#           pings (ranger_array.py). Each bucket's volume comes from the
+#           volume table, and the system volume is their sum.
+#
+#           The analytics state is checkpointed (checkpoint.py) every few
+#           minutes and on exit. A restart restores it, replays only the
+#           history stored after it, and publishes the last stored status
+#           before the first measurement, so start up takes the same time
+#           with a year of history as with a day.
+#
 #-------------------------------------------------------------------------------
 
-import os
-import sys
 import time
+START_TIME = time.perf_counter()   # for the start up time report
+
+import argparse
+import json
+import math
+import os
+
+parser = argparse.ArgumentParser(description='Chicken Watering System')
+parser.add_argument('--sim', action='store_true',
+                    help='run on simulated hardware with a virtual clock')
+parser.add_argument('--duration', type=float, default=None,
+                    help='stop after this many (virtual) seconds')
+parser.add_argument('--quiet', action='store_true', help='no status display')
+parser.add_argument('--stats-json', default=None, help='write run stats to this file on exit')
+parser.add_argument('--metrics-port', type=int, default=None,
+                    help='serve Prometheus metrics on this local port')
+parser.add_argument('--metrics-file', default=None,
+                    help='write Prometheus metrics to this textfile every minute')
+parser.add_argument('--status-port', type=int, default=8080,
+                    help='serve JSON status on this port, 0 for none')
+parser.add_argument('--status-addr', default='127.0.0.1',
+                    help='address the JSON status server listens on')
+parser.add_argument('--raw-echoes', action='store_true',
+                    help='also store the raw echo times of every measurement')
+parser.add_argument('--sampling', choices=('adaptive', 'fixed'), default='adaptive',
+                    help='measurement rate policy')
+parser.add_argument('--acq-process', action='store_true',
+                    help='read the sensors in a separate acquisition process')
+parser.add_argument('--acq-nice', type=int, default=None,
+                    help='nice increment for the acquisition process')
+parser.add_argument('--acq-fifo', type=int, default=None,
+                    help='SCHED_FIFO priority for the acquisition process')
+parser.add_argument('--acq-workers', type=int, default=None,
+                    help='sensor read threads, 0 reads them in turn (default 8, 0 with --sim)')
+parser.add_argument('--alert-socket', default=None,
+                    help='also send alert notifications to this Unix datagram socket')
+parser.add_argument('--collector', default=None,
+                    help='send status snapshots to the fleet collector at HOST:PORT')
+parser.add_argument('--station', default=None,
+                    help='station name at the collector, default the host name')
+args = parser.parse_args()
+
+if args.sim:
+  # must happen before any of the driver modules are imported
+  import sim_hw
+  sim_hw.install()
 
 import RPi.GPIO as GPIO
 from chronodot import DS3231
-from hall_sensor import HALL_SENSOR
+from hall_sensor import HALL_SENSOR, format_state
 from hc_sr04_sensor import HC_SR04
-from bme280_sensor import BME280_WRAPPER
+from ranger_array import RANGER_ARRAY
+from bme280_sensor import BME280_WRAPPER, format_reading
 from led import LED
 from logger import LOGGER
+from ts_store import TS_STORE
+from volume_table import cached_table, geometry_table, calibration_table, load_calibration
+from rtc_clock import RTC_CLOCK, date_time
+from scheduler import SCHEDULER
+from acquisition import ACQUISITION
+from analytics import CONSUMPTION_ESTIMATOR, REFILL_DETECTOR, REFILL_TABLE
+from checkpoint import CHECKPOINT
+from alerts import ALERT_ENGINE, NOTIFIER, THRESHOLD_RULE, RATE_RULE, EMPTY_RULE, \
+                   LOG_SINK, SOCKET_SINK, LED_SINK
+from status_server import STATUS_SERVER
+from sample_policy import FIXED_POLICY, ADAPTIVE_POLICY, NIGHT_SCHEDULE
+import metrics
+
+METRICS_ENABLED = args.metrics_port is not None or args.metrics_file is not None
+if METRICS_ENABLED:
+  # before the drivers are created, so bound methods get the hooks
+  metrics.enable()
 
 # Configure GPIO
 GPIO.setwarnings(False)
@@ -41,31 +160,110 @@ GPIO.setmode(GPIO.BCM)  # use BCM pin numbers
 
 # Create system sensor objects
 
+# (trigger, echo) pins of the rangers, one per bucket. A single ranger
+# measures all the buckets, which are then taken to be connected at the
+# bottom and at the same level.
+RANGER_PINS = ((23, 24), (17, 27))
+HALL_SENSOR_PIN = 21
+LED_PIN = 25
+
+# the BME280 calibration registers, read from the chip only once
+BME280_CAL_FILE = 'cws_sim_bme280_cal.json' if args.sim else 'cws_bme280_cal.json'
+
+# the acquisition process owns the BME280, rangers and hall sensor. It is
+# forked before anything else is set up here.
+acq_process = None
+if args.acq_process:
+  from acq_process import ACQUISITION_PROCESS
+  acq_process = ACQUISITION_PROCESS(RANGER_PINS, HALL_SENSOR_PIN, args.acq_nice, args.acq_fifo,
+                                    sim=args.sim, bme_cal_file=BME280_CAL_FILE,
+                                    send_metrics=METRICS_ENABLED)
+
 rtc = DS3231()
-temp_sensor = BME280_WRAPPER()
+clock = RTC_CLOCK(rtc)   # reads the RTC about once an hour
 
-RANGE_TRIGGER_PIN = 23
-RANGE_ECHO_PIN = 24
-ranger = HC_SR04(RANGE_TRIGGER_PIN, RANGE_ECHO_PIN)
+temp_sensor = rangers = water_out_sensor = None
+if acq_process is None:
+  temp_sensor = BME280_WRAPPER(cal_file=BME280_CAL_FILE)
+  # edge detect timing, so the other acquisition threads cannot skew the echo
+  # times the way they would with a busy-wait polling loop
+  rangers = RANGER_ARRAY([HC_SR04(trig_pin, echo_pin, edge_detect=True)
+                          for trig_pin, echo_pin in RANGER_PINS])
+  # edge detect, so a magnet event between measurements is still caught
+  water_out_sensor = HALL_SENSOR(HALL_SENSOR_PIN, edge_detect=True)
 
-LED_PIN = 25
 status_led = LED(LED_PIN, True)
 
-HALL_SENSOR_PIN = 21
-water_out_sensor = HALL_SENSOR(HALL_SENSOR_PIN)
-
 # initialize logging
 logfile_name = 'cws_log.txt'
 log = LOGGER(logfile_name)
 
+# initialize the reading history store. Readings within these deadbands of
+# the first one of the current run only extend it instead of adding a
+# record. The range band is about 5 standard deviations of a measured range
+# (0.06 cm), the temperature band the BME280's accuracy. The store keeps
+# the open run on disk from each flush (the checkpoint), so runs can be long.
+HISTORY_PATH = 'cws_sim_history' if args.sim else 'cws_history'
+HISTORY_DEADBANDS = {'range': 0.3, 'temp': 1.0}  # cm, C
+HISTORY_MAX_RUN_SECONDS = 7200
+history = TS_STORE(HISTORY_PATH, deadbands=HISTORY_DEADBANDS,
+                   max_run_seconds=HISTORY_MAX_RUN_SECONDS,
+                   fsync='never' if args.sim else 'flush')
+
+# water consumption rate and empty time prediction, and refill times and
+# amounts. Their state is restored by restore() below, so a restart does not
+# lose a week of averaging.
+consumption = CONSUMPTION_ESTIMATOR()
+REFILL_PATH = 'cws_sim_refills.dat' if args.sim else 'cws_refills.dat'
+refills = REFILL_DETECTOR(REFILL_TABLE(REFILL_PATH))
+
+CHECKPOINT_PATH = 'cws_sim_checkpoint.json' if args.sim else 'cws_checkpoint.json'
+CHECKPOINT_SECONDS = 300
+checkpoint = CHECKPOINT(CHECKPOINT_PATH, fsync=not args.sim)
+
+# raw echo times, for recomputing the history after a recalibration. With
+# several rangers each has its own store, numbered from 1.
+echo_stores = None
+if args.raw_echoes:
+  from echo_store import ECHO_STORE
+  ECHO_PATH = 'cws_sim_echoes' if args.sim else 'cws_echoes'
+  echo_stores = [ECHO_STORE(ECHO_PATH if len(RANGER_PINS) == 1 else '{}_{}'.format(ECHO_PATH, k + 1),
+                            fsync='never' if args.sim else 'flush')
+                 for k in range(len(RANGER_PINS))]
+
 # set some system parameters
 MEASUREMENT_INTERVAL_SECONDS = 10
+# storage and display run this far into each measurement interval, well
+# after the sensor readings are done
+REPORT_OFFSET_SECONDS = 5
+
+# adaptive sampling: MEASUREMENT_INTERVAL_SECONDS while the level is
+# changing, backing off to SLOW_INTERVAL_SECONDS when it is stable, and to
+# NIGHT_INTERVAL_SECONDS at night
+SLOW_INTERVAL_SECONDS = 300
+NIGHT_START_HOUR = 21
+NIGHT_END_HOUR = 5
+NIGHT_INTERVAL_SECONDS = 900
+if args.sampling == 'fixed':
+  sampling = FIXED_POLICY(MEASUREMENT_INTERVAL_SECONDS)
+else:
+  sampling = NIGHT_SCHEDULE(ADAPTIVE_POLICY(MEASUREMENT_INTERVAL_SECONDS, SLOW_INTERVAL_SECONDS),
+                            NIGHT_START_HOUR, NIGHT_END_HOUR, NIGHT_INTERVAL_SECONDS)
+# the tasks that run once per measurement, their period follows the policy
+CYCLE_TASKS = ('measure', 'store', 'display', 'publish')
+# between slow samples the level is checked with a single ping per ranger,
+# and a move of more than LEVEL_CHECK_CM (well over the echo noise) starts
+# a measurement cycle right away
+LEVEL_CHECK_SECONDS = 30
+LEVEL_CHECK_CM = 1.0
+measure_cpu_seconds = 0.0
 
 WATER_LEVEL_FULL_DISTANCE_CM = 5.4   # range measurement from sensor to full water level
 WATER_LEVEL_EMPTY_DISTANCE_CM = 37.4  # range measurement from sensor to WATER_OUT_LEVEL
 NUMBER_OF_WATER_BUCKETS = 2
 BUCKET_CAPACITY_LITERS = 5 * 3.875
-BUCKET_RADIUS_CM = (10.75 / 2) * 2.54
+BUCKET_RADIUS_CM = (10.75 / 2) * 2.54        # at the full level
+BUCKET_EMPTY_RADIUS_CM = (10.0 / 2) * 2.54   # the buckets taper, at the empty level
 
 # Calulate the system's total water capacity
 # volume = height * (pi * r^2)
@@ -74,6 +272,85 @@ BUCKET_RADIUS_CM = (10.75 / 2) * 2.54
 # 1 gal of water = 3.875 liter
 # 5 gal = 19.375 liters
 
+# Height to volume lookup table for the buckets under one ranger, all of
+# them with a single ranger. A fill calibration run (liters,distance_cm CSV,
+# see volume_table.py) of those buckets is used if there is one, otherwise the
+# bucket geometry. The table is cached on disk and only rebuilt when the
+# calibration or geometry changes.
+if NUMBER_OF_WATER_BUCKETS % len(RANGER_PINS) != 0:
+  raise ValueError('{} buckets cannot be shared out between {} rangers'.format(
+                   NUMBER_OF_WATER_BUCKETS, len(RANGER_PINS)))
+BUCKETS_PER_RANGER = NUMBER_OF_WATER_BUCKETS // len(RANGER_PINS)
+VOLUME_CALIBRATION_FILE = 'cws_volume_calibration.csv'
+VOLUME_TABLE_FILE = 'cws_sim_volume_table.dat' if args.sim else 'cws_volume_table.dat'
+if os.path.exists(VOLUME_CALIBRATION_FILE):
+  calibration = load_calibration(VOLUME_CALIBRATION_FILE)
+  volume_table = cached_table(VOLUME_TABLE_FILE,
+                              {'calibration': calibration, 'empty': WATER_LEVEL_EMPTY_DISTANCE_CM},
+                              lambda: calibration_table(calibration, WATER_LEVEL_EMPTY_DISTANCE_CM))
+else:
+  geometry = (BUCKET_EMPTY_RADIUS_CM, BUCKET_RADIUS_CM,
+              WATER_LEVEL_EMPTY_DISTANCE_CM - WATER_LEVEL_FULL_DISTANCE_CM, BUCKETS_PER_RANGER)
+  volume_table = cached_table(VOLUME_TABLE_FILE, {'geometry': geometry},
+                              lambda: geometry_table(*geometry))
+if volume_table.capacity() > BUCKETS_PER_RANGER * BUCKET_CAPACITY_LITERS:
+  print('Warning: volume table capacity {:.1f} L is more than {} buckets of {:.1f} L'.format(
+        volume_table.capacity(), BUCKETS_PER_RANGER, BUCKET_CAPACITY_LITERS))
+if args.sim:
+  # the simulated buckets have the same shape
+  for water in sim_hw.world.waters:
+    water.set_table(volume_table)
+
+# Alerts, checked after every measurement. The notifications go out from
+# their own threads, so a slow sink cannot hold up the measurements.
+WATER_LOW_LITERS = 4.0          # critically low
+WATER_LOW_CLEAR_LITERS = 2.0    # above WATER_LOW_LITERS to clear
+WATER_LOW_REPEAT_SECONDS = 4 * 3600
+EMPTY_WARNING_HOURS = 24
+EMPTY_WARNING_CLEAR_HOURS = 6
+LEAK_LITERS_PER_HOUR = 1.5      # the chickens drink well under 0.5 L/h
+LEAK_CLEAR_LITERS_PER_HOUR = 0.5
+TEMP_HOT_C = 35.0
+TEMP_COLD_C = 1.0               # the water is about to freeze
+TEMP_CLEAR_C = 2.0
+ALERT_CONFIRM_SAMPLES = 3       # rides out single bad echoes
+ALERT_COOLDOWN_SECONDS = 3600
+
+alert_rules = [
+  THRESHOLD_RULE('water_low', 'volume', WATER_LOW_LITERS, WATER_LOW_CLEAR_LITERS,
+                 severity='critical', confirm=ALERT_CONFIRM_SAMPLES,
+                 cooldown=ALERT_COOLDOWN_SECONDS, repeat=WATER_LOW_REPEAT_SECONDS,
+                 message='water critically low, {value:.1f} L left'),
+  EMPTY_RULE('empty_soon', EMPTY_WARNING_HOURS, EMPTY_WARNING_CLEAR_HOURS,
+             confirm=ALERT_CONFIRM_SAMPLES, cooldown=ALERT_COOLDOWN_SECONDS,
+             message='water runs out in {value:.1f} h'),
+  RATE_RULE('leak', 'volume', LEAK_LITERS_PER_HOUR, LEAK_CLEAR_LITERS_PER_HOUR,
+            confirm=ALERT_CONFIRM_SAMPLES, cooldown=ALERT_COOLDOWN_SECONDS,
+            message='water level falling {value:.1f} L/h, leak?'),
+  THRESHOLD_RULE('temp_hot', 'bme.temp', TEMP_HOT_C, TEMP_CLEAR_C, above=True,
+                 confirm=ALERT_CONFIRM_SAMPLES, cooldown=ALERT_COOLDOWN_SECONDS,
+                 message='too hot, {value:.1f} C'),
+  THRESHOLD_RULE('temp_cold', 'bme.temp', TEMP_COLD_C, TEMP_CLEAR_C,
+                 confirm=ALERT_CONFIRM_SAMPLES, cooldown=ALERT_COOLDOWN_SECONDS,
+                 message='too cold, {value:.1f} C'),
+]
+led_sink = LED_SINK(status_led)
+alert_sinks = {'log': LOG_SINK(log), 'led': led_sink}
+if args.alert_socket is not None:
+  alert_sinks['socket'] = SOCKET_SINK(args.alert_socket)
+alert_notifier = NOTIFIER(alert_sinks)
+alert_engine = ALERT_ENGINE(alert_rules, alert_notifier)
+
+# the fleet collector, if there is one
+uplink = None
+if args.collector is not None:
+  import socket
+  from uplink import UPLINK, node_snapshot
+  host, port = args.collector.rsplit(':', 1)
+  UPLINK_BOOT_FILE = 'cws_sim_boot.txt' if args.sim else 'cws_boot.txt'
+  uplink = UPLINK(host, int(port), args.station or socket.gethostname(),
+                  boot_file=UPLINK_BOOT_FILE)
+
 # Keep historical average consumption rate of water
 # weight previous 24 hrs consumption heavier than prior day's rate.
 # keep updated "empty time prediction" based on each updated reading
@@ -81,42 +358,403 @@ BUCKET_RADIUS_CM = (10.75 / 2) * 2.54
 
 status = {}
 
-# create initial display
+# The sensors are read concurrently. The rangers only collect echo times;
+# they are converted to distances once the BME280 temperature is in. Their
+# adaptive convergence check uses the last good temperature.
+BME_MISSING = {'temp': None, 'pressure': None, 'humidity': None}
+last_temp_C = 20
+
+# the virtual clock cannot overlap reads, so simulation reads them in turn
+# unless asked otherwise (cws_benchmark.py times the thread pool that way)
+acquisition = None
+if acq_process is None:
+  acq_workers = args.acq_workers
+  if acq_workers is None:
+    acq_workers = 0 if args.sim else 8
+  acquisition = ACQUISITION(max_workers=acq_workers)
+  acquisition.add_sensor('bme', temp_sensor.read, timeout=2)
+  acquisition.add_sensor('echos', lambda: rangers.get_echos(last_temp_C, adaptive=True), timeout=5)
+  acquisition.add_sensor('hall', water_out_sensor.state, timeout=1)
+
+#-------------------------------------------------------------------------------
+
+def acquire_local():
+  # read the sensors in this process, the same readings as
+  # ACQUISITION_PROCESS.acquire() returns
+  readings = acquisition.acquire()
+  temp_C = last_temp_C if readings['bme'] is None else readings['bme']['temp']
+  if readings['echos'] is None:
+    readings['ranges'] = [HC_SR04.ECHO_TIMEOUT] * len(rangers)
+  else:
+    readings['ranges'] = rangers.echos_to_distances(readings['echos'], temp_C)
+  readings['hall_events'] = water_out_sensor.snapshot()
+  return readings
+
+#-------------------------------------------------------------------------------
+
+def bucket_level(range_cm):
+  # water height and volume of the bucket(s) under one ranger
+  if range_cm == HC_SR04.ECHO_TIMEOUT:
+    return {'range': range_cm, 'height': None, 'volume': None}
+  water_height = WATER_LEVEL_EMPTY_DISTANCE_CM - range_cm
+  if water_height < 0:
+    water_height = 0.01
+  return {'range': range_cm, 'height': water_height, 'volume': volume_table.volume(water_height)}
+
+#-------------------------------------------------------------------------------
+
+def system_level(buckets):
+  # The system volume is the sum of the buckets', its range and height the
+  # mean level. Without a valid echo from every ranger it is not known.
+  if any(bucket['height'] is None for bucket in buckets):
+    return {'range': HC_SR04.ECHO_TIMEOUT, 'height': None, 'volume': None}
+  return {
+    'range'  : sum(bucket['range'] for bucket in buckets) / len(buckets),
+    'height' : sum(bucket['height'] for bucket in buckets) / len(buckets),
+    'volume' : sum(bucket['volume'] for bucket in buckets),
+  }
+
+#-------------------------------------------------------------------------------
+
+def analyze(timestamp, volume):
+  # a refill must not count as (negative) consumption, so the estimator
+  # starts again from the new level once it is over
+  refill = refills.update(timestamp, volume)
+  if refills.refilling or refill is not None:
+    consumption.rebase()
+  else:
+    consumption.update(timestamp, volume)
+  return refill
+
+#-------------------------------------------------------------------------------
+
+def measure():
+  global last_temp_C, measure_cpu_seconds
+  cpu_start = time.process_time()
 
-while 1:
-  # set next update timestamp
-  next_update_timestamp = rtc.get_timestamp() + MEASUREMENT_INTERVAL_SECONDS
-  print('\n****** {} ******'.format(rtc))
   # update system status
-  status['time'] = rtc.get_date_time()
-  status['bme'] = temp_sensor.read() 
-  status['range'] = ranger.calc_distance( status['bme']['temp'] )
-  
+  status['timestamp'] = clock.get_timestamp()
+  status['time'] = clock.get_date_time()
+  status['restored'] = False
+
+  readings = acquire_local() if acq_process is None else acq_process.acquire()
+  if readings['bme'] is not None:
+    status['bme'] = readings['bme']
+    last_temp_C = readings['bme']['temp']
+  else:
+    status['bme'] = BME_MISSING
+  status['hall'] = readings['hall']
+  status['hall_events'] = readings['hall_events']
+  if readings['echos'] is not None and echo_stores is not None:
+    for store, echos in zip(echo_stores, readings['echos']):
+      store.append(status['timestamp'], last_temp_C, echos)
+
+  status['buckets'] = [bucket_level(range_cm) for range_cm in readings['ranges']]
+  status.update(system_level(status['buckets']))
+
+  analyze(status['timestamp'], status['volume'])
+  status['refilling'] = refills.refilling
+  status['estimates'] = consumption.estimate()
+  status['last_refill'] = refills.last_refill
+  alert_engine.evaluate(status)
+  status['alerts'] = alert_engine.active()
+
+  # when to measure next
+  scheduler.set_period(CYCLE_TASKS, sampling.update(status['timestamp'], status))
+  measure_cpu_seconds += time.process_time() - cpu_start
+
+#-------------------------------------------------------------------------------
+
+def check_level():
+  # between slow samples, is there activity the next measurement should
+  # not wait for? A level that has moved since the last measurement, or
+  # water out sensor transitions (with --acq-process they only show here).
+  if 'buckets' not in status or sampling.interval is None or \
+     sampling.interval <= LEVEL_CHECK_SECONDS:
+    return
+  if acq_process is None:
+    echos = rangers.get_echos(last_temp_C, max_echos=1)
+    ranges = rangers.echos_to_distances(echos, last_temp_C)
+    hall = water_out_sensor.snapshot(events=False)
+  else:
+    readings = acq_process.acquire(echos=1)
+    ranges = readings['ranges']
+    hall = readings['hall_events']
+
+  # a single ping has no outlier filter, so a range from past the bottom
+  # of the bucket is not taken for a move
+  moved = any(range_cm != HC_SR04.ECHO_TIMEOUT and bucket['range'] != HC_SR04.ECHO_TIMEOUT and
+              range_cm < WATER_LEVEL_EMPTY_DISTANCE_CM + LEVEL_CHECK_CM and
+              abs(range_cm - bucket['range']) > LEVEL_CHECK_CM
+              for range_cm, bucket in zip(ranges, status['buckets']))
+  last_hall = status.get('hall_events')
+  changed = hall is not None and last_hall is not None and \
+            (hall['on_count'], hall['off_count']) != (last_hall['on_count'], last_hall['off_count'])
+  if moved or changed:
+    scheduler.wake(CYCLE_TASKS)
+
+#-------------------------------------------------------------------------------
+
+def store():
   # write system status to database
-  
+  history.append( status['timestamp'], status['bme']['temp'],
+                  status['bme']['pressure'], status['bme']['humidity'],
+                  None if status['height'] is None else status['range'],
+                  status['volume'], status['hall'] )
+  if uplink is not None:
+    uplink.add(node_snapshot(status))
+
+#-------------------------------------------------------------------------------
+
+def display():
   # update display
+  # everything shown comes from this cycle's readings (the sensors' read
+  # caches), so the display matches what was logged and costs no I/O
+  print('\n****** {} ******'.format(time.strftime('%Y-%m-%d %H:%M:%S',
+                                                  time.localtime(status['timestamp']))))
+  print( temp_sensor if acq_process is None else format_reading(status['bme']) )
+  if status['height'] is None:
+    print('Water height = ---- (no valid echo)')
+  else:
+    print('Water height = {:.1f} cm   Volume = {:.2f} L'.format( status['height'], status['volume']))
+  if len(status['buckets']) > 1:
+    print('   '.join('Bucket {} = {}'.format(k + 1, '----' if bucket['volume'] is None else
+                     '{:.2f} L'.format(bucket['volume']))
+                     for k, bucket in enumerate(status['buckets'])))
+  estimates = status['estimates']
+  if estimates['rate'] is not None:
+    # the 7 d rate takes days to show up
+    print('Consumption = {:.2f} +/- {:.2f} L/day (1 h {}, 7 d {})'.format(
+          estimates['rate'], estimates['rate_error'],
+          *('----' if estimates['rates'][name] is None else
+            '{:.2f}'.format(estimates['rates'][name]) for name in ('1h', '7d'))))
+  if estimates['empty_time'] is not None:
+    print('Empty at {}  (earliest {}, latest {})'.format(
+          time.strftime('%a %d %b %H:%M', time.localtime(estimates['empty_time'])),
+          time.strftime('%a %d %b %H:%M', time.localtime(estimates['empty_early'])),
+          'never' if estimates['empty_late'] is None else
+          time.strftime('%a %d %b %H:%M', time.localtime(estimates['empty_late']))))
+  if status['last_refill'] is not None:
+    print('Last refill {}: {:.1f} L'.format(
+          time.strftime('%a %d %b %H:%M', time.localtime(status['last_refill']['start'])),
+          status['last_refill']['liters']))
+  if acq_process is None:
+    print( water_out_sensor )
+  elif status['hall_events'] is None:
+    print( format_state(None) )
+  else:
+    print( format_state(status['hall'], status['hall_events']['on_count'],
+                        status['hall_events']['off_count']) )
+  for alert in status['alerts']:
+    print('ALERT {} {} since {}'.format(alert['severity'].upper(), alert['rule'],
+          time.strftime('%a %d %b %H:%M', time.localtime(alert['since']))))
+
+#-------------------------------------------------------------------------------
+
+def status_snapshot():
+  # the status without the analytics
+  return {k: v for k, v in status.items() if k not in ('estimates', 'last_refill')}
+
+#-------------------------------------------------------------------------------
+
+def publish():
+  # hand the status server this cycle's snapshots
+  estimates = dict(status['estimates'])
+  estimates['last_refill'] = status['last_refill']
+  status_server.publish({'/status': status_snapshot(), '/estimates': estimates})
+  if startup['first_publish_seconds'] is None:
+    startup['first_publish_seconds'] = time.perf_counter() - START_TIME
+
+#-------------------------------------------------------------------------------
+
+HISTORY_PUBLISH_SECONDS = 300
+HISTORY_PUBLISH_DAYS = 7
+HISTORY_PUBLISH_WIDTH = 800   # plot width in pixels, picks the rollup tier
+
+def publish_history():
+  # the capacity versus time plot data, as rows to keep the JSON small
+  now = clock.get_timestamp()
+  buckets = history.query_rollup(now - HISTORY_PUBLISH_DAYS * 86400, now,
+                                 width=HISTORY_PUBLISH_WIDTH)
+  fields = ('time', 'volume_min', 'volume_max', 'volume', 'temp_min', 'temp_max', 'temp')
+  status_server.publish({'/history': {
+    'fields' : fields,
+    'rows'   : [[b[f] for f in fields] for b in buckets],
+  }})
+
+#-------------------------------------------------------------------------------
+
+def save_checkpoint():
+  # the history is flushed first, so a restart replays everything after
+  # the checkpoint time that made it to disk
+  if 'timestamp' not in status:
+    return
+  history.flush()
+  checkpoint.save({
+    'time'        : status['timestamp'],
+    'consumption' : consumption.get_state(),
+    'refills'     : refills.get_state(),
+    'alerts'      : alert_engine.get_state(),
+    'status'      : status_snapshot(),
+  })
+
+#-------------------------------------------------------------------------------
+
+def stored_status(reading):
+  # a stored history reading as a status
+  bme = {k: None if math.isnan(reading[k]) else reading[k]
+         for k in ('temp', 'pressure', 'humidity')}
+  if math.isnan(reading['range']):
+    height = None
+  else:
+    height = max(WATER_LEVEL_EMPTY_DISTANCE_CM - reading['range'], 0.01)
+  return {
+    'timestamp'   : reading['time'],
+    'time'        : date_time(reading['time']),
+    'bme'         : bme,
+    'hall'        : reading['hall'],
+    'hall_events' : None,
+    'buckets'     : [],   # only the system level is stored
+    'range'       : HC_SR04.ECHO_TIMEOUT if height is None else reading['range'],
+    'height'      : height,
+    'volume'      : None if height is None or math.isnan(reading['volume']) else reading['volume'],
+  }
+
+#-------------------------------------------------------------------------------
+
+def restore():
+  # Restore the analytics from the checkpoint, and replay the history stored
+  # after it, which is a bisect to the tail of the history. Without a
+  # checkpoint the consumption estimator is warmed up from the last week of
+  # history instead. The newer of the checkpoint's status and the last
+  # stored reading is the status until the first measurement.
+  now = clock.get_timestamp()
+  state = checkpoint.load()
+  restored = None
+  if state is not None and state['time'] <= now:
+    consumption.set_state(state['consumption'])
+    refills.set_state(state['refills'])
+    alert_engine.set_state(state.get('alerts', {}))
+    restored = state['status']
+    # the readings, not the runs, so the refill detector's median filter
+    # sees the same stream it would have live
+    for reading in history.query(state['time'], now):
+      if reading['time'] > state['time']:
+        analyze(reading['time'], reading['volume'])
+        startup['replayed'] += 1
+    startup['source'] = 'checkpoint'
+  else:
+    consumption.prime(history, now)
+    startup['source'] = 'history'
+
+  last = history.last()
+  if last is not None and (restored is None or last['time'] > restored['timestamp']):
+    restored = stored_status(last)
+  if restored is None:
+    return
+  status.update(restored)
+  status['restored'] = True
+  status['refilling'] = refills.refilling
+  status['estimates'] = consumption.estimate()
+  status['last_refill'] = refills.last_refill
+  status['alerts'] = alert_engine.active()
+
+startup = {'source': None, 'replayed': 0, 'restore_seconds': None,
+           'first_publish_seconds': None}
+restore_start = time.perf_counter()
+restore()
+startup['restore_seconds'] = time.perf_counter() - restore_start
+print('Restored from {} ({} readings replayed) in {:.1f} ms'.format(
+      startup['source'], startup['replayed'], startup['restore_seconds'] * 1000))
+
+#-------------------------------------------------------------------------------
+
+# the status LED blinks on its own while the scheduler sleeps between tasks,
+# faster while there are alerts
+led_sink.show({alert['rule']: alert['severity'] for alert in alert_engine.active()})
+
+# in simulation the scheduler sleeps on the virtual clock
+scheduler = SCHEDULER(sim_hw.world.clock.wait if args.sim else None)
+scheduler.add_task('measure', MEASUREMENT_INTERVAL_SECONDS, measure)
+if args.sampling != 'fixed':
+  scheduler.add_task('check', LEVEL_CHECK_SECONDS, check_level, LEVEL_CHECK_SECONDS)
+  if water_out_sensor is not None:
+    water_out_sensor.on_edge = lambda: scheduler.wake(CYCLE_TASKS)
+scheduler.add_task('store', MEASUREMENT_INTERVAL_SECONDS, store, REPORT_OFFSET_SECONDS)
+if not args.quiet:
+  scheduler.add_task('display', MEASUREMENT_INTERVAL_SECONDS, display, REPORT_OFFSET_SECONDS)
+
+if args.status_port != 0:
+  status_server = STATUS_SERVER(args.status_port, args.status_addr,
+                                max_age=MEASUREMENT_INTERVAL_SECONDS)
+  scheduler.add_task('publish', MEASUREMENT_INTERVAL_SECONDS, publish, REPORT_OFFSET_SECONDS)
+  scheduler.add_task('history', HISTORY_PUBLISH_SECONDS, publish_history, REPORT_OFFSET_SECONDS)
+  # the restored status is served right away, not after the first cycle
+  if 'timestamp' in status:
+    publish()
+
+METRICS_FILE_INTERVAL_SECONDS = 60
+if args.metrics_file is not None:
+  scheduler.add_task('metrics', METRICS_FILE_INTERVAL_SECONDS,
+                     lambda: metrics.registry.write_textfile(args.metrics_file),
+                     REPORT_OFFSET_SECONDS)
+if METRICS_ENABLED:
+  metrics.add_scheduler(scheduler)
+if args.metrics_port is not None:
+  metrics.registry.serve(args.metrics_port)
+
+scheduler.add_task('checkpoint', CHECKPOINT_SECONDS, save_checkpoint, REPORT_OFFSET_SECONDS)
+
+try:
+  scheduler.run(args.duration)
+except KeyboardInterrupt:
+  pass
+
+alert_notifier.close()
+if uplink is not None:
+  uplink.close()
+status_led.stop_blink()
+if acq_process is not None:
+  acq_process.close()
+if args.status_port != 0:
+  status_server.close()
+save_checkpoint()
+history.close()
+if echo_stores is not None:
+  for store in echo_stores:
+    store.close()
+for name, stats in scheduler.stats().items():
+  print('{}: {}'.format(name, stats))
+caches = {'rtc': rtc.cache.stats()}
+if acq_process is None:
+  caches['bme'] = temp_sensor.cache.stats()
+  caches['hall'] = water_out_sensor.cache.stats()
+  acquisition_stats = acquisition.stats()
+  usage = {'pings': rangers.pings, 'bme_reads': temp_sensor.cache.misses}
+  print('rangers: {}'.format(rangers.stats()))
+else:
+  acquisition_stats = acq_process.stats()
+  usage = {'pings': acquisition_stats['pings'], 'bme_reads': acquisition_stats['bme_reads']}
+  measure_cpu_seconds += acquisition_stats['cpu_seconds']
+  print('acquisition process: {}'.format(acquisition_stats))
+for name, stats in caches.items():
+  print('{} cache: {}'.format(name, stats))
+sampling_report = sampling.report(MEASUREMENT_INTERVAL_SECONDS, usage, measure_cpu_seconds)
+print('sampling: {} samples, {} at a fixed {} s, {:.0%} saved'.format(
+      sampling_report['samples'], sampling_report['fixed_samples'],
+      MEASUREMENT_INTERVAL_SECONDS, sampling_report['saved']))
+print('sampling: {}'.format(sampling.stats()['intervals']))
+print('startup: {}'.format(startup))
+print('alerts: {}'.format(alert_engine.stats()))
+if uplink is not None:
+  print('uplink: {}'.format(uplink.stats()))
+
+if args.stats_json is not None:
+  with open(args.stats_json, 'w') as f:
+    json.dump({'scheduler': scheduler.stats(), 'acquisition': acquisition_stats,
+               'caches': caches, 'sampling': sampling_report, 'startup': startup,
+               'alerts': alert_engine.stats()}, f, indent=2)
 
-  print( temp_sensor )
-  water_height = WATER_LEVEL_EMPTY_DISTANCE_CM - status['range']
-  if water_height < 0:
-    water_height = 0.01
-  water_volume = water_height * BUCKET_RADIUS_CM * BUCKET_RADIUS_CM * 3.1415927 / 1000  
-  print('Water height = {:.1f} cm   Volume = {:.2f} L'.format( water_height, water_volume))
-  print( water_out_sensor )
-  
-  # go into sleep mode until next update is needed
-
-  skip = False
-  while next_update_timestamp > rtc.get_timestamp():
-    skip = True if not skip else False
-    if not skip:
-        status_led.toggle()
-        time.sleep(0.05)
-        status_led.toggle()
-        time.sleep(0.95)
-    else:
-        time.sleep(1)
-    
 
 '''#-------------------------------------------------------------------------------
 # Initial thoughts and todo list while prototyping
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+#  Filename: echo_store.py
+#
+#  Description: Append-only store of the raw HC-SR04 echo durations behind
+#             every range measurement, so the history can be recomputed when
+#             the calibration changes (speed of sound, tank geometry). See
+#             reprocess_echoes.py.
+#
+#             Every record is one measurement, fixed width, little endian,
+#             laid out so NumPy can map it straight from the file
+#             (ECHO_DTYPE):
+#
+#                 time     float64   (seconds since the epoch)
+#                 temp     float32   (C, the temperature used for the range)
+#                 count    uint8     (number of valid echoes)
+#                 pad      3 bytes
+#                 echo     10 x uint32 (echo durations in ns, unused = 0)
+#
+#             Records go to numbered segment files (*.echo) in a directory,
+#             each with the same small header as the TS_STORE segments
+#             (magic, version, record size). Appends are buffered and written
+#             in batches of batch_size, with the same fsync policies as
+#             TS_STORE.
+#
+#  Author: Greg Kraus
+#
+#  History:
+#    20261018 - initial creation
+#
+#-------------------------------------------------------------------------------
+
+import math
+import os
+import struct
+
+from ts_store import HEADER, FSYNC_POLICIES
+
+FILE_MAGIC = b'CWSE'
+FILE_VERSION = 1
+MAX_ECHOS = 10
+RECORD = struct.Struct('<dfB3x{}I'.format(MAX_ECHOS))
+
+# the same layout as a NumPy dtype, for reprocess_echoes.py
+ECHO_DTYPE = [('time', '<f8'), ('temp', '<f4'), ('count', 'u1'), ('pad', 'u1', 3),
+              ('echo', '<u4', MAX_ECHOS)]
+
+class ECHO_STORE:
+  def __init__(self, path, batch_size=6, fsync='flush', segment_records=100000):
+    if fsync not in FSYNC_POLICIES:
+      raise ValueError('fsync policy must be one of {}'.format(FSYNC_POLICIES))
+
+    self.path = path
+    self.batch_size = 1 if fsync == 'always' else batch_size
+    self.fsync = fsync
+    self.segment_records = segment_records
+    self.buffer = []
+    self.file = None
+    self.file_count = 0   # records in the open segment
+
+    os.makedirs(self.path, exist_ok=True)
+
+  #-------------------------------------
+
+  def __del__(self):
+    self.close()
+
+  #-------------------------------------
+
+  def segments(self):
+    # segment file names, oldest first
+    return sorted(n for n in os.listdir(self.path) if n.endswith('.echo'))
+
+  #-------------------------------------
+
+  def append(self, timestamp, temp_C, t_ns):
+    # t_ns is the list of valid echo durations from HC_SR04.get_echos()
+    t_ns = [int(t) for t in t_ns[:MAX_ECHOS]]
+    echos = t_ns + [0] * (MAX_ECHOS - len(t_ns))
+    temp = math.nan if temp_C is None else temp_C
+    self.buffer.append(RECORD.pack(timestamp, temp, len(t_ns), *echos))
+    if len(self.buffer) >= self.batch_size:
+      self.flush()
+
+  #-------------------------------------
+
+  def flush(self):
+    while len(self.buffer) > 0:
+      if self.file is None or self.file_count >= self.segment_records:
+        self.open_segment()
+
+      room = self.segment_records - self.file_count
+      batch = self.buffer[:room]
+      self.buffer = self.buffer[room:]
+
+      self.file.write(b''.join(batch))
+      self.file.flush()
+      if self.fsync != 'never':
+        os.fsync(self.file.fileno())
+      self.file_count += len(batch)
+
+  #-------------------------------------
+
+  def open_segment(self):
+    # carry on in the newest segment if it still has room, e.g. after a
+    # restart, otherwise start the next one
+    names = self.segments()
+    if self.file is None and len(names) > 0:
+      name = os.path.join(self.path, names[-1])
+      count = (os.path.getsize(name) - HEADER.size) // RECORD.size
+      if count < self.segment_records:
+        self.file = open(name, 'ab')
+        self.file.truncate(HEADER.size + count * RECORD.size)  # torn tail
+        self.file_count = count
+        return
+
+    if self.file is not None:
+      self.file.close()
+
+    number = 1
+    if len(names) > 0:
+      number = int(names[-1].split('.')[0]) + 1
+    self.file = open(os.path.join(self.path, '{:08d}.echo'.format(number)), 'ab')
+    self.file.write(HEADER.pack(FILE_MAGIC, FILE_VERSION, RECORD.size))
+    self.file_count = 0
+
+  #-------------------------------------
+
+  def close(self):
+    if len(self.buffer) > 0:
+      self.flush()
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+  #-------------------------------------
+
+  def segment_data(self, name):
+    # the whole records of one segment as bytes
+    with open(os.path.join(self.path, name), 'rb') as f:
+      magic, version, rec_size = HEADER.unpack(f.read(HEADER.size))
+      if magic != FILE_MAGIC or version != FILE_VERSION or rec_size != RECORD.size:
+        raise ValueError('{} is not a version {} CWS echo segment'.format(name, FILE_VERSION))
+      data = f.read()
+    return data[:len(data) - len(data) % RECORD.size]
+
+  #-------------------------------------
+
+  def records(self):
+    # every stored measurement as (time, temp, list of echo ns), oldest first
+    for name in self.segments():
+      for rec in RECORD.iter_unpack(self.segment_data(name)):
+        yield rec[0], rec[1], list(rec[3:3 + rec[2]])
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  import shutil
+  import time
+
+  print('ECHO_STORE class test example')
+  path = 'test_echo_store'
+  shutil.rmtree(path, ignore_errors=True)
+
+  store = ECHO_STORE(path, fsync='never', segment_records=100)
+  t0 = time.time()
+  for ii in range(250):
+    store.append(t0 + ii * 10, 20.0, [1000000 + jj for jj in range(ii % 11)])
+  store.close()
+
+  print('segments: {}'.format(store.segments()))
+  for rec in list(store.records())[:3]:
+    print(rec)
+  shutil.rmtree(path)
@@ -24,47 +24,209 @@
 #           Pin3 will be connected to the GPIO pin. Just be sure to configure 
 #           the GPIO pin with the Pull-up feature enabled.  
 #
+#           state() goes through a READ_CACHE with a ttl (default 0, always
+#           read the pin). str() shows the last state read, and does not read
+#           the pin.
+#
+#           With edge_detect=True the sensor is event driven instead: a GPIO
+#           edge callback timestamps every ON/OFF transition, so brief magnet
+#           events between measurement cycles are not missed, and nothing
+#           polls the pin. state() then returns the tracked level without
+#           reading the pin.
+#
+#           Debounce is done in software: a new level only counts once it
+#           has held for debounce_ms, which the next edge (or the next
+#           snapshot() or state() call) shows. It keeps the time of the edge
+#           that started it, so transitions are timed to the millisecond.
+#           Pulses shorter than debounce_ms are counted as bounces.
+#
+#           Transitions go into a fixed size ring buffer (time.time()
+#           timestamps, pin level). The event count is only bumped after the
+#           slot is written, so readers of the ring never take a lock. The
+#           writers (the edge callback, and the settle in snapshot() and
+#           state()) share a lock. snapshot() returns the counts and the transitions since the
+#           previous snapshot, and how many of those the ring overwrote.
+#           snapshot(events=False) only looks, and leaves the transitions
+#           for the next snapshot.
+#
+#           on_edge, if set, is called after every edge that may change the
+#           level, before it is debounced, from the GPIO callback thread.
+#           It is for waking something up (SCHEDULER.wake()), so it should
+#           be quick.
+#
 # Author: Greg Kraus
 # History: 20230512 Initial creation
+#          20261018 Read cache, str() no longer reads the pin
+#          20261018 Edge detect mode with debounce and event ring buffer
+#          20261018 format_state() for states from elsewhere
+#          20261018 on_edge hook, snapshot() without taking the events
 #
 #-------------------------------------------------------------------------------
 
+import sys
+import threading
 import time
 import RPi.GPIO as GPIO
+from read_cache import READ_CACHE
 
 class HALL_SENSOR:
-  def __init__( self, sensor_pin ):
+  def __init__( self, sensor_pin, ttl=0, edge_detect=False, debounce_ms=20, ring_size=256 ):
     self.sensor_pin = sensor_pin
+    self.cache = READ_CACHE(ttl)
+    self.edge_detect = edge_detect
+    self.on_edge = None
     GPIO.setup(self.sensor_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
+    if self.edge_detect:
+      self.debounce_ns = int(debounce_ms * 1000000)
+      self.ring_size = ring_size
+      self.ring_time = [0.0] * ring_size
+      self.ring_level = [0] * ring_size
+      self.seq = 0            # transitions recorded so far
+      self.read_seq = 0       # transitions already returned by snapshot()
+      self.on_count = 0
+      self.off_count = 0
+      self.bounces = 0        # edges ignored by the debounce
+      self.write_lock = threading.Lock()
+      self.level = GPIO.input( self.sensor_pin )
+      self.pending = None     # (level, time, monotonic ns) not yet debounced
+      self.cache.put(self.level)
+      GPIO.add_event_detect( self.sensor_pin, GPIO.BOTH, callback=self.hall_edge )
+
   #------------------------------------
 
   def __del__(self):
+    if self.edge_detect:
+      GPIO.remove_event_detect( self.sensor_pin )
     GPIO.cleanup( self.sensor_pin )
 
   #------------------------------------
 
   def __str__(self):
-    state = self.state()
-    return "Hall Sensor: {}".format("OFF" if state == GPIO.HIGH else "ON")
+    if self.edge_detect:
+      return format_state(self.cache.last(), self.on_count, self.off_count)
+    return format_state(self.cache.last())
   
   #-------------------------------------
   
   def state( self ):
-    return GPIO.input( self.sensor_pin )
+    if self.edge_detect:
+      with self.write_lock:
+        self.settle(time.monotonic_ns())
+      return self.level
+    state = self.cache.get()
+    if state is None:
+      state = GPIO.input( self.sensor_pin )
+      self.cache.put(state)
+    return state
+
+  #-------------------------------------
+
+  def hall_edge( self, channel ):
+    # GPIO edge callback. A new level is only pending until it has held for
+    # debounce_ms, shown by the next edge coming later than that (or by
+    # settle()). A level that bounces back sooner is dropped.
+    now_ns = time.monotonic_ns()
+    level = GPIO.input( self.sensor_pin )
+    with self.write_lock:
+      self.settle(now_ns)
+      if self.pending is not None:
+        self.bounces += 1
+      if level != self.level:
+        self.pending = (level, time.time(), now_ns)
+      else:
+        self.pending = None
+    if level != self.level and self.on_edge is not None:
+      self.on_edge()
+
+  #-------------------------------------
+
+  def settle( self, now_ns ):
+    # record the pending transition if it has held long enough.
+    # Called with write_lock held.
+    if self.pending is None or now_ns - self.pending[2] < self.debounce_ns:
+      return
+    level, timestamp, edge_ns = self.pending
+    self.pending = None
+    if level == self.level:
+      return
+
+    slot = self.seq % self.ring_size
+    self.ring_time[slot] = timestamp
+    self.ring_level[slot] = level
+    self.seq += 1   # publish the slot
+
+    self.level = level
+    if level == GPIO.HIGH:
+      self.off_count += 1
+    else:
+      self.on_count += 1
+    self.cache.put(level)
+
+  #-------------------------------------
+
+  def events_since( self, seq ):
+    # transitions recorded after the first seq, as (time, level) pairs,
+    # and the number of them that were already overwritten
+    end = self.seq
+    start = max(seq, end - self.ring_size)
+    events = [(self.ring_time[ii % self.ring_size], self.ring_level[ii % self.ring_size])
+              for ii in range(start, end)]
+    # slots the callback overwrote while we were copying
+    overwritten = max(self.seq - self.ring_size - start, 0)
+    return events[overwritten:], (start - seq) + overwritten
+
+  #-------------------------------------
+
+  def snapshot( self, events=True ):
+    # state of an edge detect sensor for this cycle's status
+    with self.write_lock:
+      now_ns = time.monotonic_ns()
+      self.settle(now_ns)
+      if self.pending is None and GPIO.input( self.sensor_pin ) != self.level:
+        # an edge the GPIO layer never reported
+        self.pending = (1 - self.level, time.time(), now_ns - self.debounce_ns)
+        self.settle(now_ns)
+
+    transitions, lost = [], 0
+    if events:
+      transitions, lost = self.events_since(self.read_seq)
+      self.read_seq += len(transitions) + lost
+    return {
+      'state'     : self.level,
+      'on_count'  : self.on_count,
+      'off_count' : self.off_count,
+      'bounces'   : self.bounces,
+      'events'    : transitions,
+      'lost'      : lost,
+    }
     
 #-------------------------------------------------------------------------------
 
+def format_state(state, on_count=None, off_count=None):
+  # a pin state (and edge counts) as text
+  if state is None:
+    return "Hall Sensor: ----"
+  ss = "Hall Sensor: {}".format("OFF" if state == GPIO.HIGH else "ON")
+  if on_count is not None:
+    ss += "   (ON {}x, OFF {}x)".format(on_count, off_count)
+  return ss
+
+#-------------------------------------------------------------------------------
+
 if __name__ == '__main__':
   GPIO.setwarnings(False)
   GPIO.setmode(GPIO.BCM)
 
   HALL_PIN = 21
-  sensor = HALL_SENSOR( HALL_PIN )
+  sensor = HALL_SENSOR( HALL_PIN, edge_detect=('--edge' in sys.argv) )
   
   try:
     while 1:
+        sensor.state()
         print(sensor)
+        if sensor.edge_detect:
+          print(sensor.snapshot()['events'])
         time.sleep(1)
   except KeyboardInterrupt:
     pass
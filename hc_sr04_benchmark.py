@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+#  Filename: hc_sr04_benchmark.py
+#
+#  Description: Compares the CPU cost of the two HC_SR04 echo timing modes.
+#             For each mode a number of calc_distance() measurements are made
+#             and the CPU seconds (process time, so the RPi.GPIO event thread
+#             is included) and wall seconds per measurement are reported,
+#             along with the number of echo timeouts seen. The mean distance
+#             is of the measurements that got a valid echo; the ones that
+#             did not (ECHO_TIMEOUT) are left out and counted.
+#
+#             Usage:
+#               ./hc_sr04_benchmark.py [--count N] [--mode poll|edge|both]
+#                                      [--adaptive]
+#
+#  Author: Greg Kraus
+#
+#  History:
+#    20261018 - initial creation
+#    20261018 - mean distance leaves out measurements with no echo
+#
+#-------------------------------------------------------------------------------
+
+import argparse
+import time
+import RPi.GPIO as GPIO
+from hc_sr04_sensor import HC_SR04
+
+TRIG_PIN = 23
+ECHO_PIN = 24
+
+#-------------------------------------------------------------------------------
+
+def run_mode(edge_detect, count, adaptive=False):
+  sensor = HC_SR04(TRIG_PIN, ECHO_PIN, edge_detect)
+
+  cpu_start = time.process_time()
+  wall_start = time.monotonic()
+  distances = []
+  for ii in range(count):
+    distances.append( sensor.calc_distance(adaptive=adaptive) )
+  cpu_sec = time.process_time() - cpu_start
+  wall_sec = time.monotonic() - wall_start
+  valid = [d for d in distances if d != sensor.ECHO_TIMEOUT]
+
+  result = {
+    'mode'         : 'edge' if edge_detect else 'poll',
+    'measurements' : count,
+    'cpu_sec'      : cpu_sec / count,
+    'wall_sec'     : wall_sec / count,
+    'timeouts'     : sensor.timeouts,
+    'distance_cm'  : sum(valid) / len(valid) if len(valid) > 0 else None,
+    'excluded'     : count - len(valid),
+  }
+
+  del sensor
+  return result
+
+#-------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='HC-SR04 echo timing benchmark')
+  parser.add_argument('--count', type=int, default=10,
+                      help='calc_distance() measurements per mode')
+  parser.add_argument('--mode', choices=['poll', 'edge', 'both'], default='both')
+  parser.add_argument('--adaptive', action='store_true',
+                      help='use adaptive (early stopping) calc_distance()')
+  args = parser.parse_args()
+
+  GPIO.setwarnings(False)
+  GPIO.setmode(GPIO.BCM)  # use BCM pin numbers
+
+  modes = [False, True] if args.mode == 'both' else [args.mode == 'edge']
+  results = [run_mode(edge_detect, args.count, args.adaptive) for edge_detect in modes]
+
+  print('{:>6} {:>14} {:>14} {:>9} {:>12} {:>9}'.format(
+        'mode', 'cpu s/meas', 'wall s/meas', 'timeouts', 'distance cm', 'excluded'))
+  for r in results:
+    distance = '-' if r['distance_cm'] is None else '{:.2f}'.format(r['distance_cm'])
+    print('{:>6} {:>14.4f} {:>14.4f} {:>9} {:>12} {:>9}'.format(
+          r['mode'], r['cpu_sec'], r['wall_sec'], r['timeouts'], distance, r['excluded']))
+
+  if len(results) == 2 and results[1]['cpu_sec'] > 0:
+    print('poll/edge CPU ratio: {:.1f}x'.format(results[0]['cpu_sec'] / results[1]['cpu_sec']))
+
+  GPIO.cleanup()
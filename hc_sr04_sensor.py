@@ -8,64 +8,177 @@
 #             main command to use is the calc_distance() function. All other
 #             class functions support this function.
 #
+#             Echo pulses can be timed in one of two ways:
+#               * polling (default) - spin on GPIO.input() until the echo
+#                 pin changes state. Accurate, but keeps a CPU core at 100%
+#                 for the whole echo window.
+#               * edge detect (edge_detect=True) - RPi.GPIO edge detection
+#                 timestamps the rising and falling edges of the echo pulse
+#                 from its event thread, and get_echo() simply waits for
+#                 both edges to arrive (or for the timeout to expire).
+#
+#             In both modes get_echo() returns ECHO_TIMEOUT (-1) if the echo
+#             pulse never started or never stopped.
+#
+#             Only echoes between metrics.ECHO_MIN_NS and ECHO_MAX_NS (2 cm
+#             to 400 cm) are kept. The sensor's ~38 ms "no object" pulse
+#             (about 650 cm) comes back as an echo, and is dropped with the
+#             timeouts. The distance is the median of the kept echoes, so a
+#             minority of wild ones cannot move it.
+#
+#             calc_distance() can also run in adaptive mode, where it stops
+#             pinging as soon as the median of the echoes taken so far has
+#             settled within a tolerance, instead of always taking 10.
+#
+#             The sensor needs READY_SECONDS after its pins are set up before
+#             the first ping. __init__() does not wait for it; the first
+#             get_echo() waits for whatever is left of it, so the rest of the
+#             start up runs in the meantime.
+#
 #  Author: Greg Kraus, gkraus@luf.co
 #
 #  History:
 #    20230507 - initial creation
+#    20261018 - edge detect echo timing mode, real echo timeouts
+#    20261018 - adaptive calc_distance(), drop timed out echoes
+#    20261018 - count pings
+#    20261018 - wait for the sensor to be ready at the first ping, not in __init__
+#    20261018 - drop out of range echoes, median and MAD estimate
 #
 #-------------------------------------------------------------------------------
 
 import os
 import sys
 import time
+import threading
 import RPi.GPIO as GPIO
+from metrics import ECHO_MIN_NS, ECHO_MAX_NS
 
 class HC_SR04:
-  def __init__(self, trig_pin, echo_pin):
+  ECHO_TIMEOUT = -1  # get_echo() result when no valid echo was measured
+  ECHO_INTERVAL = 0.25  # seconds between consecutive pings
+  READY_SECONDS = 0.2   # from pin setup to the first ping
+
+  def __init__(self, trig_pin, echo_pin, edge_detect=False):
     self.trig_pin = trig_pin
     self.echo_pin = echo_pin
+    self.edge_detect = edge_detect
+    self.timeouts = 0  # number of echoes that timed out
+    self.pings = 0     # number of trigger pulses sent (sensor wear)
+
+    # edge detect state - filled in by echo_edge() from the GPIO event thread
+    self.echo_armed = False
+    self.edge_times = []
+    self.echo_done = threading.Event()
 
     # GPIO.setmode(GPIO.BCM) # This should be set in main python module at init time
     GPIO.setup(self.trig_pin, GPIO.OUT, initial=GPIO.LOW)
     GPIO.setup(self.echo_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
-    time.sleep( 0.2 ) # allow device to initialize
+    if self.edge_detect:
+      GPIO.add_event_detect(self.echo_pin, GPIO.BOTH, callback=self.echo_edge)
+
+    # allow device to initialize, see wait_ready()
+    self.ready_time = time.monotonic() + self.READY_SECONDS
 
 #----------------------------------------------------------
 
   def __del__(self):
+    if self.edge_detect:
+      GPIO.remove_event_detect( self.echo_pin )
     GPIO.cleanup( self.echo_pin )
     GPIO.cleanup( self.trig_pin )
 
+#----------------------------------------------------------
+
+  def wait_ready(self):
+    if self.ready_time is not None:
+      delay = self.ready_time - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+      self.ready_time = None
+
 #----------------------------------------------------------
 
   def get_echo(self):
-    # reset echo measurement times
-    echo_start = 0
-    echo_stop = 0
+    self.wait_ready()
+    if self.edge_detect:
+      return self.get_echo_edge()
 
     # make sure ECHO_PIN is LOW before starting
-    self.gpio_wait_until( self.echo_pin, GPIO.LOW, 0.5)
+    if not self.gpio_wait_until( self.echo_pin, GPIO.LOW, 0.5):
+      return self.echo_timeout()
 
-    # issue trigger pulse (10 microseconds)
-    GPIO.output(self.trig_pin, GPIO.HIGH)
-    time.sleep(0.00001)
-    GPIO.output(self.trig_pin, GPIO.LOW)
+    self.trigger()
 
     # look for echo pulse to START
-    self.gpio_wait_until( self.echo_pin, GPIO.HIGH, 0.5)
+    if not self.gpio_wait_until( self.echo_pin, GPIO.HIGH, 0.5):
+      return self.echo_timeout()
     echo_start = time.monotonic_ns()
 
     # look for echo pulse to STOP
-    self.gpio_wait_until( self.echo_pin, GPIO.LOW, 0.5)
+    if not self.gpio_wait_until( self.echo_pin, GPIO.LOW, 0.5):
+      return self.echo_timeout()
     echo_stop = time.monotonic_ns()
 
-    # check for timeouts
-    if echo_stop == -1 or echo_start == -1:
-      return -1 # no valid reading obtained
-
     return echo_stop - echo_start # echo pulse duration in nanoseconds
 
+#----------------------------------------------------------
+
+  def get_echo_edge(self):
+    # make sure ECHO_PIN is LOW before starting. This is rare enough
+    # that a sleeping poll is fine - no need to spin here.
+    timeout = time.monotonic() + 0.5
+    while GPIO.input(self.echo_pin) != GPIO.LOW:
+      if time.monotonic() > timeout:
+        return self.echo_timeout()
+      time.sleep(0.001)
+
+    # arm the edge callback, then trigger
+    self.edge_times = []
+    self.echo_done.clear()
+    self.echo_armed = True
+
+    self.trigger()
+
+    # sleep until echo_edge() has seen both the rising and falling edge
+    got_echo = self.echo_done.wait(0.5)
+    self.echo_armed = False
+    if not got_echo:
+      return self.echo_timeout()
+
+    return self.edge_times[1] - self.edge_times[0] # echo pulse duration in nanoseconds
+
+#----------------------------------------------------------
+
+  def echo_edge(self, channel):
+    # called from the RPi.GPIO event thread on every echo pin edge.
+    # Take the timestamp first so it is as close to the edge as possible.
+    t_ns = time.monotonic_ns()
+    if not self.echo_armed:
+      return
+
+    # the echo pin is LOW when the trigger is issued, so the first edge
+    # is the start of the echo pulse and the second edge is the end
+    self.edge_times.append(t_ns)
+    if len(self.edge_times) == 2:
+      self.echo_done.set()
+
+#----------------------------------------------------------
+
+  def trigger(self):
+    # issue trigger pulse (10 microseconds)
+    self.pings += 1
+    GPIO.output(self.trig_pin, GPIO.HIGH)
+    time.sleep(0.00001)
+    GPIO.output(self.trig_pin, GPIO.LOW)
+
+#----------------------------------------------------------
+
+  def echo_timeout(self):
+    self.timeouts += 1
+    return self.ECHO_TIMEOUT # no valid reading obtained
+
 #----------------------------------------------------------
   
   def gpio_wait_until( self, pin, state, time_to_wait):
@@ -82,21 +195,79 @@ class HC_SR04:
   
 #----------------------------------------------------------
 
-  def calc_distance(self, temp_C=20):
-    time_ns = 0
-    num_echos = 10
+  def calc_distance(self, temp_C=20, adaptive=False, tolerance_cm=0.2,
+                    min_echos=4, max_echos=10):
+    # Fixed mode (default) always takes max_echos echoes. Adaptive mode
+    # stops as soon as min_echos valid echoes have been taken and the
+    # estimate has settled to within tolerance_cm (see echo_converged()).
+    # Timed out and out of range echoes are dropped in both modes.
+    t_ns = self.get_echos(temp_C, adaptive, tolerance_cm, min_echos, max_echos)
+    return self.echos_to_distance(t_ns, temp_C)
+
+#----------------------------------------------------------
+
+  def echos_to_distance(self, t_ns, temp_C=20):
+    # distance from a list of valid echo durations (see get_echos()). The
+    # echoes can be taken first and converted later, once temp_C is known.
+    t_ns = [t for t in t_ns if self.echo_valid(t)]
+    if len(t_ns) == 0:
+      return self.ECHO_TIMEOUT # no valid reading obtained
+
+    return self.echo_to_distance( self.echo_estimate(t_ns), temp_C )
+
+#----------------------------------------------------------
+
+  def get_echos(self, temp_C=20, adaptive=False, tolerance_cm=0.2,
+                min_echos=4, max_echos=10):
+    # returns the list of valid echo durations (nanoseconds)
     t_ns = []
-    for ii in range(0, num_echos):
-      t_ns.append( self.get_echo() )
-      time.sleep(0.25)
-
-    # throw out high and low readings, then calc average
-    t_max = max(t_ns)
-    t_min = min(t_ns)
-    t_avg_ns = (sum(t_ns) - t_max - t_min) / (num_echos - 2)
-    
+    for ii in range(0, max_echos):
+      if ii > 0:
+        time.sleep(self.ECHO_INTERVAL) # let the previous ping die out
+
+      t = self.get_echo()
+      if self.echo_valid(t):
+        t_ns.append(t)
+
+      if adaptive and self.echo_converged(t_ns, temp_C, tolerance_cm, min_echos):
+        break
+
+    return t_ns
+
+#----------------------------------------------------------
+
+  def echo_valid(self, t):
+    # a real echo, not a timeout or the no object pulse
+    return ECHO_MIN_NS <= t <= ECHO_MAX_NS
+
+#----------------------------------------------------------
+
+  def echo_estimate(self, t_ns):
+    # the median, which up to half the echoes being wild cannot move
+    return median(t_ns)
+
+#----------------------------------------------------------
+
+  def echo_converged(self, t_ns, temp_C, tolerance_cm, min_echos):
+    # The estimate has converged when the standard error of the median is
+    # within tolerance. The spread is the MAD (median absolute deviation,
+    # scaled by 1.4826 to the standard deviation of normal noise), which
+    # wild echoes do not blow up the way they do the standard deviation.
+    # At least 4 echoes are needed for a spread to mean anything.
+    if len(t_ns) < max(min_echos, 4):
+      return False
+
+    mid = median(t_ns)
+    sigma_ns = 1.4826 * median([abs(t - mid) for t in t_ns])
+    std_err_ns = 1.2533 * sigma_ns / len(t_ns) ** 0.5
+
+    return self.echo_to_distance(std_err_ns, temp_C) <= tolerance_cm
+
+#----------------------------------------------------------
+
+  def echo_to_distance(self, t_ns, temp_C=20):
     # we want the one-way time, not the round-trip time
-    t_one_way = t_avg_ns / 2
+    t_one_way = t_ns / 2
 
     # calculate distance based on speed of sound at given temp
     d_m = t_one_way * self.speed_of_sound( temp_C ) * 1e-9
@@ -120,6 +291,15 @@ class HC_SR04:
 
 #-------------------------------------------------------------------------------
 
+def median(values):
+  ordered = sorted(values)
+  mid = len(ordered) // 2
+  if len(ordered) % 2 == 1:
+    return ordered[mid]
+  return (ordered[mid - 1] + ordered[mid]) / 2
+
+#-------------------------------------------------------------------------------
+
 if __name__ == "__main__":
   print('HC-SR04 ultrasonic distance sensor - class test example')
   GPIO.setwarnings(False)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: i2c_bus.py
+#
+# Description: Shared, lock protected I2C bus handles. Every driver that
+#           needs an I2C bus calls get_bus(bus_id) instead of opening its own
+#           smbus2.SMBus. There is only ever one SHARED_BUS (and one open
+#           SMBus) per bus number, and every transaction on it is done while
+#           holding that bus' lock, so drivers running in different threads
+#           can never interleave transactions.
+#
+#           SHARED_BUS has the same read/write calls as smbus2.SMBus, so it
+#           can be handed straight to code that expects an SMBus (like the
+#           bme280 module). Any other SMBus call is passed through with the
+#           lock held.
+#
+#           Multi step device operations (write a command register, wait,
+#           read the result) should hold the lock for the whole sequence:
+#
+#               with bus.transaction():
+#                 ...
+#
+#           prefetch(addr, ranges) reads blocks of registers in single block
+#           transactions and returns a bus-like object that serves byte and
+#           word reads from those blocks. This turns code that reads a device
+#           one register at a time (e.g. loading calibration tables) into a
+#           couple of block reads.
+#
+#           Each bus keeps per device transaction counts, error counts and
+#           latency stats, see stats().
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#
+#-------------------------------------------------------------------------------
+
+import threading
+import time
+from smbus2 import SMBus
+
+# SMBus block transfers are limited to 32 bytes
+MAX_BLOCK = 32
+
+buses = {}
+buses_lock = threading.Lock()
+
+#-------------------------------------------------------------------------------
+
+def get_bus(bus_id=1):
+  with buses_lock:
+    if bus_id not in buses:
+      buses[bus_id] = SHARED_BUS(bus_id)
+    return buses[bus_id]
+
+#-------------------------------------------------------------------------------
+
+class SHARED_BUS:
+  def __init__(self, bus_id):
+    self.bus_id = bus_id
+    self.bus = SMBus(bus_id)
+    self.lock = threading.RLock()
+    self.device_stats = {}  # i2c address -> stats dict
+
+  #-------------------------------------
+
+  def transaction(self):
+    return self.lock
+
+  #-------------------------------------
+
+  def call(self, fn, addr, *args):
+    with self.lock:
+      stats = self.device_stats.get(addr)
+      if stats is None:
+        stats = {'transactions': 0, 'errors': 0, 'total_sec': 0.0, 'max_sec': 0.0}
+        self.device_stats[addr] = stats
+
+      t0 = time.perf_counter()
+      try:
+        return fn(addr, *args)
+      except OSError:
+        stats['errors'] += 1
+        raise
+      finally:
+        dt = time.perf_counter() - t0
+        stats['transactions'] += 1
+        stats['total_sec'] += dt
+        stats['max_sec'] = max(stats['max_sec'], dt)
+
+  #-------------------------------------
+
+  def __getattr__(self, name):
+    # any SMBus call not wrapped below - run it with the lock held
+    if name == 'bus':
+      raise AttributeError(name)
+    fn = getattr(self.bus, name)
+    if not callable(fn):
+      return fn
+    def locked(*args, **kwargs):
+      with self.lock:
+        return fn(*args, **kwargs)
+    return locked
+
+  #-------------------------------------
+
+  def read_byte(self, addr):
+    return self.call(self.bus.read_byte, addr)
+
+  def write_byte(self, addr, value):
+    return self.call(self.bus.write_byte, addr, value)
+
+  def read_byte_data(self, addr, reg):
+    return self.call(self.bus.read_byte_data, addr, reg)
+
+  def write_byte_data(self, addr, reg, value):
+    return self.call(self.bus.write_byte_data, addr, reg, value)
+
+  def read_word_data(self, addr, reg):
+    return self.call(self.bus.read_word_data, addr, reg)
+
+  def write_word_data(self, addr, reg, value):
+    return self.call(self.bus.write_word_data, addr, reg, value)
+
+  def read_i2c_block_data(self, addr, reg, length):
+    return self.call(self.bus.read_i2c_block_data, addr, reg, length)
+
+  def write_i2c_block_data(self, addr, reg, data):
+    return self.call(self.bus.write_i2c_block_data, addr, reg, data)
+
+  #-------------------------------------
+
+  def read_registers(self, addr, regs):
+    # read a set of registers with as few block reads as possible.
+    # Contiguous registers are read together, up to MAX_BLOCK at a time.
+    # Returns a dict of register -> value.
+    values = {}
+    regs = sorted(set(regs))
+    ii = 0
+    while ii < len(regs):
+      start = regs[ii]
+      jj = ii
+      while jj + 1 < len(regs) and regs[jj + 1] == regs[jj] + 1 \
+            and regs[jj + 1] - start < MAX_BLOCK:
+        jj += 1
+      data = self.read_i2c_block_data(addr, start, regs[jj] - start + 1)
+      for offset, value in enumerate(data):
+        values[start + offset] = value
+      ii = jj + 1
+
+    return values
+
+  #-------------------------------------
+
+  def prefetch(self, addr, ranges):
+    # ranges is a list of (first register, number of registers)
+    regs = []
+    for first, count in ranges:
+      regs.extend(range(first, first + count))
+    return PREFETCHED_BUS(self, addr, self.read_registers(addr, regs))
+
+  #-------------------------------------
+
+  def stats(self, addr=None):
+    with self.lock:
+      if addr is not None:
+        return dict(self.device_stats.get(addr, {}))
+      return {a: dict(s) for a, s in self.device_stats.items()}
+
+#-------------------------------------------------------------------------------
+
+class PREFETCHED_BUS:
+  # byte/word reads of prefetched registers of one device come from memory,
+  # everything else goes to the shared bus
+
+  def __init__(self, bus, addr, registers):
+    self.bus = bus
+    self.addr = addr
+    self.registers = registers
+
+  #-------------------------------------
+
+  def __getattr__(self, name):
+    if name == 'bus':
+      raise AttributeError(name)
+    return getattr(self.bus, name)
+
+  #-------------------------------------
+
+  def read_byte_data(self, addr, reg):
+    if addr == self.addr and reg in self.registers:
+      return self.registers[reg]
+    return self.bus.read_byte_data(addr, reg)
+
+  #-------------------------------------
+
+  def read_word_data(self, addr, reg):
+    # SMBus words are little endian
+    if addr == self.addr and reg in self.registers and reg + 1 in self.registers:
+      return self.registers[reg] | (self.registers[reg + 1] << 8)
+    return self.bus.read_word_data(addr, reg)
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  bus = get_bus(1)
+
+  # DS3231 time registers, one block read
+  print(bus.read_registers(0x68, range(0, 7)))
+  print(bus.stats())
@@ -9,6 +9,11 @@
 #           the LED is driven (source or sink mode). There are 2 basic functions
 #           to control the LED: toggle() and set(). 
 #
+#           blink() starts a background timer thread that flashes the LED
+#           on for on_time seconds every period seconds, on absolute
+#           deadlines, until stop_blink() is called. The calling code does
+#           not need to do anything to keep the LED blinking.
+#
 #           The parameters to create the class are:
 #             * led_pin - this is the BCM GPIO pin number that the LED is 
 #                         connected to
@@ -25,10 +30,12 @@
 #
 # Author: Greg Kraus
 # History: 20230512 Initial creation
+#          20261018 Background blink mode, fix set()
 #
 #-------------------------------------------------------------------------------
 
 import time
+import threading
 import RPi.GPIO as GPIO
 
 class LED:
@@ -38,10 +45,14 @@ class LED:
     self.isSink = isSink
     self.led_state = initial_state
     self.update_pin()
+
+    self.blink_thread = None
+    self.blink_stop = threading.Event()
     
   #-------------------------------------
 
   def __del__(self):
+    self.stop_blink()
     GPIO.cleanup( self.led_pin )
     
   #-------------------------------------
@@ -59,7 +70,7 @@ class LED:
   #-------------------------------------
   
   def set(self, state):
-    self.led_pin = state
+    self.led_state = state
     self.update_pin()
     
   #-------------------------------------
@@ -68,6 +79,40 @@ class LED:
     pin_state = self.led_state if self.isSink == False else not self.led_state
     GPIO.output(self.led_pin, pin_state)
     return self.led_state
+
+  #-------------------------------------
+
+  def blink(self, on_time=0.05, period=2.0):
+    self.stop_blink()
+    self.blink_stop.clear()
+    self.blink_thread = threading.Thread(target=self.blink_loop,
+                                         args=(on_time, period), daemon=True)
+    self.blink_thread.start()
+
+  #-------------------------------------
+
+  def stop_blink(self):
+    # stops blinking and leaves the LED off
+    if self.blink_thread is not None:
+      self.blink_stop.set()
+      self.blink_thread.join()
+      self.blink_thread = None
+
+  #-------------------------------------
+
+  def blink_loop(self, on_time, period):
+    deadline = time.monotonic()
+    while True:
+      self.set(1)
+      if self.blink_stop.wait(on_time):
+        break
+      self.set(0)
+
+      deadline += period
+      if self.blink_stop.wait(max(deadline - time.monotonic(), 0)):
+        break
+
+    self.set(0)
     
 #-------------------------------------------------------------------------------    
     
@@ -88,4 +133,12 @@ if __name__ == '__main__':
       time.sleep(1.95)
   except KeyboardInterrupt:
     pass
+
+  print('background blink - Ctrl-C to stop')
+  led.blink(0.05, 1.0)
+  try:
+    while 1:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    led.stop_blink()
     
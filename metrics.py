@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: metrics.py
+#
+# Description: Hot path instrumentation for the CWS, exported in the
+#           Prometheus text format, to find out where a slow measurement
+#           cycle spent its time (I2C, echo timeouts, SD card writes).
+#
+#           A REGISTRY holds counters, gauges and histograms. render() returns
+#           them in the Prometheus text format, write_textfile() writes them
+#           atomically for the node_exporter textfile collector (the file
+#           name must end in .prom), and serve() starts a local HTTP endpoint
+#           answering GET /metrics.
+#
+#           enable() wraps these driver calls with timing hooks:
+#             DS3231.read_date_time   (get_date_time, less read cache hits)
+#             BME280_WRAPPER.sample   (read, less read cache hits)
+#             HC_SR04.get_echo        also counts timeouts and out of range
+#                                     echoes
+#             HC_SR04.gpio_wait_until also counts wait timeouts
+#             LOGGER.write            (the alert log lines)
+#             TS_STORE.flush          history batches, with their rollups
+#             ROLLUP.flush            a rollup tier's batch
+#             ECHO_STORE.flush        raw echo batches (--raw-echoes)
+#             CHECKPOINT.save
+#           the last four being all of the main loop's SD card writes.
+#           Each call's duration goes into cws_stage_duration_seconds with a
+#           stage label, and exceptions into cws_stage_errors_total.
+#
+#           The hooks are installed by replacing the methods on the driver
+#           classes, and disable() puts the originals back, so with metrics
+#           disabled the drivers run exactly as before with no overhead at
+#           all. Call enable() before creating objects whose bound methods are
+#           held elsewhere (e.g. handed to ACQUISITION.add_sensor), since a
+#           bound method taken earlier keeps calling the original.
+#
+#           Durations are measured with time.monotonic(), so on the simulated
+#           hardware (sim_hw.py) they show the modeled device time.
+#
+#           A process forked after enable() (acq_process.py) counts its
+#           driver calls in its own copy of the registry. values() gives
+#           that copy's counts as a flat list, and set_remote() in the main
+#           process adds them to what it renders.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Time the hardware reads behind the read caches
+#          20261018 Storage stages, counts from another process
+#
+#-------------------------------------------------------------------------------
+
+import bisect
+import functools
+import http.server
+import math
+import os
+import threading
+import time
+
+# seconds, from a fast I2C read up to a ranging run that hit its timeouts
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                    0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# HC-SR04 echoes outside 2 cm - 400 cm (at 20 C) are not valid readings
+ECHO_MIN_NS = 116000
+ECHO_MAX_NS = 23300000
+
+#-------------------------------------------------------------------------------
+
+def format_labels(labels, extra=None):
+  items = list(labels.items())
+  if extra is not None:
+    items.append(extra)
+  if len(items) == 0:
+    return ''
+  return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                        .replace('"', '\\"').replace('\n', '\\n')) for k, v in items) + '}'
+
+#-------------------------------------------------------------------------------
+
+def format_value(value):
+  if value == math.inf:
+    return '+Inf'
+  if isinstance(value, float) and value.is_integer():
+    return str(int(value))
+  return repr(value)
+
+#-------------------------------------------------------------------------------
+
+class COUNTER:
+  TYPE = 'counter'
+
+  # fn, if given, is called at render time to read the value from elsewhere
+  # (e.g. a count the scheduler already keeps)
+  def __init__(self, name, help, labels=None, fn=None):
+    self.name = name
+    self.help = help
+    self.labels = labels or {}
+    self.fn = fn
+    self.value = 0
+    self.remote = 0   # counted in another process, see REGISTRY.set_remote()
+    self.lock = threading.Lock()
+
+  #-------------------------------------
+
+  def inc(self, amount=1):
+    with self.lock:
+      self.value += amount
+
+  #-------------------------------------
+
+  def values(self):
+    return [self.value]
+
+  def set_remote(self, values):
+    self.remote = values[0]
+
+  #-------------------------------------
+
+  def samples(self):
+    value = self.fn() if self.fn is not None else self.value + self.remote
+    return ['{}{} {}'.format(self.name, format_labels(self.labels), format_value(value))]
+
+#-------------------------------------------------------------------------------
+
+class GAUGE(COUNTER):
+  TYPE = 'gauge'
+
+  def set(self, value):
+    self.value = value
+
+#-------------------------------------------------------------------------------
+
+class HISTOGRAM:
+  TYPE = 'histogram'
+
+  def __init__(self, name, help, labels=None, buckets=DURATION_BUCKETS):
+    self.name = name
+    self.help = help
+    self.labels = labels or {}
+    self.buckets = tuple(sorted(buckets))
+    self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+    self.sum = 0.0
+    self.remote_counts = [0] * len(self.counts)
+    self.remote_sum = 0.0
+    self.lock = threading.Lock()
+
+  #-------------------------------------
+
+  def observe(self, value):
+    ii = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      self.counts[ii] += 1
+      self.sum += value
+
+  #-------------------------------------
+
+  def values(self):
+    with self.lock:
+      return self.counts + [self.sum]
+
+  def set_remote(self, values):
+    self.remote_counts = [int(v) for v in values[:-1]]
+    self.remote_sum = values[-1]
+
+  #-------------------------------------
+
+  def samples(self):
+    with self.lock:
+      counts = [a + b for a, b in zip(self.counts, self.remote_counts)]
+      total = self.sum + self.remote_sum
+
+    lines = []
+    cumulative = 0
+    for bound, count in zip(self.buckets + (math.inf,), counts):
+      cumulative += count
+      lines.append('{}_bucket{} {}'.format(self.name,
+                   format_labels(self.labels, ('le', format_value(float(bound)))), cumulative))
+    lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels), repr(total)))
+    lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels), cumulative))
+    return lines
+
+#-------------------------------------------------------------------------------
+
+class REGISTRY:
+  def __init__(self):
+    self.metrics = {}   # name -> list of metrics (one per label set)
+    self.lock = threading.Lock()
+
+  #-------------------------------------
+
+  def add(self, metric):
+    with self.lock:
+      family = self.metrics.setdefault(metric.name, [])
+      if len(family) > 0 and family[0].TYPE != metric.TYPE:
+        raise ValueError('metric {} already registered as a {}'.format(metric.name, family[0].TYPE))
+      for existing in family:
+        if existing.labels == metric.labels:
+          return existing
+      family.append(metric)
+      return metric
+
+  #-------------------------------------
+
+  def counter(self, name, help, labels=None, fn=None):
+    return self.add(COUNTER(name, help, labels, fn))
+
+  def gauge(self, name, help, labels=None, fn=None):
+    return self.add(GAUGE(name, help, labels, fn))
+
+  def histogram(self, name, help, labels=None, buckets=DURATION_BUCKETS):
+    return self.add(HISTOGRAM(name, help, labels, buckets))
+
+  #-------------------------------------
+
+  def own_metrics(self):
+    # the metrics that keep their own counts, in an order that is the same
+    # in every process with the same metrics
+    with self.lock:
+      own = [m for family in self.metrics.values() for m in family
+             if getattr(m, 'fn', None) is None]
+    return sorted(own, key=lambda m: (m.name, sorted(m.labels.items())))
+
+  def values(self):
+    # the counts of own_metrics() as one flat list
+    return [v for m in self.own_metrics() for v in m.values()]
+
+  def set_remote(self, values):
+    # another process's values() for the same metrics, added to these
+    for m in self.own_metrics():
+      n = len(m.values())
+      m.set_remote(values[:n])
+      values = values[n:]
+
+  #-------------------------------------
+
+  def render(self):
+    with self.lock:
+      families = [(name, list(family)) for name, family in self.metrics.items()]
+
+    lines = []
+    for name, family in families:
+      lines.append('# HELP {} {}'.format(name, family[0].help))
+      lines.append('# TYPE {} {}'.format(name, family[0].TYPE))
+      for metric in family:
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+  #-------------------------------------
+
+  def write_textfile(self, path):
+    # write to a temp file and rename it over the old one, so a collector
+    # never reads a half written file
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+      f.write(self.render())
+    os.replace(tmp, path)
+
+  #-------------------------------------
+
+  def serve(self, port, addr='127.0.0.1'):
+    # serve GET /metrics from a daemon thread, returns the server
+    registry = self
+
+    class HANDLER(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path != '/metrics':
+          self.send_error(404)
+          return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    server = http.server.ThreadingHTTPServer((addr, port), HANDLER)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+#-------------------------------------------------------------------------------
+
+registry = REGISTRY()
+hooks = []   # (class, method name, original method) of installed hooks
+
+#-------------------------------------------------------------------------------
+
+def instrument(cls, name, stage, check=None, reg=None):
+  # replace cls.name with a version that times each call. check(result), if
+  # given, is called with each result to update stage specific counters.
+  reg = reg or registry
+  original = cls.__dict__[name]
+  duration = reg.histogram('cws_stage_duration_seconds',
+                           'Duration of instrumented driver calls', {'stage': stage})
+  errors = reg.counter('cws_stage_errors_total',
+                       'Driver calls that raised an exception', {'stage': stage})
+
+  @functools.wraps(original)
+  def hook(self, *args, **kwargs):
+    t0 = time.monotonic()
+    try:
+      result = original(self, *args, **kwargs)
+    except Exception:
+      errors.inc()
+      raise
+    finally:
+      duration.observe(time.monotonic() - t0)
+    if check is not None:
+      check(result)
+    return result
+
+  setattr(cls, name, hook)
+  hooks.append((cls, name, original))
+
+#-------------------------------------------------------------------------------
+
+def enable(reg=None):
+  # install the hooks on the CWS drivers
+  if len(hooks) > 0:
+    return
+  reg = reg or registry
+
+  from chronodot import DS3231
+  from bme280_sensor import BME280_WRAPPER
+  from hc_sr04_sensor import HC_SR04
+  from logger import LOGGER
+  from ts_store import TS_STORE, ROLLUP
+  from echo_store import ECHO_STORE
+  from checkpoint import CHECKPOINT
+
+  echo_ok = reg.counter('cws_echo_results_total', 'HC-SR04 echo results', {'result': 'ok'})
+  echo_timeout = reg.counter('cws_echo_results_total', 'HC-SR04 echo results', {'result': 'timeout'})
+  echo_invalid = reg.counter('cws_echo_results_total', 'HC-SR04 echo results', {'result': 'out_of_range'})
+  def check_echo(t_ns):
+    if t_ns == HC_SR04.ECHO_TIMEOUT:
+      echo_timeout.inc()
+    elif t_ns < ECHO_MIN_NS or t_ns > ECHO_MAX_NS:
+      echo_invalid.inc()
+    else:
+      echo_ok.inc()
+
+  wait_timeout = reg.counter('cws_gpio_wait_timeouts_total', 'GPIO waits that timed out')
+  def check_wait(occurred):
+    if not occurred:
+      wait_timeout.inc()
+
+  instrument(DS3231, 'read_date_time', 'ds3231_get_date_time', reg=reg)
+  instrument(BME280_WRAPPER, 'sample', 'bme280_read', reg=reg)
+  instrument(HC_SR04, 'get_echo', 'hc_sr04_get_echo', check_echo, reg=reg)
+  instrument(HC_SR04, 'gpio_wait_until', 'hc_sr04_gpio_wait_until', check_wait, reg=reg)
+  instrument(LOGGER, 'write', 'logger_write', reg=reg)
+  instrument(TS_STORE, 'flush', 'ts_store_flush', reg=reg)
+  instrument(ROLLUP, 'flush', 'rollup_flush', reg=reg)
+  instrument(ECHO_STORE, 'flush', 'echo_store_flush', reg=reg)
+  instrument(CHECKPOINT, 'save', 'checkpoint_save', reg=reg)
+
+#-------------------------------------------------------------------------------
+
+def disable():
+  # put the original driver methods back
+  while len(hooks) > 0:
+    cls, name, original = hooks.pop()
+    setattr(cls, name, original)
+
+#-------------------------------------------------------------------------------
+
+def add_scheduler(scheduler, reg=None):
+  # export the scheduler's per task overrun counts and run times
+  reg = reg or registry
+  for task in scheduler.tasks:
+    labels = {'task': task.name}
+    reg.counter('cws_cycle_overruns_total', 'Scheduler deadlines missed', labels,
+                fn=lambda t=task: t.overruns)
+    reg.gauge('cws_cycle_last_run_seconds', 'Duration of the last task run', labels,
+              fn=lambda t=task: t.last_run_time)
+    reg.gauge('cws_cycle_last_jitter_seconds', 'How late the last task run started', labels,
+              fn=lambda t=task: t.last_jitter)
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  import sim_hw
+  sim_hw.install()
+
+  import RPi.GPIO as GPIO
+  from chronodot import DS3231
+  from bme280_sensor import BME280_WRAPPER
+  from hc_sr04_sensor import HC_SR04
+
+  GPIO.setmode(GPIO.BCM)
+  enable()
+  rtc = DS3231()
+  bme = BME280_WRAPPER()
+  ranger = HC_SR04(23, 24)
+  for ii in range(10):
+    rtc.get_date_time()
+    bme.read()
+    ranger.calc_distance()
+  print(registry.render())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: ranger_array.py
+#
+# Description: Several HC-SR04 rangers, one per bucket, measured together
+#           without hearing each other.
+#
+#           An HC-SR04 cannot tell its own ping from another one's, so two
+#           rangers pinging at about the same time read each other's sound
+#           (crosstalk). RANGER_ARRAY only ever has one ping out: a ranger
+#           pings guard seconds after the last echo of any of them has come
+#           back, and, as HC_SR04.get_echos() does, ECHO_INTERVAL after its
+#           own. Each ranger has to sit out ECHO_INTERVAL between its pings
+#           anyway, so the others take their turns in that wait, spread
+#           evenly over it. With up to ECHO_INTERVAL / guard rangers (4 with
+#           the defaults) measuring all of them takes about as long as
+#           measuring one.
+#
+#           get_echos() returns the valid echo durations of each ranger
+#           (HC_SR04.echo_valid()), with the same fixed and adaptive modes
+#           as HC_SR04.get_echos(). A ranger that has converged, or taken
+#           max_echos, drops out and the rest carry on in their own turns.
+#
+#           The pings are all made from the calling thread, one after
+#           another, so the array also runs on the simulated hardware
+#           (sim_hw.py), which models the crosstalk.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Only valid echoes, as HC_SR04.get_echos()
+#
+#-------------------------------------------------------------------------------
+
+import time
+
+class RANGER_ARRAY:
+  GUARD_SECONDS = 0.06   # from an echo to the next ranger's ping (the data sheet cycle)
+
+  def __init__(self, rangers, guard=GUARD_SECONDS):
+    self.rangers = list(rangers)
+    self.guard = guard
+    # first ping of each ranger, from the start of a measurement
+    spacing = max(guard, self.rangers[0].ECHO_INTERVAL / len(self.rangers))
+    self.offsets = [k * spacing for k in range(len(self.rangers))]
+    self.last_echo = None   # when the last echo came back
+    self.last_cycle_time = 0.0
+
+  #-------------------------------------
+
+  def __len__(self):
+    return len(self.rangers)
+
+  #-------------------------------------
+
+  @property
+  def pings(self):
+    return sum(ranger.pings for ranger in self.rangers)
+
+  #-------------------------------------
+
+  def get_echos(self, temp_C=20, adaptive=False, tolerance_cm=0.2,
+                min_echos=4, max_echos=10):
+    # returns a list of valid echo durations (nanoseconds) per ranger
+    start = time.monotonic()
+    if self.last_echo is not None:
+      start = max(start, self.last_echo + self.guard)
+    t_ns = [[] for ranger in self.rangers]
+    echos = [0] * len(self.rangers)
+    next_ping = [start + offset for offset in self.offsets]
+    active = list(range(len(self.rangers)))
+
+    while len(active) > 0:
+      k = min(active, key=lambda k: next_ping[k])
+      delay = next_ping[k] - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)   # the others' echoes have died out
+
+      ranger = self.rangers[k]
+      t = ranger.get_echo()
+      done = self.last_echo = time.monotonic()
+      echos[k] += 1
+      if ranger.echo_valid(t):
+        t_ns[k].append(t)
+
+      if echos[k] == max_echos or \
+         (adaptive and ranger.echo_converged(t_ns[k], temp_C, tolerance_cm, min_echos)):
+        active.remove(k)
+      next_ping[k] = done + ranger.ECHO_INTERVAL
+      for j in active:
+        next_ping[j] = max(next_ping[j], done + self.guard)
+
+    self.last_cycle_time = self.last_echo - start
+    return t_ns
+
+  #-------------------------------------
+
+  def echos_to_distances(self, t_ns, temp_C=20):
+    # the distance of each ranger from get_echos(), ECHO_TIMEOUT where a
+    # ranger had no valid echo
+    return [ranger.echos_to_distance(echos, temp_C)
+            for ranger, echos in zip(self.rangers, t_ns)]
+
+  #-------------------------------------
+
+  def calc_distances(self, temp_C=20, adaptive=False, tolerance_cm=0.2,
+                     min_echos=4, max_echos=10):
+    t_ns = self.get_echos(temp_C, adaptive, tolerance_cm, min_echos, max_echos)
+    return self.echos_to_distances(t_ns, temp_C)
+
+  #-------------------------------------
+
+  def stats(self):
+    return {
+      'pings'      : [ranger.pings for ranger in self.rangers],
+      'timeouts'   : [ranger.timeouts for ranger in self.rangers],
+      'cycle_time' : self.last_cycle_time,
+    }
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  import sim_hw
+  print('RANGER_ARRAY class test example (simulated hardware)')
+  world = sim_hw.install()
+
+  import RPi.GPIO as GPIO
+  from hc_sr04_sensor import HC_SR04
+
+  GPIO.setmode(GPIO.BCM)
+  rangers = [HC_SR04(23, 24, edge_detect=True), HC_SR04(17, 27, edge_detect=True)]
+  array = RANGER_ARRAY(rangers)
+  temp_C = world.weather.temp()
+  time.sleep(HC_SR04.READY_SECONDS)
+
+  # one ranger on its own, for the time to beat
+  start = time.monotonic()
+  rangers[0].calc_distance(temp_C)
+  single = time.monotonic() - start
+
+  # both rangers pinging in turn with no guard time hear each other
+  start = time.monotonic()
+  naive = [[], []]
+  for ii in range(10):
+    if ii > 0:
+      time.sleep(HC_SR04.ECHO_INTERVAL)
+    for k, ranger in enumerate(rangers):
+      naive[k].append(ranger.get_echo())
+  naive_time = time.monotonic() - start
+  crosstalk = [r.crosstalk for r in world.rangers]
+  time.sleep(1)
+
+  distances = array.calc_distances(temp_C)
+  print('one ranger:  {:.3f} s'.format(single))
+  print('no guard:    {:.3f} s  {} cm  crosstalk {}'.format(naive_time,
+        ['{:.2f}'.format(d) for d in array.echos_to_distances(naive, temp_C)], crosstalk))
+  print('array:       {:.3f} s  {} cm  crosstalk {}'.format(array.last_cycle_time,
+        ['{:.2f}'.format(d) for d in distances],
+        [r.crosstalk - c for r, c in zip(world.rangers, crosstalk)]))
+  print('model:                 {} cm'.format(
+        ['{:.2f}'.format(w.distance_cm()) for w in world.waters]))
+  print(array.stats())
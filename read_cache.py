@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: read_cache.py
+#
+# Description: Timestamped last-reading cache for the CWS sensor wrappers.
+#
+#           A wrapper's read call asks the cache first:
+#
+#               data = self.cache.get()
+#               if data is None:
+#                 data = <read the hardware>
+#                 self.cache.put(data)
+#
+#           get() returns the cached reading while it is younger than ttl
+#           seconds (a hit), otherwise None (a miss). With ttl=0 every read
+#           goes to the hardware, which is what the main loop wants for its
+#           once per cycle reads.
+#
+#           last() returns the newest reading whatever its age, and never
+#           causes any I/O. __str__ and the display use it, so showing a
+#           value costs nothing and always shows the value that was logged.
+#           It counts as a hit when there is a reading to return.
+#
+#           hits and misses are counted and returned by stats().
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#
+#-------------------------------------------------------------------------------
+
+import time
+
+class READ_CACHE:
+  def __init__(self, ttl=0):
+    self.ttl = ttl
+    self.entry = None   # (monotonic time, reading), replaced in one step
+    self.hits = 0
+    self.misses = 0
+
+  #-------------------------------------
+
+  def get(self):
+    entry = self.entry
+    if entry is not None and time.monotonic() - entry[0] < self.ttl:
+      self.hits += 1
+      return entry[1]
+    self.misses += 1
+    return None
+
+  #-------------------------------------
+
+  def put(self, reading):
+    self.entry = (time.monotonic(), reading)
+
+  #-------------------------------------
+
+  def last(self):
+    entry = self.entry
+    if entry is None:
+      return None
+    self.hits += 1
+    return entry[1]
+
+  #-------------------------------------
+
+  def age(self):
+    # seconds since the newest reading, None if there is none
+    entry = self.entry
+    return None if entry is None else time.monotonic() - entry[0]
+
+  #-------------------------------------
+
+  def clear(self):
+    self.entry = None
+
+  #-------------------------------------
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'age': self.age()}
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  print('READ_CACHE class test example')
+
+  cache = READ_CACHE(ttl=0.5)
+  for ii in range(6):
+    value = cache.get()
+    if value is None:
+      value = time.time()   # stands in for a sensor read
+      cache.put(value)
+    print('{:.3f}  last {:.3f}'.format(value, cache.last()))
+    time.sleep(0.2)
+  print(cache.stats())
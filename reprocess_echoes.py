@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: reprocess_echoes.py
+#
+# Description: Recompute distance, water height and volume for every raw echo
+#           record in an ECHO_STORE (cws_main.py --raw-echoes) under new
+#           calibration parameters, e.g. after measuring the tank again or
+#           checking the speed of sound.
+#
+#           The math is the same as the main loop's:
+#             estimate = median of the echoes between ECHO_MIN_NS and
+#                        ECHO_MAX_NS (HC_SR04.echo_valid, echo_estimate)
+#             distance = estimate / 2 * (speed_base + speed_per_C * temp)
+#                        (temp + temp_offset, clamped to 0 - 100 C)
+#             height   = empty_distance - distance (0.01 if below empty)
+#             volume   = the volume table lookup of height
+#
+#           The volume table is the one cws_main.py caches
+#           (cws_volume_table.dat, see volume_table.py), or another given
+#           with --volume-table. Without one the bucket is taken to be a
+#           cylinder of --radius:
+#             volume   = height * pi * radius^2 / 1000
+#
+#           With a ranger per bucket each ranger has its own store
+#           (cws_echoes_1, cws_echoes_2, ...), and the volumes are those of
+#           its bucket.
+#
+#           With NumPy installed each segment file is mapped straight into a
+#           structured array (echo_store.ECHO_DTYPE) and reprocessed in one
+#           vectorized pass, a few million records a second. Without NumPy it
+#           falls back to a plain Python loop that gives the same results.
+#
+#           Usage:
+#             ./reprocess_echoes.py cws_echoes [--empty-distance CM]
+#                   [--radius CM] [--speed-base M/S] [--speed-per-c M/S/C]
+#                   [--temp-offset C] [--volume-table FILE] [--start TS]
+#                   [--end TS] [--csv FILE] [--no-numpy]
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Volumes from the volume table
+#          20261018 Median of the valid echoes, as HC_SR04
+#
+#-------------------------------------------------------------------------------
+
+import argparse
+import math
+import os
+import time
+
+from echo_store import ECHO_STORE, ECHO_DTYPE, MAX_ECHOS
+from metrics import ECHO_MIN_NS, ECHO_MAX_NS
+from ts_store import HEADER
+from volume_table import VOLUME_TABLE
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+# the calibration cws_main.py uses
+CALIBRATION = {
+  'empty_distance_cm' : 37.4,
+  'radius_cm'         : (10.75 / 2) * 2.54,
+  'speed_base'        : 331,
+  'speed_per_C'       : 0.6,
+  'temp_offset'       : 0.0,
+}
+MIN_HEIGHT_CM = 0.01
+
+#-------------------------------------------------------------------------------
+
+def reprocess_numpy(store, cal, t_start=-math.inf, t_end=math.inf, table=None):
+  # returns a dict of arrays: time, temp, count, distance, height, volume
+  parts = []
+  for name in store.segments():
+    arr = np.fromfile(os.path.join(store.path, name), dtype=ECHO_DTYPE, offset=HEADER.size)
+    arr = arr[(arr['time'] >= t_start) & (arr['time'] <= t_end)]
+    if len(arr) == 0:
+      continue
+
+    count = arr['count'].astype(np.int64)
+    echo = arr['echo'].astype(np.float64)
+    used = (np.arange(MAX_ECHOS) < count[:, None]) & (echo >= ECHO_MIN_NS) & (echo <= ECHO_MAX_NS)
+    # median of the valid echoes: sorted, with the others pushed to the end
+    valid = used.sum(axis=1)
+    ordered = np.sort(np.where(used, echo, np.inf), axis=1)
+    low = np.take_along_axis(ordered, np.maximum(valid - 1, 0)[:, None] // 2, axis=1)[:, 0]
+    high = np.take_along_axis(ordered, (valid // 2)[:, None], axis=1)[:, 0]
+    with np.errstate(invalid='ignore'):
+      estimate = np.where(valid > 0, (low + high) / 2, np.nan)
+
+    temp = np.clip(arr['temp'].astype(np.float64) + cal['temp_offset'], 0, 100)
+    speed = cal['speed_base'] + cal['speed_per_C'] * temp
+    distance = estimate / 2 * speed * 1e-7          # ns, m/s -> cm
+    height = cal['empty_distance_cm'] - distance
+    height = np.where(height < 0, MIN_HEIGHT_CM, height)
+    height[valid == 0] = np.nan
+    if table is not None:
+      volume = table.volumes_for(height)
+    else:
+      volume = height * cal['radius_cm'] ** 2 * math.pi / 1000
+
+    parts.append({'time': arr['time'], 'temp': arr['temp'], 'count': count,
+                  'distance': distance, 'height': height, 'volume': volume})
+
+  if len(parts) == 0:
+    return {k: np.empty(0) for k in ('time', 'temp', 'count', 'distance', 'height', 'volume')}
+  return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+#-------------------------------------------------------------------------------
+
+def reprocess_python(store, cal, t_start=-math.inf, t_end=math.inf, table=None):
+  # the same as reprocess_numpy(), with lists
+  result = {k: [] for k in ('time', 'temp', 'count', 'distance', 'height', 'volume')}
+  area = cal['radius_cm'] ** 2 * math.pi / 1000
+  for timestamp, temp, t_ns in store.records():
+    if timestamp < t_start or timestamp > t_end:
+      continue
+    valid = sorted(t for t in t_ns if ECHO_MIN_NS <= t <= ECHO_MAX_NS)
+    if len(valid) == 0:
+      distance = height = volume = math.nan
+    else:
+      mid = len(valid) // 2
+      estimate = valid[mid] if len(valid) % 2 == 1 else (valid[mid - 1] + valid[mid]) / 2
+      t = min(max(temp + cal['temp_offset'], 0), 100)
+      distance = estimate / 2 * (cal['speed_base'] + cal['speed_per_C'] * t) * 1e-7
+      height = cal['empty_distance_cm'] - distance
+      if height < 0:
+        height = MIN_HEIGHT_CM
+      volume = height * area if table is None else table.volume(height)
+
+    for k, v in zip(result, (timestamp, temp, len(t_ns), distance, height, volume)):
+      result[k].append(v)
+  return result
+
+#-------------------------------------------------------------------------------
+
+def write_csv(filename, result):
+  with open(filename, 'w') as f:
+    f.write('time,temp,echoes,distance_cm,height_cm,volume_l\n')
+    for row in zip(*(result[k] for k in ('time', 'temp', 'count', 'distance', 'height', 'volume'))):
+      f.write('{:.3f},{:.2f},{},{:.3f},{:.3f},{:.4f}\n'.format(*row))
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Recompute CWS history from raw echoes')
+  parser.add_argument('path', help='ECHO_STORE directory')
+  parser.add_argument('--empty-distance', type=float, default=CALIBRATION['empty_distance_cm'],
+                      help='sensor to empty water level, cm')
+  parser.add_argument('--radius', type=float, default=CALIBRATION['radius_cm'],
+                      help='bucket radius without a volume table, cm')
+  parser.add_argument('--speed-base', type=float, default=CALIBRATION['speed_base'],
+                      help='speed of sound at 0 C, m/s')
+  parser.add_argument('--speed-per-c', type=float, default=CALIBRATION['speed_per_C'],
+                      help='speed of sound change per degree C, m/s')
+  parser.add_argument('--temp-offset', type=float, default=CALIBRATION['temp_offset'],
+                      help='correction added to the stored temperatures, C')
+  parser.add_argument('--volume-table', default='cws_volume_table.dat',
+                      help='height to volume table (volume_table.py), if the file exists')
+  parser.add_argument('--start', type=float, default=-math.inf, help='first timestamp')
+  parser.add_argument('--end', type=float, default=math.inf, help='last timestamp')
+  parser.add_argument('--csv', default=None, help='write the results to this CSV file')
+  parser.add_argument('--no-numpy', action='store_true', help='use the plain Python path')
+  args = parser.parse_args()
+
+  cal = {
+    'empty_distance_cm' : args.empty_distance,
+    'radius_cm'         : args.radius,
+    'speed_base'        : args.speed_base,
+    'speed_per_C'       : args.speed_per_c,
+    'temp_offset'       : args.temp_offset,
+  }
+  store = ECHO_STORE(args.path)
+  table = None
+  if os.path.exists(args.volume_table):
+    table = VOLUME_TABLE.load(args.volume_table)
+    if table is None:
+      print('{} is not a volume table'.format(args.volume_table))
+      raise SystemExit(1)
+  else:
+    print('no volume table, using a cylinder of radius {:.2f} cm'.format(args.radius))
+
+  t0 = time.perf_counter()
+  if np is not None and not args.no_numpy:
+    result = reprocess_numpy(store, cal, args.start, args.end, table)
+  else:
+    result = reprocess_python(store, cal, args.start, args.end, table)
+  elapsed = time.perf_counter() - t0
+
+  n = len(result['time'])
+  print('{} records in {:.3f} s ({:.0f} records/s, {})'.format(n, elapsed,
+        n / elapsed if elapsed > 0 else 0,
+        'numpy' if np is not None and not args.no_numpy else 'python'))
+  if isinstance(result['volume'], list):
+    valid = [v for v in result['volume'] if not math.isnan(v)]
+  else:
+    valid = result['volume'][~np.isnan(result['volume'])]
+  if len(valid) > 0:
+    print('volume: min {:.2f} L  max {:.2f} L  last {:.2f} L  ({} without echoes)'.format(
+          min(valid), max(valid), valid[-1], n - len(valid)))
+
+  if args.csv is not None:
+    write_csv(args.csv, result)
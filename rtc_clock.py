@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: rtc_clock.py
+#
+# Description: A clock that is disciplined by the DS3231 RTC but does not talk
+#           to it on every call. The RTC is read once at start up, and after
+#           that timestamps are calculated from time.monotonic(), which
+#           costs microseconds instead of an I2C transaction.
+#
+#           Every discipline_interval seconds the RTC is read again. The
+#           clock is re-anchored to the RTC, and the rate of the monotonic
+#           clock relative to the RTC (drift, in ppm) is measured over the
+#           whole time since start up. That rate is then used to scale
+#           monotonic time between RTC reads. The DS3231 only has 1 second
+#           resolution, so the clock is only re-anchored when it has moved
+#           out of the RTC's current second, and the drift is not used until
+#           it has been measured over at least MIN_DRIFT_BASELINE seconds.
+#
+#           The get_timestamp(), get_date_time() and str() calls match the
+#           DS3231 class, so RTC_CLOCK can be used in its place. Timestamps
+#           are floats rather than whole seconds.
+#
+# Author: Greg Kraus
+#
+# History: 20261018 Initial version
+#          20261018 date_time() for stored timestamps
+#
+#-------------------------------------------------------------------------------
+
+import time
+
+# ignore drift estimates until they are measured over this many seconds
+MIN_DRIFT_BASELINE = 6 * 3600
+
+# anything beyond this is a clock step (RTC set, bad read), not drift
+MAX_DRIFT_PPM = 500
+
+class RTC_CLOCK:
+  def __init__(self, rtc, discipline_interval=3600):
+    self.rtc = rtc
+    self.discipline_interval = discipline_interval
+
+    self.rtc_reads = 0       # number of RTC reads so far
+    self.drift_ppm = 0.0     # monotonic clock rate error relative to the RTC
+    self.last_error = 0.0    # seconds the clock was off at the last discipline
+    self.first_anchor = None # (monotonic, rtc timestamp) at start up
+
+    self.discipline()
+
+  #-----------------------------------------
+
+  def __str__(self):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.get_timestamp()))
+
+  #-----------------------------------------
+
+  def discipline(self):
+    rtc_ts = self.rtc.get_timestamp()
+    mono = time.monotonic()
+    self.rtc_reads += 1
+
+    self.last_discipline = mono
+
+    if self.first_anchor is None:
+      self.first_anchor = (mono, rtc_ts)
+    else:
+      # the RTC truncates to whole seconds, so anything inside the RTC's
+      # current second is as good as it can tell us
+      self.last_error = rtc_ts - self.calc_timestamp(mono)
+      in_step = -1 < self.last_error <= 0
+
+      # measure drift over the whole run for the best resolution
+      elapsed = mono - self.first_anchor[0]
+      drift_ppm = ((rtc_ts - self.first_anchor[1]) / elapsed - 1) * 1e6
+      if abs(drift_ppm) > MAX_DRIFT_PPM:
+        # the RTC was stepped - start measuring drift again from here
+        self.first_anchor = (mono, rtc_ts)
+        self.drift_ppm = 0.0
+      elif elapsed >= MIN_DRIFT_BASELINE:
+        self.drift_ppm = drift_ppm
+
+      if in_step:
+        return
+
+    self.anchor_mono = mono
+    self.anchor_ts = rtc_ts
+
+  #-----------------------------------------
+
+  def calc_timestamp(self, mono):
+    return self.anchor_ts + (mono - self.anchor_mono) * (1 + self.drift_ppm * 1e-6)
+
+  #-----------------------------------------
+
+  def get_timestamp(self):
+    mono = time.monotonic()
+    if mono - self.last_discipline >= self.discipline_interval:
+      self.discipline()
+
+    return self.calc_timestamp(mono)
+
+  #-----------------------------------------
+
+  def get_date_time(self):
+    return date_time(self.get_timestamp())
+
+#-------------------------------------------------------------------------------
+
+def date_time(timestamp):
+  # same register order and conventions as DS3231.get_date_time()
+  t = time.localtime(timestamp)
+  return [ t.tm_sec, t.tm_min, t.tm_hour, t.tm_wday+1, t.tm_mday, t.tm_mon,
+           t.tm_year - 2000 ]
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  from chronodot import DS3231
+
+  clock = RTC_CLOCK(DS3231(), discipline_interval=60)
+
+  try:
+    while( 1 ):
+      t0 = time.perf_counter()
+      ts = clock.get_timestamp()
+      t1 = time.perf_counter()
+      print('clock: {}  timestamp: {:.3f}  ({:.1f} us)'.format(clock, ts, (t1 - t0) * 1e6))
+      print('rtc reads: {}  last error: {:.3f} s  drift: {:.1f} ppm'.format(
+            clock.rtc_reads, clock.last_error, clock.drift_ppm))
+      time.sleep( 2 )
+  except KeyboardInterrupt:
+    pass   # Ctrl-C to exit program
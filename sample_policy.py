@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: sample_policy.py
+#
+# Description: Sampling rate policies for the CWS measurement cycle.
+#
+#           After every measurement the main loop calls
+#
+#               interval = policy.update(now, status)
+#
+#           and sets the measurement cycle period to interval seconds
+#           (SCHEDULER.set_period()). status is the cws_main.py status dict;
+#           the policies look at 'volume', 'hall_events' and 'refilling'.
+#           Any class with the SAMPLE_POLICY update() / stats() / report()
+#           methods can be used, the ones here are:
+#
+#             * FIXED_POLICY    - always the same interval.
+#             * ADAPTIVE_POLICY - the fast interval whenever the level is
+#               moving (more than noise_liters since the last sample, at
+#               more than active_lph), the water out sensor changed, or a
+#               refill is in progress. Otherwise the interval grows by the
+#               backoff factor every quiet sample, up to the slow interval.
+#             * NIGHT_SCHEDULE  - wraps another policy, and between
+#               start_hour and end_hour (local time) stretches its quiet
+#               intervals out to the night interval. Activity still gets the
+#               fast interval, and the last night interval is cut short so
+#               sampling picks up again at end_hour.
+#
+#           A policy only sees activity at a sample, so a slow interval
+#           would see a refill or water out event up to that interval late.
+#           cws_main.py does not wait for it: a hall sensor edge, or a
+#           cheap level check in between, wakes the measurement cycle up
+#           (SCHEDULER.wake()), and that sample sees the activity and picks
+#           the fast interval. The hall sensor's edge detection keeps every
+#           water out event (HALL_SENSOR.snapshot()) either way.
+#
+#           report() compares the samples taken, and what they cost (sensor
+#           pings, reads, measurement CPU time), with what sampling at a
+#           fixed base interval would have taken over the same time.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Activity between samples wakes the cycle up
+#
+#-------------------------------------------------------------------------------
+
+import time
+
+class SAMPLE_POLICY:
+  # bookkeeping shared by all the policies. Subclasses implement choose().
+
+  def __init__(self):
+    self.active = False       # the last sample saw activity
+    self.interval = None      # the last interval chosen
+    self.samples = 0
+    self.active_samples = 0
+    self.first_time = None
+    self.last_time = None
+    self.intervals = {}       # interval -> number of times chosen
+
+  #-------------------------------------
+
+  def choose(self, now, status):
+    raise NotImplementedError
+
+  #-------------------------------------
+
+  def update(self, now, status):
+    # seconds until the next sample
+    interval = self.choose(now, status)
+
+    self.interval = interval
+    self.samples += 1
+    if self.active:
+      self.active_samples += 1
+    if self.first_time is None:
+      self.first_time = now
+    self.last_time = now
+    self.intervals[interval] = self.intervals.get(interval, 0) + 1
+    return interval
+
+  #-------------------------------------
+
+  def stats(self):
+    elapsed = 0.0 if self.first_time is None else self.last_time - self.first_time
+    return {
+      'samples'        : self.samples,
+      'active_samples' : self.active_samples,
+      'elapsed'        : elapsed,
+      'mean_interval'  : elapsed / (self.samples - 1) if self.samples > 1 else None,
+      'intervals'      : {'{:g}'.format(k): v for k, v in sorted(self.intervals.items())},
+    }
+
+  #-------------------------------------
+
+  def report(self, base_interval, counts=None, cpu_seconds=None):
+    # counts is a dict of name -> total, e.g. sensor pings. Each is scaled
+    # to what sampling every base_interval seconds would have cost.
+    stats = self.stats()
+    fixed = stats['elapsed'] / base_interval + 1 if stats['samples'] > 0 else 0
+    ratio = stats['samples'] / fixed if fixed > 0 else 1.0
+
+    report = {
+      'samples'       : stats['samples'],
+      'fixed_samples' : round(fixed),
+      'saved'         : 1 - ratio,   # fraction of the fixed rate cost saved
+    }
+    totals = dict(counts or {})
+    if cpu_seconds is not None:
+      totals['cpu_seconds'] = cpu_seconds
+    for name, total in totals.items():
+      report[name] = {
+        'total'      : total,
+        'per_sample' : total / stats['samples'] if stats['samples'] > 0 else 0,
+        'fixed'      : total / ratio if ratio > 0 else total,
+      }
+    return report
+
+#-------------------------------------------------------------------------------
+
+class FIXED_POLICY(SAMPLE_POLICY):
+  def __init__(self, interval=10):
+    super().__init__()
+    self.fixed = interval
+
+  #-------------------------------------
+
+  def choose(self, now, status):
+    return self.fixed
+
+#-------------------------------------------------------------------------------
+
+class ADAPTIVE_POLICY(SAMPLE_POLICY):
+  def __init__(self, fast=10, slow=300, backoff=2.0, noise_liters=0.5, active_lph=2.0):
+    super().__init__()
+    self.fast = fast
+    self.slow = slow
+    self.backoff = backoff
+    self.noise_liters = noise_liters   # level changes within this are noise
+    self.active_lph = active_lph       # liters per hour that count as activity
+
+    self.last_volume = None
+    self.last_volume_time = None
+    self.last_hall_count = None
+
+  #-------------------------------------
+
+  def is_active(self, now, status):
+    active = bool(status.get('refilling'))
+
+    volume = status.get('volume')
+    if volume is not None:
+      if self.last_volume is not None and now > self.last_volume_time:
+        change = abs(volume - self.last_volume)
+        rate = change / (now - self.last_volume_time) * 3600
+        if change >= self.noise_liters and rate >= self.active_lph:
+          active = True
+      self.last_volume = volume
+      self.last_volume_time = now
+
+    hall = status.get('hall_events')
+    if hall is not None:
+      count = hall['on_count'] + hall['off_count']
+      if self.last_hall_count is not None and count != self.last_hall_count:
+        active = True
+      self.last_hall_count = count
+
+    return active
+
+  #-------------------------------------
+
+  def choose(self, now, status):
+    self.active = self.is_active(now, status)
+    if self.active or self.interval is None:
+      return self.fast
+    return min(self.interval * self.backoff, self.slow)
+
+#-------------------------------------------------------------------------------
+
+class NIGHT_SCHEDULE(SAMPLE_POLICY):
+  def __init__(self, policy, start_hour=21, end_hour=5, interval=900):
+    super().__init__()
+    self.policy = policy
+    self.start_hour = start_hour   # local time, may be fractional
+    self.end_hour = end_hour
+    self.night_interval = interval
+
+  #-------------------------------------
+
+  def seconds_to_morning(self, now):
+    # seconds until end_hour if now is at night, otherwise None
+    t = time.localtime(now)
+    hour = t.tm_hour + t.tm_min / 60 + t.tm_sec / 3600
+    if self.start_hour <= self.end_hour:
+      night = self.start_hour <= hour < self.end_hour
+    else:
+      night = hour >= self.start_hour or hour < self.end_hour
+    if not night:
+      return None
+    return ((self.end_hour - hour) % 24) * 3600
+
+  #-------------------------------------
+
+  def choose(self, now, status):
+    interval = self.policy.update(now, status)
+    self.active = self.policy.active
+
+    left = self.seconds_to_morning(now)
+    if left is None or self.active:
+      return interval
+    return max(interval, min(self.night_interval, left))
+
+  #-------------------------------------
+
+  def stats(self):
+    stats = super().stats()
+    stats['policy'] = self.policy.stats()
+    return stats
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  print('SAMPLE_POLICY class test example - a simulated day')
+
+  # one bucket drinking 3 L during the day, refilled at 15:00
+  policy = NIGHT_SCHEDULE(ADAPTIVE_POLICY())
+  midnight = time.mktime(time.strptime('2026-10-18', '%Y-%m-%d'))
+  now = midnight
+  volume = 10.0
+  while now < midnight + 86400:
+    hour = (now - midnight) / 3600
+    if 6 <= hour < 20:
+      volume -= 3.0 / (14 * 3600) * policy.interval
+    if 15 <= hour < 15 + 1 / 60:
+      volume = min(volume + 0.2 * policy.interval, 18.0)
+    interval = policy.update(now, {'volume': volume, 'refilling': False})
+    if policy.active:
+      print('{:5.2f} h  {:.1f} L  active'.format(hour, volume))
+    now += interval
+
+  print(policy.stats())
+  print(policy.report(10, {'pings': policy.samples * 4}, cpu_seconds=policy.samples * 0.002))
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: scheduler.py
+#
+# Description: A simple periodic task scheduler driven by absolute monotonic
+#           deadlines. Each task runs at start + offset + N * period, no
+#           matter how long the previous run took, so the cadence does not
+#           drift by the cost of each cycle. Between deadlines the scheduler
+#           sleeps until the next one is due.
+#
+#           If a task runs past its next deadline (an overrun), the missed
+#           deadlines are skipped rather than run back to back, and counted.
+#           Jitter (how late a task started relative to its deadline) and
+#           run time are tracked per task and available from stats().
+#
+#           Tasks due at the same deadline run in the order they were added.
+#
+#           set_period() changes a task's period from its next deadline on,
+#           e.g. for adaptive sampling. A task that changes its own period
+#           while it runs gets its next deadline from the new period. Tasks
+#           that run at an offset into the same cycle keep that offset when
+#           their periods are all changed before the first of them runs.
+#
+#           wake() brings tasks forward, e.g. when a sensor sees activity
+#           before the next sample is due. It may be called from any thread
+#           (a GPIO edge callback): the scheduler sleeps on a
+#           threading.Event, and a wake() ends the sleep. Each woken task is
+#           then due at its offset from now, unless it was due sooner
+#           anyway, and its cadence carries on from there. The simulated
+#           clock cannot be waited on with a threading.Event, so with
+#           sim_hw.py pass its VIRTUAL_CLOCK.wait as wait.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Mean run time in stats()
+#          20261018 Changing task periods
+#          20261018 wake() to bring tasks forward
+#
+#-------------------------------------------------------------------------------
+
+import math
+import threading
+import time
+
+class TASK:
+  def __init__(self, name, period, func, offset=0):
+    self.name = name
+    self.period = period
+    self.func = func
+    self.offset = offset
+    self.deadline = None
+
+    self.runs = 0
+    self.overruns = 0        # number of deadlines skipped
+    self.last_jitter = 0.0   # seconds late the last run started
+    self.max_jitter = 0.0
+    self.sum_jitter = 0.0
+    self.last_run_time = 0.0 # seconds the last run took
+    self.max_run_time = 0.0
+    self.sum_run_time = 0.0
+
+  #-------------------------------------
+
+  def run(self, now):
+    jitter = now - self.deadline
+    self.func()
+    run_time = time.monotonic() - now
+
+    self.runs += 1
+    self.last_jitter = jitter
+    self.max_jitter = max(self.max_jitter, jitter)
+    self.sum_jitter += jitter
+    self.last_run_time = run_time
+    self.max_run_time = max(self.max_run_time, run_time)
+    self.sum_run_time += run_time
+
+    # next deadline, skipping any that have already gone by
+    self.deadline += self.period
+    late = time.monotonic() - self.deadline
+    if late >= 0:
+      missed = math.floor(late / self.period) + 1
+      self.overruns += missed
+      self.deadline += missed * self.period
+
+  #-------------------------------------
+
+  def set_period(self, period):
+    # takes effect after the pending deadline
+    if period <= 0:
+      raise ValueError('task period must be greater than 0')
+    self.period = period
+
+  #-------------------------------------
+
+  def stats(self):
+    return {
+      'period'        : self.period,
+      'runs'          : self.runs,
+      'overruns'      : self.overruns,
+      'last_jitter'   : self.last_jitter,
+      'max_jitter'    : self.max_jitter,
+      'mean_jitter'   : self.sum_jitter / self.runs if self.runs > 0 else 0.0,
+      'last_run_time' : self.last_run_time,
+      'max_run_time'  : self.max_run_time,
+      'mean_run_time' : self.sum_run_time / self.runs if self.runs > 0 else 0.0,
+    }
+
+#-------------------------------------------------------------------------------
+
+class SCHEDULER:
+  def __init__(self, wait=None):
+    # wait(event, seconds) sleeps until event is set or seconds have gone
+    # by, and returns whether it was set (threading.Event.wait() by default)
+    self.tasks = []
+    self.running = False
+    self.wait = wait or (lambda event, seconds: event.wait(seconds))
+    self.wake_event = threading.Event()
+    self.wake_lock = threading.Lock()
+    self.woken = set()    # names of the tasks to bring forward
+
+  #-------------------------------------
+
+  def add_task(self, name, period, func, offset=0):
+    task = TASK(name, period, func, offset)
+    self.tasks.append(task)
+    return task
+
+  #-------------------------------------
+
+  def set_period(self, names, period):
+    # change the period of the named tasks
+    for task in self.tasks:
+      if task.name in names:
+        task.set_period(period)
+
+  #-------------------------------------
+
+  def wake(self, names):
+    # run the named tasks now (at their offsets from now), from any thread
+    with self.wake_lock:
+      self.woken.update(names)
+      self.wake_event.set()
+
+  #-------------------------------------
+
+  def bring_forward(self):
+    # in run(), after a wake()
+    with self.wake_lock:
+      names, self.woken = self.woken, set()
+      self.wake_event.clear()
+    now = time.monotonic()
+    for task in self.tasks:
+      if task.name in names:
+        task.deadline = min(task.deadline, now + task.offset)
+
+  #-------------------------------------
+
+  def stop(self):
+    # may be called from a task to end run()
+    self.running = False
+
+  #-------------------------------------
+
+  def run(self, duration=None):
+    # run tasks until stop() is called, or for duration seconds
+    start = time.monotonic()
+    for task in self.tasks:
+      if task.deadline is None:
+        task.deadline = start + task.offset
+
+    self.running = True
+    while self.running:
+      if self.wake_event.is_set():
+        self.bring_forward()
+      # min() returns the first of equal deadlines, i.e. the earliest added
+      task = min(self.tasks, key=lambda t: t.deadline)
+      if duration is not None and task.deadline > start + duration:
+        break
+
+      delay = task.deadline - time.monotonic()
+      if delay > 0 and self.wait(self.wake_event, delay):
+        continue    # woken up, the next task may have changed
+
+      task.run(time.monotonic())
+
+    self.running = False
+
+  #-------------------------------------
+
+  def stats(self):
+    return {task.name: task.stats() for task in self.tasks}
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  print('SCHEDULER class test example')
+
+  sched = SCHEDULER()
+  sched.add_task('fast', 0.5, lambda: None)
+  sched.add_task('slow', 1.0, lambda: time.sleep(0.3))
+  sched.add_task('overrun', 1.0, lambda: time.sleep(1.2), offset=0.25)
+  sched.add_task('woken', 60.0, lambda: None, offset=0.1)
+  # activity seen by another thread brings 'woken' forward
+  threading.Timer(2.5, sched.wake, args=(('woken',),)).start()
+  sched.run(duration=5)
+
+  for name, stats in sched.stats().items():
+    print('{:>8}: {}'.format(name, stats))
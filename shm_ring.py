@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: shm_ring.py
+#
+# Description: Fixed-layout ring buffer of records in shared memory
+#           (multiprocessing.shared_memory), with one writer process and any
+#           number of reader processes, and no locks.
+#
+#           Layout, all little endian:
+#
+#               header   magic '4s', version B, pad, record size H,
+#                        slots I, pad, write_seq Q                 24 bytes
+#               control  CONTROL_WORDS x Q                         32 bytes
+#               slots    from SLOTS_OFFSET, each slot is
+#                          seq I, crc I, then the record (struct format)
+#
+#           write_seq is the number of records ever published. Record n
+#           goes to slot n % slots. Each slot is a seqlock: the writer sets
+#           its seq to 2n+1 (odd, busy), writes the record and its crc, sets
+#           the seq to 2n+2 and then bumps write_seq (the seq words keep
+#           the low 32 bits). The crc is the CRC-32 of n and the record
+#           bytes. A reader copies the record out of the shared buffer and
+#           keeps it only if the slot seq was 2n+2 both before and after,
+#           and the crc of its copy matches. Otherwise the writer lapped it
+#           and the record counts as lost. Readers never write to the
+#           buffer, so a reader can never hold up or disturb the writer.
+#
+#           Python has no memory barriers, so on a weakly ordered CPU (the
+#           Pi's ARM) a reader may see the seq and the record bytes stores
+#           in another order than they were made. The seq check alone
+#           could then pass a torn record, or the record of an earlier
+#           lap; the crc, which covers n, catches both.
+#
+#           The control words are a tiny side channel in the other
+#           direction (e.g. a measurement request from the main process).
+#           Each word must only ever be written by one process.
+#
+#           The slot words are accessed through a memoryview cast to 'I',
+#           write_seq and the control words through one cast to 'Q', so
+#           each is a single aligned native load or store. struct.pack_into()
+#           would not do: it clears the bytes before it packs them, so a
+#           reader could see 0 for a moment. An aligned 4 byte access is
+#           whole on any CPU the CWS runs on. An 8 byte one is only whole on
+#           a 64 bit CPU: on a 32 bit ARM (a Pi running a 32 bit OS) it is
+#           two stores, and a reader can see a mix of the old and new
+#           halves while the high half changes. For write_seq that is once
+#           every 2^32 records, and a wrong write_seq only costs the lost
+#           count, since each slot is checked on its own. Control words
+#           that need 64 bits (acq_process.py REQUEST_TIME) must allow for
+#           it.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 32 bit slot seq and a crc per record, version 2
+#
+#-------------------------------------------------------------------------------
+
+import struct
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+
+RING_MAGIC = b'CWSM'
+RING_VERSION = 2
+HEADER = struct.Struct('<4sBxHI4xQ')   # magic, version, record size, slots, write_seq
+WRITE_SEQ_WORD = 2                          # byte offset 16
+CONTROL_WORD = HEADER.size // 8             # byte offset 24
+CONTROL_WORDS = 4
+SLOTS_OFFSET = 64
+SEQ_SIZE = 8                                # slot seq and crc
+SEQ_MASK = 0xffffffff
+RECORD_NUMBER = struct.Struct('<Q')         # n as covered by the crc
+
+class SHM_RING:
+  def __init__(self, record, slots=64, name=None, create=True):
+    # record is a struct.Struct, the same in every process. With
+    # create=False the ring called name is attached to, e.g. from a viewer.
+    self.record = record
+    self.slot_size = SEQ_SIZE + (record.size + 7) // 8 * 8
+    self.owner = create
+
+    if create:
+      self.slots = slots
+      size = SLOTS_OFFSET + slots * self.slot_size
+      try:
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+      except FileExistsError:
+        # left over from a process that did not get to close() it
+        shared_memory.SharedMemory(name=name).unlink()
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+      self.buf = self.shm.buf
+      self.buf[:SLOTS_OFFSET] = bytes(SLOTS_OFFSET)
+      HEADER.pack_into(self.buf, 0, RING_MAGIC, RING_VERSION, record.size, slots, 0)
+    else:
+      self.shm = shared_memory.SharedMemory(name=name)
+      # attaching must not make this process unlink the ring on exit
+      resource_tracker.unregister(self.shm._name, 'shared_memory')
+      self.buf = self.shm.buf
+      magic, version, rec_size, self.slots, seq = HEADER.unpack_from(self.buf, 0)
+      if magic != RING_MAGIC or version != RING_VERSION or rec_size != record.size:
+        self.shm.close()
+        raise ValueError('{} is not a version {} CWS ring of {} byte records'.format(
+                         name, RING_VERSION, record.size))
+
+    self.words = self.buf.cast('Q')   # the 8 byte words: write_seq, control
+    self.slot_words = self.buf.cast('I')   # the 4 byte words: slot seq, crc
+    self.name = self.shm.name
+    self.read_seq = 0
+
+  #-------------------------------------
+
+  def close(self):
+    # the process that created the ring also removes it
+    if self.shm is None:
+      return
+    self.words.release()
+    self.words = None
+    self.slot_words.release()
+    self.slot_words = None
+    self.buf = None
+    self.shm.close()
+    if self.owner:
+      self.shm.unlink()
+    self.shm = None
+
+  #-------------------------------------
+
+  def write_seq(self):
+    return self.words[WRITE_SEQ_WORD]
+
+  #-------------------------------------
+
+  def get_control(self, index):
+    return self.words[CONTROL_WORD + index]
+
+  def set_control(self, index, value):
+    self.words[CONTROL_WORD + index] = value
+
+  #-------------------------------------
+
+  def crc(self, n, data):
+    return zlib.crc32(data, zlib.crc32(RECORD_NUMBER.pack(n)))
+
+  #-------------------------------------
+
+  def publish(self, *values):
+    # writer only
+    n = self.words[WRITE_SEQ_WORD]
+    offset = SLOTS_OFFSET + (n % self.slots) * self.slot_size
+    seq = offset // 4
+    data = self.record.pack(*values)
+    self.slot_words[seq] = (2 * n + 1) & SEQ_MASK
+    self.buf[offset + SEQ_SIZE:offset + SEQ_SIZE + len(data)] = data
+    self.slot_words[seq + 1] = self.crc(n, data)
+    self.slot_words[seq] = (2 * n + 2) & SEQ_MASK
+    self.words[WRITE_SEQ_WORD] = n + 1
+    return n
+
+  #-------------------------------------
+
+  def read(self, n):
+    # record n as a tuple, or None if it is not there (not written yet, or
+    # overwritten before or while it was read)
+    offset = SLOTS_OFFSET + (n % self.slots) * self.slot_size
+    seq = offset // 4
+    done = (2 * n + 2) & SEQ_MASK
+    if self.slot_words[seq] != done:
+      return None
+    data = bytes(self.buf[offset + SEQ_SIZE:offset + SEQ_SIZE + self.record.size])
+    crc = self.slot_words[seq + 1]
+    if self.slot_words[seq] != done or self.crc(n, data) != crc:
+      return None
+    return self.record.unpack(data)
+
+  #-------------------------------------
+
+  def latest(self):
+    # (n, newest record), or (None, None) if nothing has been published
+    for attempt in range(3):
+      n = self.write_seq() - 1
+      if n < 0:
+        return None, None
+      values = self.read(n)
+      if values is not None:
+        return n, values
+    return None, None
+
+  #-------------------------------------
+
+  def read_new(self):
+    # records published since the last read_new(), and how many of them
+    # were overwritten before they could be read
+    end = self.write_seq()
+    start = max(self.read_seq, end - self.slots)
+    lost = start - self.read_seq
+
+    records = []
+    for n in range(start, end):
+      values = self.read(n)
+      if values is None:
+        lost += 1
+      else:
+        records.append(values)
+    self.read_seq = end
+    return records, lost
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  import multiprocessing
+
+  print('SHM_RING class test example')
+
+  # a writer process publishing bursts of half a small ring, and this
+  # process checking that every record it reads is whole. The pause after
+  # each burst lets the reader keep up, so nearly every record is read
+  # while the writer is still busy in the slots next to it.
+  import time
+
+  record = struct.Struct('<Qd8I')
+  ring = SHM_RING(record, slots=16)
+
+  def writer(ring, count):
+    for ii in range(count):
+      ring.publish(ii, ii * 0.5, *([ii & 0xffffffff] * 8))
+      if ii % 8 == 7:
+        time.sleep(0.0005)
+
+  count = 20000
+  proc = multiprocessing.get_context('fork').Process(target=writer, args=(ring, count))
+  proc.start()
+
+  # (another program would attach with SHM_RING(record, name=ring.name,
+  # create=False), here the creating object reads just the same)
+  reader = ring
+  seen = lost = torn = 0
+  while proc.is_alive() or reader.read_seq < count:
+    records, missed = reader.read_new()
+    lost += missed
+    for values in records:
+      seen += 1
+      if values[1] != values[0] * 0.5 or any(v != values[0] for v in values[2:]):
+        torn += 1
+  proc.join()
+
+  print('{} records read, {} lost to overwrites, {} torn'.format(seen, lost, torn))
+  print('latest: {}'.format(reader.latest()[0]))
+  ring.close()
@@ -0,0 +1,752 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: sim_hw.py
+#
+# Description: Simulated hardware for running the CWS code on any Linux box.
+#           install() puts fake RPi.GPIO and smbus2 modules into sys.modules
+#           and switches time.sleep(), time.monotonic(), time.monotonic_ns(),
+#           time.time() and time.time_ns() over to a shared virtual clock.
+#           It must be called before any of the driver modules are imported.
+#           After that HC_SR04, DS3231, BME280_WRAPPER, HALL_SENSOR, LED and
+#           the cws_main.py loop all run unchanged against:
+#
+#             * SIM_HC_SR04 - an echo line driven by a water level model.
+#               Works with both polling and edge detect echo timing. There
+#               is one per bucket, each with its own water model, and a
+#               ping while another ranger's sound is still about
+#               (CROSSTALK_NS after its echo) comes back short.
+#             * SIM_HALL    - a hall sensor pin that follows the water level
+#               (ON when the water runs out) or a scripted list of changes.
+#               With edge detection on it checks the water level every
+#               HALL_CHECK_NS and fires the edges.
+#             * SIM_DS3231  - the DS3231 time registers, kept from the
+#               virtual clock.
+#             * SIM_BME280  - the BME280 calibration and data registers. Raw
+#               ADC values are worked back from a simple weather model so the
+#               real bme280 module's compensation returns the model values.
+#
+#           The virtual clock only moves when the code sleeps or polls a pin
+#           (each GPIO.input() call costs INPUT_COST_NS of virtual time), so
+#           time runs as fast as the code does. A simulated week of 10
+#           second cycles finishes in seconds. time.perf_counter() and
+#           time.process_time() are left alone so real costs can still be
+#           measured.
+#
+#           The clock is shared by all threads, and a sleep in any thread
+#           moves it forward. Threaded code still works, but concurrent
+#           sleeps add up instead of overlapping.
+#
+#           Edge callbacks are run in the thread that moved the clock past
+#           the edge, not in a separate GPIO event thread.
+#
+#           VIRTUAL_CLOCK.wait() is threading.Event.wait() on the virtual
+#           clock: it sleeps, but stops at the clock event (e.g. an edge
+#           callback) that sets the event. SCHEDULER(wait=...) uses it.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Hall pin edges from the water level
+#          20261018 Water model buckets from a volume table
+#          20261018 A ranger and water model per bucket, crosstalk
+#          20261018 VIRTUAL_CLOCK.wait()
+#          20261018 Test example reads the RTC and the hall sensor
+#
+#-------------------------------------------------------------------------------
+
+import heapq
+import math
+import random
+import sys
+import threading
+import time
+import types
+
+# these keep references to the real time functions once imported, so import
+# them before install() swaps the time module functions out
+import concurrent.futures
+import queue
+
+# real time functions, saved before install() replaces them
+real_sleep = time.sleep
+real_monotonic = time.monotonic
+real_monotonic_ns = time.monotonic_ns
+real_time = time.time
+real_time_ns = time.time_ns
+
+# virtual time cost of one GPIO.input() call (a Pi 3B takes about 1 us)
+INPUT_COST_NS = 1000
+
+# delay from the end of the trigger pulse to the start of the echo pulse
+ECHO_DELAY_NS = 450000
+
+# the echo pulse length an HC-SR04 gives when nothing comes back
+NO_ECHO_NS = 38000000
+
+# how long a ping can still be heard by the other rangers after its echo
+CROSSTALK_NS = 50000000
+
+# how often a water level driven hall pin is checked for edges
+HALL_CHECK_NS = 1000000000
+
+#-------------------------------------------------------------------------------
+
+class VIRTUAL_CLOCK:
+  def __init__(self, start_time=None):
+    self.lock = threading.RLock()
+    self.now_ns = 0
+    self.epoch = real_time() if start_time is None else start_time
+    self.events = []   # heap of (time ns, sequence, function)
+    self.sequence = 0
+
+  #-------------------------------------
+
+  def monotonic_ns(self):
+    return self.now_ns
+
+  def monotonic(self):
+    return self.now_ns / 1e9
+
+  def time(self):
+    return self.epoch + self.now_ns / 1e9
+
+  def time_ns(self):
+    return int(self.epoch * 1e9) + self.now_ns
+
+  #-------------------------------------
+
+  def sleep(self, seconds):
+    if seconds < 0:
+      raise ValueError('sleep length must be non-negative')
+    self.advance_to(self.now_ns + int(seconds * 1e9))
+
+  #-------------------------------------
+
+  def wait(self, event, seconds):
+    # sleep(), ending at the clock event that sets event. Returns whether
+    # event is set.
+    end_ns = self.now_ns + int(seconds * 1e9)
+    with self.lock:
+      while not event.is_set() and len(self.events) > 0 and self.events[0][0] <= end_ns:
+        event_ns, seq, fn = heapq.heappop(self.events)
+        self.now_ns = max(self.now_ns, event_ns)
+        fn()
+      if not event.is_set():
+        self.now_ns = max(self.now_ns, end_ns)
+      return event.is_set()
+
+  #-------------------------------------
+
+  def call_at(self, t_ns, fn):
+    with self.lock:
+      heapq.heappush(self.events, (t_ns, self.sequence, fn))
+      self.sequence += 1
+
+  #-------------------------------------
+
+  def advance_to(self, t_ns):
+    # run every event due up to t_ns in time order, with the clock set to
+    # the event time while it runs
+    with self.lock:
+      while len(self.events) > 0 and self.events[0][0] <= t_ns:
+        event_ns, seq, fn = heapq.heappop(self.events)
+        self.now_ns = max(self.now_ns, event_ns)
+        fn()
+      self.now_ns = max(self.now_ns, t_ns)
+
+#-------------------------------------------------------------------------------
+
+class WATER_MODEL:
+  # Water level in one cylindrical bucket, or any buckets described by a
+  # volume table (set_table()). The chickens drink during the day only, and
+  # the bucket is refilled to full when it drops below refill_liters during
+  # the day.
+
+  def __init__(self, clock, full_distance_cm=5.4, empty_distance_cm=37.4,
+               radius_cm=(10.75 / 2) * 2.54, liters_per_day=3.0,
+               refill_liters=1.0, start_fraction=0.8, day_start=6, day_end=20):
+    self.clock = clock
+    self.full_distance_cm = full_distance_cm
+    self.empty_distance_cm = empty_distance_cm
+    self.area_cm2 = math.pi * radius_cm * radius_cm
+    self.day_start = day_start
+    self.day_end = day_end
+    self.liters_per_day = liters_per_day
+    self.refill_liters = refill_liters
+
+    self.table = None   # a volume_table.VOLUME_TABLE, see set_table()
+    self.capacity_liters = self.area_cm2 * (empty_distance_cm - full_distance_cm) / 1000
+    self.liters = self.capacity_liters * start_fraction
+    self.last_time = clock.time()
+    self.refills = []  # (time, liters added)
+
+  #-------------------------------------
+
+  def set_table(self, table):
+    # model buckets of any shape (and number) from a height to volume
+    # table instead of one cylinder, keeping how full they are
+    fraction = self.liters / self.capacity_liters
+    self.table = table
+    self.capacity_liters = table.volume(self.empty_distance_cm - self.full_distance_cm)
+    self.liters = self.capacity_liters * fraction
+
+  #-------------------------------------
+
+  def update(self):
+    # integrate drinking in steps of up to a minute
+    now = self.clock.time()
+    rate_lps = self.liters_per_day / ((self.day_end - self.day_start) * 3600)
+    while self.last_time < now:
+      step = min(now - self.last_time, 60)
+      hour = time.localtime(self.last_time).tm_hour
+      if self.day_start <= hour < self.day_end:
+        self.liters = max(self.liters - rate_lps * step, 0)
+        if self.liters < self.refill_liters:
+          self.refills.append((self.last_time, self.capacity_liters - self.liters))
+          self.liters = self.capacity_liters
+      self.last_time += step
+
+  #-------------------------------------
+
+  def distance_cm(self):
+    self.update()
+    if self.table is not None:
+      return self.empty_distance_cm - self.table.height(self.liters)
+    return self.empty_distance_cm - self.liters * 1000 / self.area_cm2
+
+#-------------------------------------------------------------------------------
+
+class WEATHER_MODEL:
+  # daily temperature and humidity swing, slow pressure swing
+
+  def __init__(self, clock, mean_temp=18.0, temp_swing=8.0):
+    self.clock = clock
+    self.mean_temp = mean_temp
+    self.temp_swing = temp_swing
+
+  #-------------------------------------
+
+  def day_phase(self):
+    t = time.localtime(self.clock.time())
+    hour = t.tm_hour + t.tm_min / 60
+    return math.sin(2 * math.pi * (hour - 9) / 24)  # warmest mid afternoon
+
+  def temp(self):
+    return self.mean_temp + self.temp_swing * self.day_phase()
+
+  def pressure(self):
+    return 1013.0 + 6.0 * math.sin(2 * math.pi * self.clock.time() / (3 * 86400))
+
+  def humidity(self):
+    return 60.0 - 20.0 * self.day_phase()
+
+#-------------------------------------------------------------------------------
+
+class SIM_HC_SR04:
+  # air is shared by all the rangers: the last ping and until when it can
+  # still be heard
+
+  def __init__(self, gpio, trig_pin, echo_pin, water, weather, noise_cm=0.15,
+               outlier_rate=0.02, seed=1, air=None):
+    self.gpio = gpio
+    self.trig_pin = trig_pin
+    self.echo_pin = echo_pin
+    self.water = water
+    self.weather = weather
+    self.noise_cm = noise_cm
+    self.outlier_rate = outlier_rate
+    self.random = random.Random(seed)
+    self.echo = (0, 0)  # start and stop time (ns) of the last echo pulse
+    self.pings = 0
+    self.air = {} if air is None else air
+    self.crosstalk = 0  # echoes cut short by another ranger's ping
+
+    gpio.attach(trig_pin, self)
+    gpio.attach(echo_pin, self)
+
+  #-------------------------------------
+
+  def on_output(self, pin, value, prev):
+    if pin != self.trig_pin or not (prev == 1 and value == 0):
+      return
+
+    # falling edge of the trigger pulse - schedule the echo pulse
+    self.pings += 1
+    if self.random.random() < self.outlier_rate:
+      echo_ns = NO_ECHO_NS
+    else:
+      d_cm = self.water.distance_cm() + self.random.gauss(0, self.noise_cm)
+      speed = 331 + 0.6 * min(max(self.weather.temp(), 0), 100)
+      echo_ns = int(2 * d_cm / 100 / speed * 1e9)
+
+    now = self.gpio.clock.now_ns
+    if self.air.get('ranger', self) is not self and self.air['until'] > now:
+      # the other ranger's sound gets back first and ends the echo early
+      self.crosstalk += 1
+      echo_ns = int(echo_ns * self.random.uniform(0.2, 0.9))
+
+    start = now + ECHO_DELAY_NS
+    self.echo = (start, start + echo_ns)
+    self.air.update(ranger=self, until=self.echo[1] + CROSSTALK_NS)
+
+    if self.gpio.watching(self.echo_pin):
+      # edge detect mode - fire both edges now, as if the caller waited
+      self.gpio.schedule_edge(self.echo_pin, self.echo[0])
+      self.gpio.schedule_edge(self.echo_pin, self.echo[1])
+      self.gpio.clock.advance_to(self.echo[1])
+
+  #-------------------------------------
+
+  def level(self, pin):
+    if pin == self.echo_pin:
+      return 1 if self.echo[0] <= self.gpio.clock.now_ns < self.echo[1] else 0
+    return self.gpio.outputs.get(pin, 0)
+
+#-------------------------------------------------------------------------------
+
+class SIM_HALL:
+  # Hall sensor output (active LOW). With a script of (seconds from now,
+  # state) pairs the pin follows the script, otherwise it reads ON (LOW)
+  # whenever the water model is below out_liters.
+
+  def __init__(self, gpio, pin, water=None, out_liters=0.5, script=None):
+    self.gpio = gpio
+    self.pin = pin
+    self.water = water
+    self.out_liters = out_liters
+    self.state = 1
+    self.scripted = script is not None
+
+    gpio.attach(pin, self)
+    if script is not None:
+      for offset, state in script:
+        self.set_at(gpio.clock.now_ns + int(offset * 1e9), state)
+
+  #-------------------------------------
+
+  def set_at(self, t_ns, state):
+    def change():
+      if state != self.state:
+        self.state = state
+        self.gpio.edge(self.pin)
+    self.gpio.clock.call_at(t_ns, change)
+
+  #-------------------------------------
+
+  def on_output(self, pin, value, prev):
+    pass
+
+  #-------------------------------------
+
+  def on_watch(self, pin):
+    # edge detection was turned on - follow the water level with edges
+    if not self.scripted and self.water is not None:
+      self.gpio.clock.call_at(self.gpio.clock.now_ns + HALL_CHECK_NS, self.check)
+
+  def check(self):
+    if not self.gpio.watching(self.pin):
+      return
+    prev = self.state
+    if self.level(self.pin) != prev:
+      self.gpio.edge(self.pin)
+    self.gpio.clock.call_at(self.gpio.clock.now_ns + HALL_CHECK_NS, self.check)
+
+  #-------------------------------------
+
+  def level(self, pin):
+    if not self.scripted and self.water is not None:
+      self.water.update()
+      self.state = 0 if self.water.liters < self.out_liters else 1
+    return self.state
+
+#-------------------------------------------------------------------------------
+
+class GPIO_SIM:
+  # stand-in for the RPi.GPIO module
+
+  BCM = 11
+  BOARD = 10
+  OUT = 0
+  IN = 1
+  LOW = 0
+  HIGH = 1
+  PUD_OFF = 20
+  PUD_DOWN = 21
+  PUD_UP = 22
+  RISING = 31
+  FALLING = 32
+  BOTH = 33
+
+  def __init__(self, clock):
+    self.clock = clock
+    self.devices = {}    # pin -> simulated device
+    self.outputs = {}    # pin -> last output value
+    self.callbacks = {}  # pin -> edge callback
+
+  #-------------------------------------
+
+  def attach(self, pin, device):
+    self.devices[pin] = device
+
+  def watching(self, pin):
+    return pin in self.callbacks
+
+  def schedule_edge(self, pin, t_ns):
+    self.clock.call_at(t_ns, lambda: self.edge(pin))
+
+  def edge(self, pin):
+    callback = self.callbacks.get(pin)
+    if callback is not None:
+      callback(pin)
+
+  #-------------------------------------
+
+  def setwarnings(self, flag):
+    pass
+
+  def setmode(self, mode):
+    pass
+
+  def setup(self, pin, mode, initial=0, pull_up_down=None):
+    if mode == self.OUT:
+      self.outputs[pin] = initial
+
+  def cleanup(self, pin=None):
+    if pin is None:
+      self.callbacks.clear()
+    else:
+      self.callbacks.pop(pin, None)
+
+  #-------------------------------------
+
+  def output(self, pin, value):
+    prev = self.outputs.get(pin, 0)
+    self.outputs[pin] = 1 if value else 0
+    device = self.devices.get(pin)
+    if device is not None:
+      device.on_output(pin, self.outputs[pin], prev)
+
+  #-------------------------------------
+
+  def input(self, pin):
+    self.clock.advance_to(self.clock.now_ns + INPUT_COST_NS)
+    device = self.devices.get(pin)
+    if device is not None:
+      return device.level(pin)
+    return self.outputs.get(pin, 1)  # inputs are pulled up
+
+  #-------------------------------------
+
+  def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+    self.callbacks[pin] = callback
+    device = self.devices.get(pin)
+    if hasattr(device, 'on_watch'):
+      device.on_watch(pin)
+
+  def remove_event_detect(self, pin):
+    self.callbacks.pop(pin, None)
+
+#-------------------------------------------------------------------------------
+
+def bcd(value):
+  return (value // 10) * 16 + (value % 10)
+
+def from_bcd(value):
+  return (value // 16) * 10 + (value % 16)
+
+#-------------------------------------------------------------------------------
+
+class SIM_DS3231:
+  def __init__(self, clock):
+    self.clock = clock
+    self.offset = 0.0  # seconds the RTC is set away from the virtual clock
+    self.regs = [0] * 19
+
+  #-------------------------------------
+
+  def read(self, reg, length):
+    t = time.localtime(self.clock.time() + self.offset)
+    self.regs[0:7] = [bcd(t.tm_sec), bcd(t.tm_min), bcd(t.tm_hour),
+                      (t.tm_wday + 1) % 7 + 1, bcd(t.tm_mday), bcd(t.tm_mon),
+                      bcd(t.tm_year - 2000)]
+    return self.regs[reg:reg + length]
+
+  #-------------------------------------
+
+  def write(self, reg, data):
+    self.regs[reg:reg + len(data)] = data
+    if reg == 0 and len(data) >= 7:
+      d = [from_bcd(x) for x in data[:7]]
+      ts = time.mktime((2000 + d[6], d[5] & 0x1F, d[4], d[2] & 0x3F, d[1], d[0], 0, 0, -1))
+      self.offset = ts - self.clock.time()
+
+#-------------------------------------------------------------------------------
+
+# datasheet example calibration values
+BME280_CAL = {
+  'T1': 27504, 'T2': 26435, 'T3': -1000,
+  'P1': 36477, 'P2': -10685, 'P3': 3024, 'P4': 2855, 'P5': 140, 'P6': -7,
+  'P7': 15500, 'P8': -14600, 'P9': 6000,
+  'H1': 75, 'H2': 362, 'H3': 0, 'H4': 313, 'H5': 50, 'H6': 30,
+}
+
+class SIM_BME280:
+  def __init__(self, weather, cal=BME280_CAL):
+    self.weather = weather
+    self.cal = cal
+    self.regs = [0] * 256
+    self.regs[0xD0] = 0x60  # chip id
+
+    # calibration registers, little endian
+    def put16(reg, value):
+      value &= 0xFFFF
+      self.regs[reg] = value & 0xFF
+      self.regs[reg + 1] = value >> 8
+    reg = 0x88
+    for name in ('T1', 'T2', 'T3', 'P1', 'P2', 'P3', 'P4', 'P5', 'P6', 'P7', 'P8', 'P9'):
+      put16(reg, cal[name])
+      reg += 2
+    self.regs[0xA1] = cal['H1']
+    put16(0xE1, cal['H2'])
+    self.regs[0xE3] = cal['H3']
+    self.regs[0xE4] = (cal['H4'] >> 4) & 0xFF
+    self.regs[0xE5] = (cal['H4'] & 0x0F) | ((cal['H5'] & 0x0F) << 4)
+    self.regs[0xE6] = (cal['H5'] >> 4) & 0xFF
+    self.regs[0xE7] = cal['H6'] & 0xFF
+
+  #-------------------------------------
+
+  def read(self, reg, length):
+    if reg <= 0xF7 < reg + length:
+      self.sample()
+    return self.regs[reg:reg + length]
+
+  #-------------------------------------
+
+  def write(self, reg, data):
+    self.regs[reg:reg + len(data)] = data
+
+  #-------------------------------------
+
+  def sample(self):
+    # work the model values back to raw ADC readings
+    adc_t = self.raw_temp(self.weather.temp())
+    t_fine = self.comp_temp(adc_t)[1]
+    adc_p = self.raw_pressure(self.weather.pressure(), t_fine)
+    adc_h = self.raw_humidity(self.weather.humidity(), t_fine)
+
+    self.regs[0xF7:0xFA] = [(adc_p >> 12) & 0xFF, (adc_p >> 4) & 0xFF, (adc_p << 4) & 0xF0]
+    self.regs[0xFA:0xFD] = [(adc_t >> 12) & 0xFF, (adc_t >> 4) & 0xFF, (adc_t << 4) & 0xF0]
+    self.regs[0xFD:0xFF] = [(adc_h >> 8) & 0xFF, adc_h & 0xFF]
+
+  #-------------------------------------
+  # Compensation formulas (floating point versions, BME280 datasheet 8.1)
+  # and their inverses. Each formula is at most quadratic in the raw value,
+  # so each inverse is a single quadratic solve.
+
+  def comp_temp(self, adc):
+    c = self.cal
+    var1 = (adc / 16384.0 - c['T1'] / 1024.0) * c['T2']
+    var2 = ((adc / 131072.0 - c['T1'] / 8192.0) ** 2) * c['T3']
+    t_fine = var1 + var2
+    return t_fine / 5120.0, t_fine
+
+  def raw_temp(self, temp):
+    # with x = adc / 131072 - T1 / 8192:  t_fine = 8 * T2 * x + T3 * x^2
+    c = self.cal
+    x = solve_quadratic(c['T3'], 8.0 * c['T2'], -temp * 5120.0)
+    return clamp_adc((x + c['T1'] / 8192.0) * 131072.0, 20)
+
+  def comp_pressure(self, adc, t_fine):
+    var1, var2 = self.pressure_terms(t_fine)
+    c = self.cal
+    p = 1048576.0 - adc
+    p = ((p - var2 / 4096.0) * 6250.0) / var1
+    var1 = c['P9'] * p * p / 2147483648.0
+    var2 = p * c['P8'] / 32768.0
+    return (p + (var1 + var2 + c['P7']) / 16.0) / 100  # hPa
+
+  def raw_pressure(self, pressure, t_fine):
+    var1, var2 = self.pressure_terms(t_fine)
+    c = self.cal
+    p = solve_quadratic(c['P9'] / 2147483648.0 / 16.0,
+                        1.0 + c['P8'] / 32768.0 / 16.0,
+                        c['P7'] / 16.0 - pressure * 100)
+    return clamp_adc(1048576.0 - (p * var1 / 6250.0 + var2 / 4096.0), 20)
+
+  def pressure_terms(self, t_fine):
+    c = self.cal
+    var1 = t_fine / 2.0 - 64000.0
+    var2 = var1 * var1 * c['P6'] / 32768.0
+    var2 = var2 + var1 * c['P5'] * 2.0
+    var2 = var2 / 4.0 + c['P4'] * 65536.0
+    var1 = (c['P3'] * var1 * var1 / 524288.0 + c['P2'] * var1) / 524288.0
+    var1 = (1.0 + var1 / 32768.0) * c['P1']
+    return var1, var2
+
+  def comp_humidity(self, adc, t_fine):
+    offset, scale = self.humidity_terms(t_fine)
+    h = (adc - offset) * scale
+    return h * (1.0 - self.cal['H1'] * h / 524288.0)
+
+  def raw_humidity(self, humidity, t_fine):
+    offset, scale = self.humidity_terms(t_fine)
+    h = solve_quadratic(-self.cal['H1'] / 524288.0, 1.0, -humidity)
+    return clamp_adc(h / scale + offset, 16)
+
+  def humidity_terms(self, t_fine):
+    c = self.cal
+    h = t_fine - 76800.0
+    offset = c['H4'] * 64.0 + c['H5'] / 16384.0 * h
+    scale = c['H2'] / 65536.0 * (1.0 + c['H6'] / 67108864.0 * h * (1.0 + c['H3'] / 67108864.0 * h))
+    return offset, scale
+
+#-------------------------------------------------------------------------------
+
+def solve_quadratic(a, b, c):
+  # the root of a*x^2 + b*x + c = 0 closest to the linear solution -c/b,
+  # written so it stays accurate when a is tiny or zero
+  return -2 * c / (b + math.copysign(math.sqrt(b * b - 4 * a * c), b))
+
+#-------------------------------------------------------------------------------
+
+def clamp_adc(value, bits):
+  return min(max(int(round(value)), 0), (1 << bits) - 1)
+
+#-------------------------------------------------------------------------------
+
+class SMBUS_SIM:
+  # stand-in for smbus2.SMBus, talking to the simulated devices on a bus
+
+  def __init__(self, world, bus_id=1):
+    self.devices = world.i2c_devices.get(bus_id, {})
+
+  #-------------------------------------
+
+  def device(self, addr):
+    if addr not in self.devices:
+      raise OSError(121, 'Remote I/O error')  # what a missing device gives
+    return self.devices[addr]
+
+  #-------------------------------------
+
+  def read_byte_data(self, addr, reg):
+    return self.device(addr).read(reg, 1)[0]
+
+  def write_byte_data(self, addr, reg, value):
+    self.device(addr).write(reg, [value])
+
+  def read_word_data(self, addr, reg):
+    data = self.device(addr).read(reg, 2)
+    return data[0] | (data[1] << 8)
+
+  def write_word_data(self, addr, reg, value):
+    self.device(addr).write(reg, [value & 0xFF, value >> 8])
+
+  def read_i2c_block_data(self, addr, reg, length):
+    return list(self.device(addr).read(reg, length))
+
+  def write_i2c_block_data(self, addr, reg, data):
+    self.device(addr).write(reg, list(data))
+
+  def close(self):
+    pass
+
+#-------------------------------------------------------------------------------
+
+class SIM_WORLD:
+  # everything the CWS talks to, wired up with the cws_main.py pin numbers.
+  # Each (trigger, echo) pin pair is a ranger over its own bucket. The
+  # buckets start at different levels and the chickens drink more from the
+  # first, so they do not run low together. The hall sensor is in the first.
+
+  def __init__(self, start_time=None, ranger_pins=((23, 24), (17, 27)), hall_pin=21,
+               hall_script=None, seed=1):
+    self.clock = VIRTUAL_CLOCK(start_time)
+    self.weather = WEATHER_MODEL(self.clock)
+    self.waters = [WATER_MODEL(self.clock, liters_per_day=1.8 - 0.6 * (k % 2),
+                               start_fraction=0.8 - 0.3 * (k % 2))
+                   for k in range(len(ranger_pins))]
+
+    self.gpio = GPIO_SIM(self.clock)
+    air = {}
+    self.rangers = [SIM_HC_SR04(self.gpio, trig_pin, echo_pin, water, self.weather,
+                                seed=seed + k, air=air)
+                    for k, ((trig_pin, echo_pin), water) in enumerate(zip(ranger_pins, self.waters))]
+    self.water = self.waters[0]
+    self.ranger = self.rangers[0]
+    self.hall = SIM_HALL(self.gpio, hall_pin, self.water, script=hall_script)
+
+    self.i2c_devices = {1: {0x68: SIM_DS3231(self.clock),
+                            0x76: SIM_BME280(self.weather)}}
+
+#-------------------------------------------------------------------------------
+
+world = None
+
+def install(sim_world=None):
+  # Use the simulated hardware and virtual clock. Call before importing any
+  # of the driver modules.
+  global world
+  world = SIM_WORLD() if sim_world is None else sim_world
+
+  rpi = types.ModuleType('RPi')
+  rpi.GPIO = world.gpio
+  sys.modules['RPi'] = rpi
+  sys.modules['RPi.GPIO'] = world.gpio
+
+  smbus2 = types.ModuleType('smbus2')
+  smbus2.SMBus = lambda bus_id=1: SMBUS_SIM(world, bus_id)
+  sys.modules['smbus2'] = smbus2
+
+  time.sleep = world.clock.sleep
+  time.monotonic = world.clock.monotonic
+  time.monotonic_ns = world.clock.monotonic_ns
+  time.time = world.clock.time
+  time.time_ns = world.clock.time_ns
+
+  return world
+
+#-------------------------------------------------------------------------------
+
+def uninstall():
+  global world
+  time.sleep = real_sleep
+  time.monotonic = real_monotonic
+  time.monotonic_ns = real_monotonic_ns
+  time.time = real_time
+  time.time_ns = real_time_ns
+  for name in ('RPi', 'RPi.GPIO', 'smbus2'):
+    sys.modules.pop(name, None)
+  world = None
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  print('Simulated hardware test example - one simulated day of readings')
+  # the water runs out for the hall sensor half an hour in the afternoon
+  install(SIM_WORLD(hall_script=[(12.9 * 3600, 0), (13.4 * 3600, 1)]))
+
+  import RPi.GPIO as GPIO
+  from chronodot import DS3231
+  from hc_sr04_sensor import HC_SR04
+  from hall_sensor import HALL_SENSOR
+
+  GPIO.setmode(GPIO.BCM)
+  rtc = DS3231()
+  ranger = HC_SR04(23, 24, edge_detect=True)
+  hall = HALL_SENSOR(21, edge_detect=True)
+
+  t0 = time.perf_counter()
+  for hour in range(24):
+    d_cm = ranger.calc_distance(world.weather.temp(), adaptive=True)
+    rtc.get_date_time()
+    hall.state()
+    print('{}  range {:.2f} cm (model {:.2f})  {}'.format(
+          rtc, d_cm, world.water.distance_cm(), hall))
+    time.sleep(3600)
+  print('rtc - clock: {} s'.format(rtc.get_timestamp() - int(time.time())))
+  print('hall transitions: {}'.format(hall.snapshot()['events']))
+  print('refills: {}'.format(world.water.refills))
+  print('pings: {}  real time: {:.3f} s'.format(world.ranger.pings, time.perf_counter() - t0))
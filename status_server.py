@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: status_server.py
+#
+# Description: Small embedded HTTP server for the CWS status, standard library
+#           only. It never touches the sensors or the store: the main loop
+#           publishes snapshots once per cycle, and requests are answered
+#           from those.
+#
+#           publish() encodes each snapshot to JSON bytes (with an ETag) in
+#           the calling thread, then swaps the whole path -> response dict in
+#           one assignment. A request thread picks up either the old dict or
+#           the new one, never a mix. Serving a request is a dict lookup and a
+#           socket write, so any number of polling clients cannot cause
+#           sensor I/O or hold up acquisition. Clients that send
+#           If-None-Match with the current ETag get a 304.
+#
+#           The CWS main loop publishes:
+#             /status     - the latest readings
+#             /estimates  - consumption rates, empty time and last refill
+#             /history    - the last week of volume and temperature, from
+#                           the store's rollups, refreshed every few minutes
+#
+#           NaN values go out as null, so the output is plain JSON.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#
+#-------------------------------------------------------------------------------
+
+import hashlib
+import http.server
+import json
+import math
+import threading
+
+class STATUS_SERVER:
+  def __init__(self, port=8080, addr='127.0.0.1', max_age=10):
+    self.max_age = max_age      # seconds clients may cache a response
+    self.responses = {}         # path -> (body bytes, etag)
+    self.publishes = 0
+    self.requests = 0
+
+    server = self
+    class HANDLER(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        server.handle(self)
+
+      def log_message(self, format, *args):
+        pass
+
+    self.httpd = http.server.ThreadingHTTPServer((addr, port), HANDLER)
+    self.httpd.daemon_threads = True
+    self.thread = threading.Thread(target=self.httpd.serve_forever, name='status', daemon=True)
+    self.thread.start()
+
+  #-------------------------------------
+
+  def close(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+  #-------------------------------------
+
+  def publish(self, snapshots):
+    # snapshots is a dict of path -> JSON-able object. Paths not given keep
+    # their last response.
+    responses = dict(self.responses)
+    for path, data in snapshots.items():
+      body = json.dumps(clean(data), separators=(',', ':')).encode()
+      etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:16])
+      responses[path] = (body, etag)
+    index = json.dumps(sorted(responses)).encode()
+    responses['/'] = (index, '"{}"'.format(hashlib.sha1(index).hexdigest()[:16]))
+
+    self.responses = responses   # the atomic swap
+    self.publishes += 1
+
+  #-------------------------------------
+
+  def handle(self, request):
+    self.requests += 1
+    path = request.path.split('?')[0]
+    response = self.responses.get(path)
+    if response is None:
+      request.send_error(404)
+      return
+
+    body, etag = response
+    if request.headers.get('If-None-Match') == etag:
+      request.send_response(304)
+      request.send_header('ETag', etag)
+      request.end_headers()
+      return
+
+    request.send_response(200)
+    request.send_header('Content-Type', 'application/json')
+    request.send_header('Content-Length', str(len(body)))
+    request.send_header('Cache-Control', 'max-age={}'.format(self.max_age))
+    request.send_header('ETag', etag)
+    request.send_header('Access-Control-Allow-Origin', '*')
+    request.end_headers()
+    request.wfile.write(body)
+
+#-------------------------------------------------------------------------------
+
+def clean(data):
+  # copy of data with NaN / inf replaced by None and tuples as lists
+  if isinstance(data, float):
+    return data if math.isfinite(data) else None
+  if isinstance(data, dict):
+    return {str(k): clean(v) for k, v in data.items()}
+  if isinstance(data, (list, tuple)):
+    return [clean(v) for v in data]
+  return data
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  import time
+  import urllib.request
+
+  print('STATUS_SERVER class test example')
+  server = STATUS_SERVER(port=0)
+  port = server.httpd.server_address[1]
+
+  server.publish({'/status': {'time': time.time(), 'volume': 12.5, 'range': math.nan}})
+  url = 'http://127.0.0.1:{}/status'.format(port)
+  with urllib.request.urlopen(url) as r:
+    etag = r.headers['ETag']
+    print(r.status, etag, r.read())
+
+  request = urllib.request.Request(url, headers={'If-None-Match': etag})
+  try:
+    urllib.request.urlopen(request)
+  except urllib.error.HTTPError as e:
+    print(e.code, 'not modified')
+
+  # many clients
+  t0 = time.perf_counter()
+  for ii in range(500):
+    urllib.request.urlopen(url).read()
+  print('{:.0f} requests/s'.format(500 / (time.perf_counter() - t0)))
+  server.close()
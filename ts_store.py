@@ -0,0 +1,701 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+#  Filename: ts_store.py
+#
+#  Description: Append-only binary time-series store for the CWS readings.
+#             Every record is one fixed-width little endian run of readings:
+#
+#                 time       float64  (seconds since the epoch, first reading)
+#                 time_end   float64  (seconds since the epoch, last reading)
+#                 count      uint32   (number of readings in the run)
+#                 temp       float32  (C)
+#                 pressure   float32  (hPa)
+#                 humidity   float32  (%rH)
+#                 range      float32  (cm, sensor to water surface)
+#                 volume     float32  (liters)
+#                 hall       uint8    (raw hall sensor pin state)
+#
+#             Missing values are stored as NaN (hall as 255).
+#
+#             Run-length compaction: when the store is given a dict of
+#             per-field deadbands, e.g. {'range': 0.3, 'temp': 1.0}, a new
+#             reading that is within every deadband of the first reading of
+#             the current run (and has the same hall state) just extends
+#             that run instead of creating a new record. The run is written
+#             as one record, with the mean of its readings, when a reading
+#             falls outside the deadbands or the run is max_run_seconds
+#             long. The limit has to be longer than the sampling interval,
+#             or every run closes at one reading; the default, 1800 s, is
+#             twice the slowest (night) interval of cws_main.py. As flush()
+#             keeps the pending run on disk (below), a longer one costs
+#             nothing in a crash. query() expands runs back into
+#             evenly spaced readings, so readers never see the difference.
+#             Without deadbands every reading is its own run of 1.
+#
+#             flush() also writes the pending run as it stands so far, one
+#             record past the end of the segment that is not counted in it
+#             yet. The next flush() writes over it (with the run when it is
+#             closed, or with the longer pending run), so the open run costs
+#             no more than the buffer in a crash. A store reopened after a
+#             crash finds it as the last record, a closed run.
+#
+#             Records go to numbered segment files in a directory. Each
+#             segment starts with a small header (magic, version, record
+#             size) and holds at most segment_records records before the
+#             store rotates to a new segment.
+#
+#             Appends are buffered in memory and written out in batches of
+#             batch_size records. The fsync policy controls durability:
+#               * 'always' - write and fsync every record
+#               * 'flush'  - fsync after every batch write (default)
+#               * 'never'  - leave it to the OS
+#
+#             Because records are fixed width and timestamps only go up,
+#             query() can bisect: first over the in-memory segment index
+#             (first/last timestamp of every segment), then inside a segment
+#             by seeking straight to record N. Nothing is ever scanned.
+#
+#             Rollups: the store also keeps pre-aggregated tiers of the
+#             volume and temperature (by default 1 minute, 15 minute and
+#             hourly buckets) with the min, max and mean of each bucket.
+#             Every reading is added to the open bucket of each tier as it
+#             arrives. Finished buckets are written, one fixed-width record
+#             each, to rollup_<seconds>.dat in the store directory with the
+#             rest of the batch. query_rollup() picks the coarsest tier that
+#             still gives about one bucket per MAX_PIXELS_PER_POINT pixels of
+#             the plot, so a week long graph is a few hundred hourly or 15
+#             minute buckets instead of 60000 readings. On open, the newest
+#             bucket of each tier is reopened. Any readings stored after it
+#             (lost in a crash, or from before the store had rollups) are
+#             added back from the segments by the first append() or
+#             query_rollup(). Only append() writes them out, a store opened
+#             just to be read leaves its rollup files alone (and does not
+#             create them).
+#
+#  Author: Greg Kraus
+#
+#  History:
+#    20261018 - initial creation
+#    20261018 - run-length compaction of unchanged readings (format v2)
+#    20261018 - rollup tiers
+#    20261018 - rollups caught up on first use, not written by readers
+#    20261018 - runs up to 1800 s, two night sampling intervals
+#    20261018 - flush() writes the pending run too
+#
+#-------------------------------------------------------------------------------
+
+import bisect
+import math
+import os
+import struct
+
+FILE_MAGIC = b'CWSS'
+FILE_VERSION = 2
+HEADER = struct.Struct('<4sBxH')   # magic, version, pad, record size
+RECORD = struct.Struct('<ddI5fB')
+RUN_FIELDS = ('time', 'time_end', 'count')
+FIELDS = ('time', 'temp', 'pressure', 'humidity', 'range', 'volume', 'hall')
+VALUE_FIELDS = FIELDS[1:]
+
+HALL_UNKNOWN = 255
+
+FSYNC_POLICIES = ('always', 'flush', 'never')
+
+ROLLUP_MAGIC = b'CWSU'
+ROLLUP_VERSION = 1
+ROLLUP_RECORD = struct.Struct('<ddIfffIfff')
+ROLLUP_FIELDS = ('time', 'time_end', 'volume_count', 'volume_min', 'volume_max', 'volume',
+                 'temp_count', 'temp_min', 'temp_max', 'temp')
+ROLLUP_TIERS = (60, 900, 3600)   # seconds
+MAX_PIXELS_PER_POINT = 4
+CATCH_UP_SECONDS = 86400         # readings replayed into the rollups per query
+
+class TS_STORE:
+  def __init__(self, path, batch_size=6, fsync='flush', segment_records=100000,
+               deadbands=None, max_run_seconds=1800, rollups=ROLLUP_TIERS):
+    if fsync not in FSYNC_POLICIES:
+      raise ValueError('fsync policy must be one of {}'.format(FSYNC_POLICIES))
+
+    self.path = path
+    self.batch_size = 1 if fsync == 'always' else batch_size
+    self.fsync = fsync
+    self.segment_records = segment_records
+    self.max_run_seconds = max_run_seconds
+
+    # deadbands are kept as (value index, band) pairs
+    self.deadbands = None
+    if deadbands is not None:
+      self.deadbands = [(VALUE_FIELDS.index(k), v) for k, v in deadbands.items()]
+
+    self.buffer = []     # packed records not yet written
+    self.run = None      # [start, end, count, first values, value sums]
+    self.last_ts = None  # newest timestamp, buffered or on disk
+    self.readings = 0    # readings accepted since the store was opened
+    self.dropped = 0     # out of order readings that were rejected
+    self.file = None     # open handle to the newest segment
+    self.tail = False    # the pending run is on disk past the segment end
+
+    # segment index - parallel lists so bisect can work on first_ts
+    self.seg_names = []
+    self.seg_first = []
+    self.seg_last = []
+    self.seg_count = []
+
+    os.makedirs(self.path, exist_ok=True)
+    self.load_index()
+
+    self.rollups = [ROLLUP(self.path, res, fsync) for res in sorted(rollups or ())]
+    self.caught_up = False   # see catch_up_rollups()
+
+  #-------------------------------------
+
+  def __del__(self):
+    self.close()
+
+  #-------------------------------------
+
+  def __len__(self):
+    # number of records (runs), not readings
+    return sum(self.seg_count) + len(self.buffer) + (self.run is not None)
+
+  #-------------------------------------
+
+  def load_index(self):
+    # read the header, first and last record of every segment
+    names = sorted(n for n in os.listdir(self.path) if n.endswith('.seg'))
+    for name in names:
+      with open(os.path.join(self.path, name), 'rb') as f:
+        count = self.check_header(f, name)
+        if count == 0:
+          # header only - the store was stopped before the first write
+          os.remove(os.path.join(self.path, name))
+          continue
+        first = self.read_record(f, 0)[0]
+        last = self.read_record(f, count - 1)[1]
+      self.seg_names.append(name)
+      self.seg_first.append(first)
+      self.seg_last.append(last)
+      self.seg_count.append(count)
+
+    if len(self.seg_last) > 0:
+      self.last_ts = self.seg_last[-1]
+
+  #-------------------------------------
+
+  def check_header(self, f, name):
+    # returns the number of whole records in the segment
+    magic, version, rec_size = HEADER.unpack(f.read(HEADER.size))
+    if magic != FILE_MAGIC or version != FILE_VERSION or rec_size != RECORD.size:
+      raise ValueError('{} is not a version {} CWS segment'.format(name, FILE_VERSION))
+
+    size = os.fstat(f.fileno()).st_size
+    # a torn write at the end of the file is ignored
+    return (size - HEADER.size) // RECORD.size
+
+  #-------------------------------------
+
+  def read_record(self, f, index):
+    f.seek(HEADER.size + index * RECORD.size)
+    return RECORD.unpack(f.read(RECORD.size))
+
+  #-------------------------------------
+
+  def append(self, timestamp, temp=None, pressure=None, humidity=None,
+             range_cm=None, volume=None, hall=None):
+    # timestamps must only go up, otherwise bisecting breaks
+    if self.last_ts is not None and timestamp < self.last_ts:
+      self.dropped += 1
+      return False
+    self.catch_up_rollups()
+
+    values = (nan(temp), nan(pressure), nan(humidity), nan(range_cm),
+              nan(volume), HALL_UNKNOWN if hall is None else hall)
+    self.last_ts = timestamp
+    self.readings += 1
+    for rollup in self.rollups:
+      rollup.add(timestamp, values[4], values[0])
+
+    if self.deadbands is None:
+      self.write_run(timestamp, timestamp, 1, values)
+    elif self.run is not None and self.run_matches(timestamp, values):
+      self.run[1] = timestamp
+      self.run[2] += 1
+      self.run[4] = [a + b for a, b in zip(self.run[4], values)]
+    else:
+      self.close_run()
+      self.run = [timestamp, timestamp, 1, values, list(values)]
+
+    return True
+
+  #-------------------------------------
+
+  def run_matches(self, timestamp, values):
+    # NaN never matches, so missing readings always start a new run
+    start, end, count, first, sums = self.run
+    if timestamp - start > self.max_run_seconds or values[-1] != first[-1]:
+      return False
+    for idx, band in self.deadbands:
+      if not abs(values[idx] - first[idx]) <= band:
+        return False
+    return True
+
+  #-------------------------------------
+
+  def run_record(self):
+    # the pending run as a record, values averaged over the run
+    start, end, count, first, sums = self.run
+    means = [x / count for x in sums[:-1]] + [first[-1]]
+    return (start, end, count) + tuple(means)
+
+  #-------------------------------------
+
+  def close_run(self):
+    if self.run is not None:
+      rec = self.run_record()
+      self.run = None
+      self.write_run(rec[0], rec[1], rec[2], rec[3:])
+
+  #-------------------------------------
+
+  def write_run(self, start, end, count, values):
+    self.buffer.append(RECORD.pack(start, end, count, *values))
+    if len(self.buffer) >= self.batch_size:
+      self.flush()
+
+  #-------------------------------------
+
+  def flush(self):
+    # the buffered records, then the pending run so far (see above)
+    while len(self.buffer) > 0:
+      if self.file is None or self.seg_count[-1] >= self.segment_records:
+        self.new_segment()
+
+      # only fill the current segment up to segment_records
+      room = self.segment_records - self.seg_count[-1]
+      batch = self.buffer[:room]
+      self.buffer = self.buffer[room:]
+
+      self.file.seek(HEADER.size + self.seg_count[-1] * RECORD.size)
+      self.file.write(b''.join(batch))
+      self.file.flush()
+      if self.fsync != 'never':
+        os.fsync(self.file.fileno())
+
+      if self.seg_count[-1] == 0:
+        self.seg_first[-1] = RECORD.unpack(batch[0])[0]
+      self.seg_last[-1] = RECORD.unpack(batch[-1])[1]
+      self.seg_count[-1] += len(batch)
+
+    if self.run is not None or self.tail:
+      # write the run over the last one, or drop that once it is closed
+      if self.file is None or self.seg_count[-1] >= self.segment_records:
+        self.new_segment()
+      self.file.seek(HEADER.size + self.seg_count[-1] * RECORD.size)
+      if self.run is not None:
+        self.file.write(RECORD.pack(*self.run_record()))
+      self.file.truncate()
+      self.file.flush()
+      if self.fsync != 'never':
+        os.fsync(self.file.fileno())
+      self.tail = self.run is not None
+
+    for rollup in self.rollups:
+      rollup.flush()
+
+  #-------------------------------------
+
+  def new_segment(self):
+    # reopen the newest segment if it still has room, e.g. after a restart
+    if self.file is None and len(self.seg_names) > 0 \
+       and self.seg_count[-1] < self.segment_records:
+      self.file = open(os.path.join(self.path, self.seg_names[-1]), 'r+b')
+      self.file.truncate(HEADER.size + self.seg_count[-1] * RECORD.size)
+      return
+
+    if self.file is not None:
+      self.file.close()
+
+    number = 1
+    if len(self.seg_names) > 0:
+      number = int(self.seg_names[-1].split('.')[0]) + 1
+    name = '{:08d}.seg'.format(number)
+
+    self.file = open(os.path.join(self.path, name), 'wb')
+    self.file.write(HEADER.pack(FILE_MAGIC, FILE_VERSION, RECORD.size))
+
+    self.seg_names.append(name)
+    self.seg_first.append(None)
+    self.seg_last.append(None)
+    self.seg_count.append(0)
+
+  #-------------------------------------
+
+  def close(self):
+    # a store nothing was appended to has nothing to write
+    if self.readings == 0:
+      return
+    self.close_run()
+    if self.file is not None or len(self.buffer) > 0:
+      self.flush()
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+    for rollup in self.rollups:
+      rollup.close()
+
+  #-------------------------------------
+
+  def query(self, t_start, t_end, expand=True):
+    # Return the readings with t_start <= time <= t_end, oldest first.
+    # With expand=False the raw run records are returned instead, with
+    # their time_end and count fields.
+    records = []
+
+    # skip segments that end before t_start
+    first_seg = max(bisect.bisect_right(self.seg_first, t_start) - 1, 0)
+    for seg in range(first_seg, len(self.seg_names)):
+      if self.seg_count[seg] == 0 or self.seg_first[seg] > t_end:
+        break
+      if self.seg_last[seg] < t_start:
+        continue
+      records.extend(self.query_segment(seg, t_start, t_end))
+
+    # and anything still waiting in the write buffer or the open run
+    pending = [RECORD.unpack(packed) for packed in self.buffer]
+    if self.run is not None:
+      pending.append(self.run_record())
+    for rec in pending:
+      if rec[0] <= t_end and rec[1] >= t_start:
+        records.append(rec)
+
+    if not expand:
+      return [to_dict(rec, RUN_FIELDS + VALUE_FIELDS) for rec in records]
+
+    readings = []
+    for rec in records:
+      readings.extend(r for r in expand_run(rec) if t_start <= r['time'] <= t_end)
+    return readings
+
+  #-------------------------------------
+
+  def query_segment(self, seg, t_start, t_end):
+    with open(os.path.join(self.path, self.seg_names[seg]), 'rb') as f:
+      count = self.seg_count[seg]
+
+      # bisect for the first run that ends at or after t_start
+      lo, hi = 0, count
+      while lo < hi:
+        mid = (lo + hi) // 2
+        if self.read_record(f, mid)[1] < t_start:
+          lo = mid + 1
+        else:
+          hi = mid
+
+      # then read forward in one go until t_end
+      records = []
+      f.seek(HEADER.size + lo * RECORD.size)
+      data = f.read((count - lo) * RECORD.size)
+      for rec in RECORD.iter_unpack(data):
+        if rec[0] > t_end:
+          break
+        records.append(rec)
+
+    return records
+
+  #-------------------------------------
+
+  def last(self):
+    # newest reading, or None if the store is empty
+    if self.run is not None:
+      return expand_run(self.run_record())[-1]
+    if len(self.buffer) > 0:
+      return expand_run(RECORD.unpack(self.buffer[-1]))[-1]
+    if len(self.seg_names) == 0 or self.seg_count[-1] == 0:
+      return None
+    with open(os.path.join(self.path, self.seg_names[-1]), 'rb') as f:
+      return expand_run(self.read_record(f, self.seg_count[-1] - 1))[-1]
+
+  #-------------------------------------
+
+  def catch_up_rollups(self):
+    # add the stored readings newer than each tier's newest bucket, a day
+    # at a time. Normally that is only whatever a crash left out. They are
+    # written with the next flush() after an append.
+    if self.caught_up:
+      return
+    self.caught_up = True
+    if self.last_ts is None or len(self.rollups) == 0:
+      return
+    behind = [r.last_time for r in self.rollups]
+    if None in behind:
+      start = self.seg_first[0]
+    else:
+      start = min(behind)
+    if start >= self.last_ts:
+      return
+
+    while start <= self.last_ts:
+      end = start + CATCH_UP_SECONDS
+      for reading in self.query(start, end):
+        for rollup in self.rollups:
+          if rollup.last_time is None or reading['time'] > rollup.last_time:
+            rollup.add(reading['time'], reading['volume'], reading['temp'])
+      start = end
+
+  #-------------------------------------
+
+  def query_rollup(self, t_start, t_end, width=800, resolution=None):
+    # Volume and temperature min/max/mean per bucket for t_start..t_end,
+    # from the coarsest tier with at least width / MAX_PIXELS_PER_POINT
+    # buckets in the window, or from the tier with the given resolution.
+    # If no tier is fine enough the raw readings come back in the same form.
+    self.catch_up_rollups()
+    rollup = None
+    if resolution is not None:
+      for r in self.rollups:
+        if r.resolution == resolution:
+          rollup = r
+      if rollup is None:
+        raise ValueError('no {} second rollup tier'.format(resolution))
+    else:
+      for r in self.rollups:
+        if (t_end - t_start) / r.resolution >= width / MAX_PIXELS_PER_POINT:
+          rollup = r   # tiers are sorted, so the last match is the coarsest
+
+    if rollup is not None:
+      return rollup.query(t_start, t_end)
+    return [reading_to_rollup(r) for r in self.query(t_start, t_end)]
+
+#-------------------------------------------------------------------------------
+
+class ROLLUP:
+  # one tier of fixed size buckets
+
+  def __init__(self, path, resolution, fsync='flush'):
+    self.resolution = resolution
+    self.fsync = fsync
+    self.filename = os.path.join(path, 'rollup_{:06d}.dat'.format(resolution))
+    self.buffer = []   # packed buckets not yet written
+    # open bucket: [start, last time, volume count, min, max, sum,
+    #               temp count, min, max, sum]
+    self.bucket = None
+    self.count = 0
+    self.reopened = False
+
+    # the file is only created by the first flush()
+    self.on_disk = os.path.isfile(self.filename) and os.path.getsize(self.filename) >= HEADER.size
+    if self.on_disk:
+      self.open_file()
+    self.dirty = False
+
+  #-------------------------------------
+
+  def open_file(self):
+    with open(self.filename, 'rb') as f:
+      magic, version, rec_size = HEADER.unpack(f.read(HEADER.size))
+      if magic != ROLLUP_MAGIC or version != ROLLUP_VERSION or rec_size != ROLLUP_RECORD.size:
+        raise ValueError('{} is not a version {} CWS rollup'.format(self.filename, ROLLUP_VERSION))
+      # a torn write at the end of the file is ignored (and overwritten)
+      self.count = (os.fstat(f.fileno()).st_size - HEADER.size) // ROLLUP_RECORD.size
+
+      # reopen the newest bucket, readings after a restart may belong to
+      # it. Its record is rewritten in place when the bucket is written.
+      self.reopened = self.count > 0
+      if self.reopened:
+        self.bucket = unpack_bucket(self.read_record(f, self.count - 1))
+
+  #-------------------------------------
+
+  @property
+  def last_time(self):
+    # time of the newest reading in the tier
+    if self.bucket is not None:
+      return self.bucket[1]
+    if len(self.buffer) > 0:
+      return ROLLUP_RECORD.unpack(self.buffer[-1])[1]
+    return None
+
+  #-------------------------------------
+
+  def read_record(self, f, index):
+    f.seek(HEADER.size + index * ROLLUP_RECORD.size)
+    return ROLLUP_RECORD.unpack(f.read(ROLLUP_RECORD.size))
+
+  #-------------------------------------
+
+  def add(self, timestamp, volume, temp):
+    start = math.floor(timestamp / self.resolution) * self.resolution
+    if self.bucket is not None and self.bucket[0] != start:
+      self.buffer.append(pack_bucket(self.bucket))
+      self.bucket = None
+    if self.bucket is None:
+      self.bucket = [start, timestamp, 0, math.inf, -math.inf, 0.0,
+                     0, math.inf, -math.inf, 0.0]
+
+    b = self.bucket
+    b[1] = timestamp
+    self.dirty = True
+    if not math.isnan(volume):
+      b[2] += 1
+      b[3] = min(b[3], volume)
+      b[4] = max(b[4], volume)
+      b[5] += volume
+    if not math.isnan(temp):
+      b[6] += 1
+      b[7] = min(b[7], temp)
+      b[8] = max(b[8], temp)
+      b[9] += temp
+
+  #-------------------------------------
+
+  def flush(self):
+    if len(self.buffer) == 0:
+      return
+    if not self.on_disk:
+      with open(self.filename, 'wb') as f:
+        f.write(HEADER.pack(ROLLUP_MAGIC, ROLLUP_VERSION, ROLLUP_RECORD.size))
+      self.on_disk = True
+    # the first buffered bucket replaces a reopened bucket's old record
+    first = self.count - 1 if self.reopened else self.count
+    with open(self.filename, 'rb+') as f:
+      f.seek(HEADER.size + first * ROLLUP_RECORD.size)
+      f.write(b''.join(self.buffer))
+      f.flush()
+      if self.fsync != 'never':
+        os.fsync(f.fileno())
+    self.count = first + len(self.buffer)
+    self.reopened = False
+    self.buffer = []
+
+  #-------------------------------------
+
+  def close(self):
+    # the open bucket is written too, and reopened by the next ROLLUP
+    if self.bucket is not None and self.dirty:
+      self.buffer.append(pack_bucket(self.bucket))
+    self.bucket = None
+    self.dirty = False
+    self.flush()
+
+  #-------------------------------------
+
+  def query(self, t_start, t_end):
+    # buckets holding readings in t_start..t_end, oldest first
+    records = []
+    # a reopened bucket's old record is left out, the open bucket replaces it
+    count = self.count - 1 if self.reopened else self.count
+    if count > 0:
+      with open(self.filename, 'rb') as f:
+        # bisect for the first bucket that ends at or after t_start
+        lo, hi = 0, count
+        while lo < hi:
+          mid = (lo + hi) // 2
+          if self.read_record(f, mid)[1] < t_start:
+            lo = mid + 1
+          else:
+            hi = mid
+
+        f.seek(HEADER.size + lo * ROLLUP_RECORD.size)
+        data = f.read((count - lo) * ROLLUP_RECORD.size)
+        for rec in ROLLUP_RECORD.iter_unpack(data):
+          if rec[0] > t_end:
+            break
+          records.append(rec)
+
+    pending = [ROLLUP_RECORD.unpack(packed) for packed in self.buffer]
+    if self.bucket is not None:
+      pending.append(ROLLUP_RECORD.unpack(pack_bucket(self.bucket)))
+    for rec in pending:
+      if rec[0] <= t_end and rec[1] >= t_start:
+        records.append(rec)
+
+    return [dict(zip(ROLLUP_FIELDS, rec)) for rec in records]
+
+#-------------------------------------------------------------------------------
+
+def pack_bucket(b):
+  start, end, v_count, v_min, v_max, v_sum, t_count, t_min, t_max, t_sum = b
+  if v_count == 0:
+    v_min = v_max = v_sum = math.nan
+  if t_count == 0:
+    t_min = t_max = t_sum = math.nan
+  return ROLLUP_RECORD.pack(start, end, v_count, v_min, v_max, v_sum / max(v_count, 1),
+                            t_count, t_min, t_max, t_sum / max(t_count, 1))
+
+#-------------------------------------------------------------------------------
+
+def unpack_bucket(rec):
+  # back to the open bucket form, means turned back into sums
+  start, end, v_count, v_min, v_max, v_mean, t_count, t_min, t_max, t_mean = rec
+  if v_count == 0:
+    v_min, v_max, v_mean = math.inf, -math.inf, 0.0
+  if t_count == 0:
+    t_min, t_max, t_mean = math.inf, -math.inf, 0.0
+  return [start, end, v_count, v_min, v_max, v_mean * v_count,
+          t_count, t_min, t_max, t_mean * t_count]
+
+#-------------------------------------------------------------------------------
+
+def reading_to_rollup(r):
+  has_volume = not math.isnan(r['volume'])
+  has_temp = not math.isnan(r['temp'])
+  return {'time': r['time'], 'time_end': r['time'],
+          'volume_count': int(has_volume), 'volume_min': r['volume'],
+          'volume_max': r['volume'], 'volume': r['volume'],
+          'temp_count': int(has_temp), 'temp_min': r['temp'],
+          'temp_max': r['temp'], 'temp': r['temp']}
+
+#-------------------------------------------------------------------------------
+
+def nan(value):
+  return math.nan if value is None else value
+
+#-------------------------------------------------------------------------------
+
+def to_dict(rec, fields=FIELDS):
+  data = dict(zip(fields, rec))
+  if data['hall'] == HALL_UNKNOWN:
+    data['hall'] = None
+  return data
+
+#-------------------------------------------------------------------------------
+
+def expand_run(rec):
+  # turn one run record back into count evenly spaced readings
+  start, end, count = rec[:3]
+  step = (end - start) / (count - 1) if count > 1 else 0
+  return [to_dict((start + ii * step,) + rec[3:]) for ii in range(count)]
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  import shutil
+  import time
+
+  print('TS_STORE class test example')
+  path = 'test_ts_store'
+  shutil.rmtree(path, ignore_errors=True)
+
+  store = TS_STORE(path, batch_size=10, fsync='never', segment_records=100,
+                   deadbands={'range': 0.2, 'temp': 0.1})
+  t0 = int(time.time())
+  for ii in range(5000):
+    # the level drops 1 cm every 100 readings
+    store.append(t0 + ii * 10, 20.0, 1013.0, 50.0, 20.0 + (ii // 100) + (ii % 3) * 0.05, 18.5, 1)
+  print('readings: {}  records: {}'.format(store.readings, len(store)))
+  store.close()
+
+  store = TS_STORE(path)
+  print('records: {}  segments: {}'.format(len(store), len(store.seg_names)))
+  for rec in store.query(t0 + 12000, t0 + 12030):
+    print(rec)
+  print('last: {}'.format(store.last()))
+
+  # a week long plot 800 pixels wide, from a rollup tier
+  buckets = store.query_rollup(t0, t0 + 7 * 86400, width=800)
+  print('rollup buckets: {}  first: {}'.format(len(buckets), buckets[0]))
+  store.close()
+
+  shutil.rmtree(path)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: uplink.py
+#
+# Description: Node side of the CWS fleet collector (collector.py). Sends this
+#           node's status snapshots to the collector in batches, and keeps
+#           them until the collector has acked them.
+#
+#           add() only numbers the snapshot and puts it in a bounded buffer,
+#           so it never waits on the network. A sender thread sends a batch
+#           every interval seconds, or as soon as batch_size snapshots are
+#           waiting, over one kept open TCP connection, and drops the
+#           snapshots the ack covers. If the collector cannot be reached, or
+#           does not ack within timeout seconds, the connection is closed and
+#           the batch sent again after a backoff that doubles up to
+#           max_backoff seconds. During a long outage the buffer holds the
+#           newest max_buffer snapshots; older ones are dropped, and show up
+#           at the collector as a gap.
+#
+#           Each start of the node is a new boot id, and its snapshots are
+#           numbered from 0, see collector.py. The id is a start counter kept
+#           in boot_file and a random part, not the system clock, which can
+#           come up behind its last value after a power cut. The buffer is in memory only,
+#           whatever a node crash loses is still in the node's own history.
+#
+#           node_snapshot() is the part of the cws_main.py status that is
+#           sent: the readings, the consumption and empty time estimates and
+#           the active alerts.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Boot ids from a start counter
+#
+#-------------------------------------------------------------------------------
+
+import collections
+import os
+import socket
+import threading
+import time
+
+from collector import encode, recv_frame
+
+#-------------------------------------------------------------------------------
+
+def node_snapshot(status):
+  bme = status.get('bme') or {}
+  estimates = status.get('estimates') or {}
+  return {
+    'time'       : status['timestamp'],
+    'temp'       : bme.get('temp'),
+    'pressure'   : bme.get('pressure'),
+    'humidity'   : bme.get('humidity'),
+    'range'      : None if status.get('height') is None else status.get('range'),
+    'volume'     : status.get('volume'),
+    'hall'       : status.get('hall'),
+    'rate'       : estimates.get('rate'),
+    'empty_time' : estimates.get('empty_time'),
+    'refilling'  : status.get('refilling', False),
+    'alerts'     : [a['rule'] for a in status.get('alerts', [])],
+  }
+
+#-------------------------------------------------------------------------------
+
+def boot_id(filename=None):
+  # a new id for this start of the node: the start count, kept in filename,
+  # and a random part so the id is still new if the file is lost or restored
+  count = 0
+  if filename is not None:
+    try:
+      with open(filename) as f:
+        count = int(f.read()) + 1
+    except (OSError, ValueError):
+      pass
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+      f.write('{}\n'.format(count))
+    os.replace(tmp, filename)
+  return '{}-{}'.format(count, os.urandom(4).hex())
+
+#-------------------------------------------------------------------------------
+
+class UPLINK:
+  def __init__(self, host, port, station, batch_size=30, interval=60, max_buffer=20000,
+               timeout=10, max_backoff=300, boot_file=None):
+    self.host = host
+    self.port = port
+    self.station = station
+    self.batch_size = batch_size
+    self.interval = interval
+    self.timeout = timeout
+    self.max_backoff = max_backoff
+    self.boot = boot_id(boot_file)
+
+    self.lock = threading.Lock()
+    self.buffer = collections.deque(maxlen=max_buffer)   # (seq, snapshot)
+    self.next_seq = 0
+    self.sock = None
+    self.backoff = 0
+
+    self.sent = 0        # snapshots acked
+    self.batches = 0
+    self.resent = 0      # batches sent again after a failure
+    self.dropped = 0     # snapshots lost to a full buffer
+    self.failures = 0
+    self.last_error = None
+    self.retrying = False
+
+    self.wake = threading.Event()
+    self.stopping = threading.Event()
+    self.thread = threading.Thread(target=self.run, name='uplink', daemon=True)
+    self.thread.start()
+
+  #-------------------------------------
+
+  def add(self, snapshot):
+    with self.lock:
+      if len(self.buffer) == self.buffer.maxlen:
+        self.dropped += 1
+      self.buffer.append((self.next_seq, snapshot))
+      self.next_seq += 1
+      waiting = len(self.buffer)
+    if waiting >= self.batch_size:
+      self.wake.set()
+
+  #-------------------------------------
+
+  def run(self):
+    while not self.stopping.is_set():
+      self.wake.wait(self.backoff or self.interval)
+      self.wake.clear()
+      self.send_waiting()
+
+  #-------------------------------------
+
+  def send_waiting(self):
+    # send batches until the buffer is empty or a send fails
+    while True:
+      with self.lock:
+        batch = list(self.buffer)[:self.batch_size]
+      if len(batch) == 0:
+        return True
+      if not self.send_batch(batch):
+        return False
+
+  #-------------------------------------
+
+  def send_batch(self, batch):
+    if self.retrying:
+      self.resent += 1
+    try:
+      if self.sock is None:
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+      self.sock.sendall(encode({'type': 'batch', 'station': self.station, 'boot': self.boot,
+                                'seq': batch[0][0], 'snapshots': [s for n, s in batch]}))
+      ack = recv_frame(self.sock)
+      if ack is None or ack.get('boot') != self.boot:
+        raise ConnectionError('no ack')
+    except (OSError, ValueError) as e:
+      self.failures += 1
+      self.last_error = repr(e)
+      self.retrying = True
+      self.disconnect()
+      self.backoff = min(max(self.backoff * 2, 1), self.max_backoff)
+      return False
+
+    with self.lock:
+      while len(self.buffer) > 0 and self.buffer[0][0] <= ack['seq']:
+        self.buffer.popleft()
+        self.sent += 1
+    self.batches += 1
+    self.retrying = False
+    self.backoff = 0
+    return True
+
+  #-------------------------------------
+
+  def disconnect(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+
+  #-------------------------------------
+
+  def close(self, timeout=5):
+    # one last try to send what is waiting, for at most about timeout seconds
+    self.stopping.set()
+    self.wake.set()
+    self.thread.join()
+    self.timeout = timeout
+    if self.sock is not None:
+      self.sock.settimeout(timeout)
+    deadline = time.monotonic() + timeout
+    while len(self.buffer) > 0 and time.monotonic() < deadline:
+      if not self.send_waiting():
+        time.sleep(min(self.backoff, max(deadline - time.monotonic(), 0)))
+    self.disconnect()
+
+  #-------------------------------------
+
+  def stats(self):
+    return {
+      'waiting'    : len(self.buffer),
+      'sent'       : self.sent,
+      'batches'    : self.batches,
+      'resent'     : self.resent,
+      'dropped'    : self.dropped,
+      'failures'   : self.failures,
+      'last_error' : self.last_error,
+    }
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+#-------------------------------------------------------------------------------
+#
+# Filename: volume_table.py
+#
+# Description: Water height to volume lookup table for the CWS buckets.
+#
+#           A VOLUME_TABLE is a list of (height, volume) points, heights in
+#           cm above the empty (water out) level and volumes in liters for
+#           the buckets one ranger measures (all of them with a single
+#           ranger, see cws_main.py RANGER_PINS). volume() interpolates linearly between the
+#           points with a bisect, and volumes_for() does a whole array at once
+#           (numpy.interp for a NumPy array), so the main loop and
+#           reprocess_echoes.py convert heights exactly the same way.
+#           height() goes the other way, e.g. for the simulated water model.
+#
+#           A table is built from either:
+#             * geometry_table() - the bucket shape. A 5 gal bucket tapers,
+#               so each bucket is a frustum, its radius changing linearly
+#               from the empty level to the full level. All buckets are
+#               connected at the bottom and fill to the same level, so the
+#               table volume is buckets times the volume of one.
+#             * calibration_table() - a recorded fill calibration run: known
+#               amounts of water poured in, and the range reading after each,
+#               e.g. from a CSV file via load_calibration().
+#
+#           cached_table() keeps a built table on disk, with a key made from
+#           the description it was built from, and only rebuilds it when
+#           that description changes. The file has the same small header as
+#           the TS_STORE segments, the key, then (height, volume) float64
+#           pairs.
+#
+#           Above the top of the table the volume is extrapolated from its
+#           last section, below the bottom it is 0.
+#
+# Author: Greg Kraus
+# History: 20261018 Initial creation
+#          20261018 Do not import NumPy, it is only needed for NumPy arrays
+#
+#-------------------------------------------------------------------------------
+
+import bisect
+import csv
+import hashlib
+import json
+import math
+import os
+import struct
+import sys
+
+from ts_store import HEADER
+
+FILE_MAGIC = b'CWSV'
+FILE_VERSION = 1
+POINT = struct.Struct('<dd')   # height cm, volume liters
+KEY_SIZE = 20                  # sha1 digest of the table description
+
+GEOMETRY_STEPS = 256           # table points for a geometry table
+
+#-------------------------------------------------------------------------------
+
+class VOLUME_TABLE:
+  def __init__(self, heights, volumes):
+    # heights and volumes must both be strictly increasing
+    if len(heights) != len(volumes) or len(heights) < 2:
+      raise ValueError('a volume table needs at least 2 (height, volume) points')
+    for ii in range(1, len(heights)):
+      if heights[ii] <= heights[ii - 1] or volumes[ii] <= volumes[ii - 1]:
+        raise ValueError('volume table heights and volumes must increase')
+
+    self.heights = [float(h) for h in heights]
+    self.volumes = [float(v) for v in volumes]
+    # liters per cm above the top of the table
+    self.top_slope = ((self.volumes[-1] - self.volumes[-2]) /
+                      (self.heights[-1] - self.heights[-2]))
+
+  #-------------------------------------
+
+  def __len__(self):
+    return len(self.heights)
+
+  #-------------------------------------
+
+  def capacity(self):
+    # volume at the top of the table (full)
+    return self.volumes[-1]
+
+  #-------------------------------------
+
+  def volume(self, height_cm):
+    return interpolate(self.heights, self.volumes, height_cm, self.top_slope)
+
+  #-------------------------------------
+
+  def height(self, liters):
+    return interpolate(self.volumes, self.heights, liters, 1 / self.top_slope)
+
+  #-------------------------------------
+
+  def volumes_for(self, heights_cm):
+    # volume of every height in a list or NumPy array, returned the same way.
+    # A NumPy array means NumPy is already imported, the main loop never
+    # pays for importing it.
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(heights_cm, np.ndarray):
+      h = heights_cm.astype(np.float64)
+      v = np.interp(h, self.heights, self.volumes)
+      above = h > self.heights[-1]
+      v[above] = self.volumes[-1] + (h[above] - self.heights[-1]) * self.top_slope
+      return v
+    return [self.volume(h) for h in heights_cm]
+
+  #-------------------------------------
+
+  def save(self, filename, key=b''):
+    # write to a temp file and rename it over the old one
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+      f.write(HEADER.pack(FILE_MAGIC, FILE_VERSION, POINT.size))
+      f.write(key.ljust(KEY_SIZE, b'\0'))
+      f.write(b''.join(POINT.pack(h, v) for h, v in zip(self.heights, self.volumes)))
+    os.replace(tmp, filename)
+
+  #-------------------------------------
+
+  @classmethod
+  def load(cls, filename, key=None):
+    # returns None if the file is not a table, or was built from a
+    # different description than key
+    with open(filename, 'rb') as f:
+      data = f.read()
+    if len(data) < HEADER.size + KEY_SIZE:
+      return None
+    magic, version, point_size = HEADER.unpack_from(data)
+    if magic != FILE_MAGIC or version != FILE_VERSION or point_size != POINT.size:
+      return None
+    if key is not None and data[HEADER.size:HEADER.size + KEY_SIZE] != key.ljust(KEY_SIZE, b'\0'):
+      return None
+
+    points = data[HEADER.size + KEY_SIZE:]
+    points = list(POINT.iter_unpack(points[:len(points) - len(points) % POINT.size]))
+    try:
+      return cls([p[0] for p in points], [p[1] for p in points])
+    except ValueError:
+      return None
+
+#-------------------------------------------------------------------------------
+
+def interpolate(xs, ys, x, top_slope):
+  # piecewise linear y(x), 0 below xs[0], extended with top_slope above xs[-1]
+  if x is None or math.isnan(x):
+    return math.nan
+  if x <= xs[0]:
+    return ys[0]
+  if x >= xs[-1]:
+    return ys[-1] + (x - xs[-1]) * top_slope
+  ii = bisect.bisect_right(xs, x)
+  x0, x1 = xs[ii - 1], xs[ii]
+  y0, y1 = ys[ii - 1], ys[ii]
+  return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+#-------------------------------------------------------------------------------
+
+def geometry_table(empty_radius_cm, full_radius_cm, full_height_cm, buckets=1,
+                   steps=GEOMETRY_STEPS):
+  # buckets tapering linearly from empty_radius_cm at the empty level to
+  # full_radius_cm full_height_cm above it. Each section is an exact
+  # frustum, so the table is exact at its points.
+  heights = []
+  volumes = []
+  for ii in range(steps + 1):
+    h = full_height_cm * ii / steps
+    r = empty_radius_cm + (full_radius_cm - empty_radius_cm) * ii / steps
+    v = math.pi * h / 3 * (empty_radius_cm ** 2 + empty_radius_cm * r + r ** 2)
+    heights.append(h)
+    volumes.append(buckets * v / 1000)
+  return VOLUME_TABLE(heights, volumes)
+
+#-------------------------------------------------------------------------------
+
+def calibration_table(points, empty_distance_cm):
+  # points are (liters, distance cm) readings from a fill calibration run,
+  # liters counted from the empty level. Readings at the same amount are
+  # averaged, and a point that does not raise both the height and the
+  # volume (sensor noise) is dropped.
+  readings = {}
+  for liters, distance in points:
+    readings.setdefault(float(liters), []).append(float(distance))
+  if 0.0 not in readings:
+    readings[0.0] = [empty_distance_cm]
+
+  heights = []
+  volumes = []
+  for liters in sorted(readings):
+    distances = readings[liters]
+    h = max(empty_distance_cm - sum(distances) / len(distances), 0)
+    if len(heights) > 0 and (h <= heights[-1] or liters <= volumes[-1]):
+      continue
+    heights.append(h)
+    volumes.append(liters)
+  return VOLUME_TABLE(heights, volumes)
+
+#-------------------------------------------------------------------------------
+
+def load_calibration(filename):
+  # (liters, distance cm) points from a CSV file with liters and
+  # distance_cm columns
+  with open(filename, newline='') as f:
+    return [(float(row['liters']), float(row['distance_cm'])) for row in csv.DictReader(f)]
+
+#-------------------------------------------------------------------------------
+
+def table_key(description):
+  return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).digest()
+
+#-------------------------------------------------------------------------------
+
+def cached_table(filename, description, build):
+  # the table in filename if it was built from description, otherwise
+  # build() it and save it there
+  key = table_key(description)
+  if os.path.exists(filename):
+    table = VOLUME_TABLE.load(filename, key)
+    if table is not None:
+      return table
+
+  table = build()
+  table.save(filename, key)
+  return table
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  import time
+
+  try:
+    import numpy as np
+  except ImportError:
+    np = None
+
+  print('VOLUME_TABLE test example')
+
+  # two 5 gal buckets, 10" across at the water out level, 10.75" at full
+  table = geometry_table(5.0 * 2.54, (10.75 / 2) * 2.54, 32.0, buckets=2)
+  cylinder = 32.0 * math.pi * ((10.75 / 2) * 2.54) ** 2 / 1000 * 2
+  print('capacity {:.2f} L (cylinder {:.2f} L)'.format(table.capacity(), cylinder))
+  for h in (0, 0.01, 8, 16, 24, 32, 33):
+    v = table.volume(h)
+    print('{:5.2f} cm  {:6.3f} L  -> {:.3f} cm'.format(h, v, table.height(v)))
+
+  cal = calibration_table([(4, 33.0), (8, 28.6), (8, 28.8), (16, 19.9), (24, 10.8)], 37.4)
+  print('calibration run: {} points, 12 L at {:.2f} cm'.format(len(cal), cal.height(12)))
+
+  heights = [ii * 0.01 for ii in range(100000)]
+  t0 = time.perf_counter()
+  table.volumes_for(heights)
+  print('{:.0f} lookups/s'.format(len(heights) / (time.perf_counter() - t0)))
+  if np is not None:
+    heights = np.array(heights)
+    t0 = time.perf_counter()
+    table.volumes_for(heights)
+    print('{:.0f} lookups/s (numpy)'.format(len(heights) / (time.perf_counter() - t0)))
+
+  table.save('test_volume_table.dat', table_key('test'))
+  print('reloaded: {}'.format(VOLUME_TABLE.load('test_volume_table.dat', table_key('test')) is not None))
+  print('stale key: {}'.format(VOLUME_TABLE.load('test_volume_table.dat', table_key('other'))))
+  os.remove('test_volume_table.dat')